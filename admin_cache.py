@@ -0,0 +1,141 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, FrozenSet, List, Optional
+
+import storage
+from firebase_file import reference
+
+logger = logging.getLogger(__name__)
+
+ADMIN_CACHE_TTL = float(os.getenv("ADMIN_CACHE_TTL", "300"))
+
+
+class AdminCache:
+    """
+    Unica copia in memoria degli ID admin del bot.
+    Viene aggiornata da un listener Firebase sul nodo 'admin_ids' (o, se il
+    listener non è disponibile, ricaricata ogni ADMIN_CACHE_TTL secondi).
+    L'insieme è immutabile e viene sostituito in blocco, quindi i controlli
+    dei permessi sono semplici lookup senza lock né letture di rete.
+    """
+
+    def __init__(self, ttl: float = ADMIN_CACHE_TTL):
+        self.ttl = ttl
+        self._ids: FrozenSet[int] = frozenset()
+        self._loaded_at: Optional[float] = None
+        self._write_lock = asyncio.Lock()
+        self._listener = None
+        self._task: Optional[asyncio.Task] = None
+        # Righe (id, username) già risolte su Telegram per la lista admin paginata
+        self._rows: Optional[List[Dict]] = None
+        self._rows_at = 0.0
+
+    def refresh(self) -> FrozenSet[int]:
+        """Ricarica gli admin da Firebase (chiamata bloccante, per il thread del listener)."""
+        self._set(storage.backend.load_admin_ids())
+        return self._ids
+
+    async def reload(self) -> FrozenSet[int]:
+        """Ricarica gli admin da Firebase senza bloccare il loop."""
+        self._set(await storage.load_admin_ids())
+        return self._ids
+
+    def _set(self, admin_ids) -> None:
+        ids = frozenset(int(uid) for uid in admin_ids)
+        if ids != self._ids:
+            self._rows = None
+        self._ids = ids
+        self._loaded_at = time.monotonic()
+
+    def rows(self) -> Optional[List[Dict]]:
+        """Righe della lista admin risolte di recente, None se la lista è cambiata o sono più vecchie del TTL."""
+        if self._rows is None or time.monotonic() - self._rows_at > self.ttl:
+            return None
+        return self._rows
+
+    def set_rows(self, admin_ids: FrozenSet[int], rows: List[Dict]) -> None:
+        """Memorizza le righe risolte per admin_ids, se nel frattempo la lista non è cambiata."""
+        if admin_ids == self._ids:
+            self._rows = rows
+            self._rows_at = time.monotonic()
+
+    def ids(self) -> FrozenSet[int]:
+        # La lista viene caricata all'avvio con reload(): qui nessuna lettura di rete sul loop
+        return self._ids
+
+    def is_admin(self, user_id: int) -> bool:
+        return user_id in self.ids()
+
+    async def add(self, user_id: int) -> Optional[bool]:
+        """
+        Aggiunge un admin e lo salva su Firebase. Restituisce False se era già presente,
+        None se il salvataggio non è riuscito (la cache resta invariata).
+        """
+        async with self._write_lock:
+            current = self.ids()
+            if user_id in current:
+                return False
+            updated = current | {user_id}
+            if not await storage.save_admin_ids(set(updated)):
+                return None
+            self._set(updated)
+        return True
+
+    async def remove(self, user_id: int) -> Optional[bool]:
+        """
+        Rimuove un admin e salva su Firebase. Restituisce False se non era presente,
+        None se il salvataggio non è riuscito (la cache resta invariata).
+        """
+        async with self._write_lock:
+            current = self.ids()
+            if user_id not in current:
+                return False
+            updated = current - {user_id}
+            if not await storage.save_admin_ids(set(updated)):
+                return None
+            self._set(updated)
+        return True
+
+    def _on_event(self, event) -> None:
+        # Il listener gira in un thread di firebase_admin: basta rileggere il nodo, che è piccolo
+        try:
+            self.refresh()
+            logger.info(f"Lista admin aggiornata dal listener Firebase ({len(self._ids)} admin).")
+        except Exception as e:
+            logger.error(f"Errore nell'aggiornamento della lista admin: {e}")
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.ttl)
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.error(f"Errore nel refresh periodico degli admin: {e}")
+
+    def start(self) -> None:
+        """Avvia il listener Firebase; in caso di errore ripiega sul refresh periodico."""
+        if self._listener is not None or self._task is not None:
+            return
+        if storage.STORAGE_BACKEND == "sqlite":
+            # Nessun listener con SQLite: la lista viene riletta periodicamente
+            self._task = asyncio.create_task(self._refresh_loop())
+            return
+        try:
+            self._listener = reference('admin_ids').listen(self._on_event)
+            logger.info("Listener Firebase sulla lista admin avviato.")
+        except Exception as e:
+            logger.warning(f"Listener admin non disponibile ({e}), uso refresh ogni {self.ttl}s.")
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    def stop(self) -> None:
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+admin_cache = AdminCache()
@@ -0,0 +1,229 @@
+"""
+Backup e ripristino del database a flusso.
+
+Il backup scorre i nodi principali con letture shallow e ne scarica i figli a
+pagine, scrivendo un record per riga (JSON) in un file compresso con lz4: la
+memoria resta limitata a una pagina, qualunque sia la dimensione del database.
+I backup incrementali contengono solo i record di 'group_users' e 'stats'
+toccati dopo il backup precedente (letti dal registro modifiche) più i nodi
+piccoli, interi. Il file manifest.json nella cartella dei backup tiene la
+catena: l'ultimo completo e gli incrementali successivi, nell'ordine in cui
+vanno ripristinati.
+
+Uso (con il bot fermo per il ripristino):
+    python backup.py                      # backup completo
+    python backup.py --incrementale       # solo le modifiche dall'ultimo backup
+    python backup.py --ripristina         # ripristina la catena del manifest
+    python backup.py --ripristina FILE... # ripristina i file indicati, in ordine
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+import lz4.frame
+
+import storage
+from firebase_file import CHANGES_NODE, CHANGES_HEAD, APPLIED_NODE, change_stamp
+from snapshot import SNAPSHOT_MAX_AGE, SNAPSHOT_CLOCK_MARGIN
+
+logger = logging.getLogger(__name__)
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_PAGE_SIZE = int(os.getenv("BACKUP_PAGE_SIZE", "500"))
+BACKUP_RESTORE_BATCH = int(os.getenv("BACKUP_RESTORE_BATCH", "500"))
+BACKUP_FORMAT = 1
+MANIFEST = "manifest.json"
+
+# Profondità a cui ogni nodo viene diviso in record (1 = un record per figlio,
+# 2 = uno per nipote, cioè per utente di ogni chat). Gli altri nodi sono un record unico.
+NODE_DEPTH = {"group_users": 2, "stats": 1, "pending_feedback": 1}
+# Nodi di servizio, ricostruiti dal bot: non vanno nel backup
+SKIPPED_NODES = {CHANGES_NODE, CHANGES_HEAD, APPLIED_NODE, "leases", "replicas"}
+# Nodi coperti dal registro modifiche: negli incrementali se ne salvano solo i record toccati
+LOGGED_NODES = ("group_users", "stats")
+
+
+def _records(backend, node: str) -> Iterator[Tuple[str, Any]]:
+    """Record (percorso, valore) di un nodo, letti a pagine di BACKUP_PAGE_SIZE figli."""
+    depth = NODE_DEPTH.get(node, 0)
+    if depth == 0:
+        value = backend.load_path(node)
+        if value is not None:
+            yield node, value
+        return
+    parents = [node] if depth == 1 else [f"{node}/{key}" for key in backend.list_keys(node)]
+    for parent in parents:
+        after = None
+        while True:
+            page = backend.load_page(parent, after, BACKUP_PAGE_SIZE)
+            for key, value in page.items():
+                yield f"{parent}/{key}", value
+                after = key
+            if len(page) < BACKUP_PAGE_SIZE:
+                break
+
+
+def _changed_records(backend, since: str) -> Tuple[Dict[str, Set[str]], Set[str]]:
+    """
+    Record di 'group_users' e 'stats' modificati da since, per nodo, e nodi riscritti
+    per intero (da salvare completi).
+    """
+    changes = backend.load_changes_since(since)
+    if changes is None:
+        raise RuntimeError("registro modifiche non leggibile")
+    paths: Dict[str, Set[str]] = {node: set() for node in LOGGED_NODES}
+    full: Set[str] = set()
+    for entry in changes.values():
+        node = entry.get("nodo") if isinstance(entry, dict) else None
+        if node not in paths:
+            continue
+        if entry.get("completo"):
+            full.add(node)
+            continue
+        depth = NODE_DEPTH[node]
+        for path in entry.get("percorsi") or []:
+            parts = str(path).strip("/").split("/")
+            if len(parts) >= depth:
+                paths[node].add("/".join([node, *parts[:depth]]))
+    return paths, full
+
+
+def _load_manifest(directory: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _save_manifest(directory: str, manifest: dict) -> None:
+    path = os.path.join(directory, MANIFEST)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def run_backup(incremental: bool = False, directory: str = BACKUP_DIR) -> str:
+    """
+    Esegue un backup completo, o incrementale se richiesto e possibile (c'è un
+    backup precedente e il registro modifiche copre ancora il periodo trascorso).
+    Restituisce il percorso del file scritto.
+    """
+    backend = storage.backend
+    os.makedirs(directory, exist_ok=True)
+    manifest = _load_manifest(directory)
+    started = time.time()
+    version = change_stamp(started - SNAPSHOT_CLOCK_MARGIN)
+
+    changed: Dict[str, Set[str]] = {}
+    full: Set[str] = set()
+    if incremental:
+        if manifest is None:
+            logger.info("Nessun backup precedente: eseguo un backup completo.")
+            incremental = False
+        elif started - manifest["eseguito"] > SNAPSHOT_MAX_AGE - SNAPSHOT_CLOCK_MARGIN:
+            # Il registro modifiche più vecchio di SNAPSHOT_MAX_AGE viene ripulito dallo snapshot
+            logger.info("Ultimo backup troppo vecchio per il registro modifiche: eseguo un backup completo.")
+            incremental = False
+        else:
+            changed, full = _changed_records(backend, manifest["versione"])
+
+    kind = "incrementale" if incremental else "completo"
+    nodes = [node for node in backend.list_keys("") if node not in SKIPPED_NODES]
+    # Nodi salvati interi: al ripristino vengono svuotati prima di riscriverli
+    replaced = [node for node in nodes if not incremental or node not in LOGGED_NODES or node in full]
+    name = f"backup-{version}-{kind}.ndjson.lz4"
+    path = os.path.join(directory, name)
+
+    count = 0
+    with lz4.frame.open(f"{path}.tmp", "wt", encoding="utf-8") as f:
+        f.write(_dumps({"formato": BACKUP_FORMAT, "tipo": kind, "versione": version, "sostituiti": replaced}) + "\n")
+        for node in nodes:
+            if node in replaced:
+                records = _records(backend, node)
+            else:
+                # I record eliminati nel frattempo vengono salvati come null, cioè da cancellare
+                records = ((record, backend.load_path(record)) for record in sorted(changed[node]))
+            for record, value in records:
+                f.write(_dumps({"p": record, "v": value}) + "\n")
+                count += 1
+    os.replace(f"{path}.tmp", path)
+
+    chain = (manifest or {}).get("catena", []) if incremental else []
+    _save_manifest(directory, {"catena": chain + [name], "versione": version, "eseguito": started})
+    logger.info(f"Backup {kind} salvato in {path}: {count} record in {time.time() - started:.1f}s.")
+    return path
+
+
+def _read(path: str) -> Iterator[dict]:
+    with lz4.frame.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def restore_file(path: str) -> int:
+    """
+    Ripristina un file di backup: svuota i nodi salvati interi, poi scrive i record
+    a blocchi di BACKUP_RESTORE_BATCH percorsi. Restituisce il numero di record scritti.
+    """
+    backend = storage.backend
+    lines = _read(path)
+    header = next(lines, None)
+    if not header or header.get("formato") != BACKUP_FORMAT:
+        raise ValueError(f"{path} non è un backup valido (formato {header and header.get('formato')}).")
+    if header["sostituiti"]:
+        backend.restore_batch({node: None for node in header["sostituiti"]})
+
+    count = 0
+    batch: Dict[str, Any] = {}
+    for line in lines:
+        batch[line["p"]] = line["v"]
+        if len(batch) >= BACKUP_RESTORE_BATCH:
+            backend.restore_batch(batch)
+            count += len(batch)
+            batch = {}
+    if batch:
+        backend.restore_batch(batch)
+        count += len(batch)
+    logger.info(f"Ripristinato {path} ({header['tipo']}, versione {header['versione']}): {count} record.")
+    return count
+
+
+def run_restore(files: Optional[List[str]] = None, directory: str = BACKUP_DIR) -> int:
+    """Ripristina i file indicati o, senza file, la catena del manifest (ultimo completo e incrementali)."""
+    if not files:
+        manifest = _load_manifest(directory)
+        if manifest is None:
+            raise FileNotFoundError(f"Nessun {MANIFEST} in {directory}.")
+        files = [os.path.join(directory, name) for name in manifest["catena"]]
+    return sum(restore_file(path) for path in files)
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Backup e ripristino a flusso del database del bot.")
+    parser.add_argument("--incrementale", action="store_true", help="salva solo le modifiche dall'ultimo backup")
+    parser.add_argument("--ripristina", nargs="*", metavar="FILE", help="ripristina i file indicati (o la catena del manifest)")
+    parser.add_argument("--dir", default=BACKUP_DIR, help="cartella dei backup")
+    return parser.parse_args(argv)
+
+
+def main_cli(argv: List[str]) -> None:
+    args = parse_args(argv)
+    storage.initialize()
+    if args.ripristina is not None:
+        run_restore(args.ripristina, args.dir)
+    else:
+        run_backup(args.incrementale, args.dir)
+
+
+if __name__ == "__main__":
+    main_cli(sys.argv[1:])
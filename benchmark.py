@@ -0,0 +1,555 @@
+"""
+Benchmark degli handler su gruppi sintetici.
+
+Genera gruppi di N utenti con storico realistico, esegue gli handler veri
+(traccia_utente, feedback, button, apply_feedback_stats, send_paginated_message)
+con un Bot finto che non contatta Telegram e uno storage in memoria, e riporta
+per ogni handler latenza p50/p95/p99, memoria allocata e chiamate allo storage
+e alle API per update. I risultati vengono salvati in JSON per confrontarli
+tra un commit e l'altro.
+
+Uso:
+    python benchmark.py --sizes 1000 10000 100000 --iterations 500 --output benchmark.json
+"""
+import os
+import sys
+import copy
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import datetime
+import itertools
+import platform
+import subprocess
+import tracemalloc
+from collections import Counter
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+# Valori fittizi per le variabili lette all'import dei moduli del bot
+BENCH_ENV = {
+    "GRUPPO_SCAMBI": "-1001000000001",
+    "GRUPPO_FEEDBACK_DA_ACCETTARE": "-1001000000002",
+    "GRUPPO_FEEDBACK": "-1001000000003",
+    "GRUPPO_STAFF": "-1001000000004",
+    "TOKEN": "123456:BENCHMARK",
+}
+for _key, _value in BENCH_ENV.items():
+    os.environ.setdefault(_key, _value)
+
+from telegram import Bot, Update
+from telegram.ext import Application, CallbackContext
+
+import storage
+import main
+from admin_cache import admin_cache
+from pending_store import pending_store
+from write_behind import group_users_writer
+from user_index import build_username_index
+from leaderboard import build_leaderboards, get_leaderboards
+from stats import build_group_stats, apply_feedback_stats, reset_feedback_total
+from chart_cache import chart_cache
+from utils import send_paginated_message
+from records import users_from_json, stats_from_json
+
+CHAT_ID = main.GRUPPO_SCAMBI
+ADMIN_ID = 1
+FIRST_USER_ID = 100_000
+COLD_RATIO = 0.02
+PAGINATED_KEYS = ("verificati", "ricevuti", "inviati", "limitati")
+
+
+class MemoryBackend:
+    """
+    Backend di storage in memoria con le stesse funzioni di firebase_file.
+    Conta le chiamate per funzione; i valori scritti vengono copiati come
+    farebbe una serializzazione verso il database.
+    """
+
+    def __init__(self, group_users: Dict[int, Dict[int, dict]], stats: Dict[int, dict]):
+        self.group_users = group_users
+        self.stats = stats
+        self.group_stats: dict = {}
+        self.pending: Dict[str, dict] = {}
+        self.admin_ids = {ADMIN_ID}
+        self.calls: Counter = Counter()
+
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def load_admin_ids(self):
+        self.calls["load_admin_ids"] += 1
+        return set(self.admin_ids)
+
+    def save_admin_ids(self, admin_ids):
+        self.calls["save_admin_ids"] += 1
+        self.admin_ids = set(admin_ids)
+
+    def load_group_users(self):
+        self.calls["load_group_users"] += 1
+        return {chat_id: dict(users) for chat_id, users in self.group_users.items()}
+
+    def save_group_users(self, group_users):
+        self.calls["save_group_users"] += 1
+        self.group_users = copy.deepcopy(group_users)
+
+    def _apply_users(self, updates):
+        for path, value in updates.items():
+            chat_id, user_id = (int(part) for part in path.split("/")[:2])
+            self.group_users.setdefault(chat_id, {})[user_id] = copy.deepcopy(value)
+
+    def update_group_users(self, updates, marker=None):
+        self.calls["update_group_users"] += 1
+        self._apply_users(updates)
+        return True
+
+    def load_stats(self):
+        self.calls["load_stats"] += 1
+        return dict(self.stats)
+
+    def save_stats(self, stats):
+        self.calls["save_stats"] += 1
+        self.stats = copy.deepcopy(stats)
+
+    def _apply_stats(self, updates):
+        for path, value in updates.items():
+            self.stats[int(path.split("/")[0])] = copy.deepcopy(value)
+
+    def load_stats_entry(self, user_id):
+        self.calls["load_stats_entry"] += 1
+        return copy.deepcopy(self.stats.get(int(user_id)))
+
+    def load_changes_since(self, version):
+        self.calls["load_changes_since"] += 1
+        return {}
+
+    def prune_changes(self, before):
+        self.calls["prune_changes"] += 1
+        return True
+
+    def load_group_stats(self):
+        self.calls["load_group_stats"] += 1
+        return copy.deepcopy(self.group_stats)
+
+    def save_group_stats(self, group_stats):
+        self.calls["save_group_stats"] += 1
+        self.group_stats = copy.deepcopy(group_stats)
+
+    def _apply_group_stats(self, updates):
+        for path, value in updates.items():
+            parts = path.split("/")
+            target = self.group_stats
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            target[parts[-1]] = copy.deepcopy(value)
+
+    def commit_accepted_feedback(self, request_id, marker, users, stats, group_stats):
+        self.calls["commit_accepted_feedback"] += 1
+        self._apply_users(users)
+        self._apply_stats(stats)
+        self._apply_group_stats(group_stats)
+        self.pending.pop(str(request_id), None)
+        return True
+
+    def load_pending_feedback(self):
+        self.calls["load_pending_feedback"] += 1
+        return copy.deepcopy(self.pending)
+
+    def set_pending_feedback_entry(self, request_id, data):
+        self.calls["set_pending_feedback_entry"] += 1
+        self.pending[str(request_id)] = copy.deepcopy(data)
+        return True
+
+    def update_pending_feedback_entry(self, request_id, fields):
+        self.calls["update_pending_feedback_entry"] += 1
+        self.pending.setdefault(str(request_id), {}).update(copy.deepcopy(fields))
+        return True
+
+    def delete_pending_feedback_entry(self, request_id):
+        self.calls["delete_pending_feedback_entry"] += 1
+        self.pending.pop(str(request_id), None)
+        return True
+
+    def load_user_data(self, chat_id, user_id):
+        self.calls["load_user_data"] += 1
+        return copy.deepcopy(self.group_users.get(int(chat_id), {}).get(int(user_id)))
+
+
+class FakeBot(Bot):
+    """Bot che non contatta Telegram: risponde localmente a ogni metodo e conta le chiamate API."""
+
+    def __init__(self, token: str):
+        super().__init__(token)
+        with self._unfrozen():
+            self.api_calls: Counter = Counter()
+            self._message_ids = itertools.count(1_000_000)
+
+    def total_calls(self) -> int:
+        return sum(self.api_calls.values())
+
+    async def _do_post(self, endpoint: str, data: dict, **kwargs):
+        self.api_calls[endpoint] += 1
+        if endpoint == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+        if endpoint.startswith(("answer", "set", "delete")):
+            return True
+        chat_id = int(data.get("chat_id", CHAT_ID))
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup"},
+        }
+
+
+def _split_cards(total: int, rng: random.Random) -> List[int]:
+    cards = [0] * 7
+    sampled = min(total, 50)
+    for _ in range(sampled):
+        cards[rng.randrange(7)] += 1
+    cards[0] += total - sampled
+    return cards
+
+
+def generate_group(size: int, rng: random.Random) -> Tuple[Dict[int, dict], Dict[int, dict]]:
+    """
+    Genera (utenti, stats) per un gruppo di size utenti.
+    I contatori seguono una distribuzione a coda lunga (pochi utenti molto
+    attivi, molti con pochi feedback) e lo storico copre fino a 90 giorni.
+    """
+    today = datetime.date.today()
+    users: Dict[int, dict] = {}
+    stats: Dict[int, dict] = {}
+    for i in range(size):
+        user_id = FIRST_USER_ID + i
+        username = f"utente_{i}"
+        fatti = min(int(rng.paretovariate(1.1)) - 1, 5000)
+        ricevuti = min(int(rng.paretovariate(1.1)) - 1, 5000)
+        users[user_id] = {
+            "id": user_id,
+            "username": username,
+            "verified": ricevuti >= 25,
+            "limited": rng.random() < 0.02,
+            "feedback_fatti": fatti,
+            "feedback_ricevuti": ricevuti,
+            "cards_donate": _split_cards(ricevuti, rng),
+            "cards_ricevute": _split_cards(fatti, rng),
+        }
+        if not fatti and not ricevuti:
+            continue
+        days = min(90, 1 + (fatti + ricevuti) // 2)
+        history = {
+            (today - datetime.timedelta(days=offset)).isoformat(): {
+                "feedback_fatti": rng.randint(0, 3),
+                "feedback_ricevuti": rng.randint(0, 3),
+            }
+            for offset in rng.sample(range(1, 365), days)
+        }
+        stats[user_id] = {
+            "username": username,
+            "feedback_fatti": {"count": fatti, "daily_count": 0, "daily_date": None, "last": None},
+            "feedback_ricevuti": {"count": ricevuti, "daily_count": 0, "daily_date": None, "last": None},
+            "history": history,
+        }
+    return users, stats
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class HandlerResult:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.storage_calls = 0
+        self.api_calls = 0
+        self.alloc_peak: List[int] = []
+        self.alloc_net: List[int] = []
+
+    def summary(self) -> dict:
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        return {
+            "updates": count,
+            "p50_ms": round(_percentile(latencies, 50) * 1000, 4),
+            "p95_ms": round(_percentile(latencies, 95) * 1000, 4),
+            "p99_ms": round(_percentile(latencies, 99) * 1000, 4),
+            "mean_ms": round(sum(latencies) / count * 1000, 4) if count else 0.0,
+            "max_ms": round(latencies[-1] * 1000, 4) if count else 0.0,
+            "alloc_peak_kb": round(sum(self.alloc_peak) / len(self.alloc_peak) / 1024, 2) if self.alloc_peak else None,
+            "alloc_net_kb": round(sum(self.alloc_net) / len(self.alloc_net) / 1024, 2) if self.alloc_net else None,
+            "storage_calls_per_update": round(self.storage_calls / count, 3) if count else 0.0,
+            "api_calls_per_update": round(self.api_calls / count, 3) if count else 0.0,
+        }
+
+
+class Scenario:
+    """Un gruppo sintetico con la sua Application, su cui vengono eseguiti gli handler."""
+
+    def __init__(self, size: int, seed: int):
+        self.size = size
+        self.rng = random.Random(seed)
+        self.results: Dict[str, HandlerResult] = {}
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._new_user_ids = itertools.count(FIRST_USER_ID + size)
+        self._renames = itertools.count(1)
+        self.tracing = False
+
+    async def setup(self) -> float:
+        started = time.perf_counter()
+        users, stats = generate_group(self.size, self.rng)
+        self.known_ids = list(users)
+        # Una piccola parte degli utenti è solo nello storage, per esercitare il cache miss
+        self.cold_ids = self.rng.sample(self.known_ids, int(self.size * COLD_RATIO))
+        cold = set(self.cold_ids)
+        self.known_ids = [uid for uid in self.known_ids if uid not in cold]
+
+        self.backend = MemoryBackend({CHAT_ID: dict(users)}, dict(stats))
+        storage.backend = self.backend
+
+        self.bot = FakeBot(os.environ["TOKEN"])
+        self.app = Application.builder().bot(self.bot).updater(None).build()
+        await self.app.initialize()
+        main.application = self.app
+
+        # In memoria i dati vivono come record compatti, come dopo un caricamento dallo storage
+        group_users = users_from_json({CHAT_ID: {uid: data for uid, data in users.items() if uid not in cold}})
+        stats = stats_from_json(stats)
+        bot_data = self.app.bot_data
+        bot_data["group_users"] = group_users
+        bot_data["username_index"] = build_username_index(group_users)
+        bot_data["leaderboards"] = build_leaderboards(group_users)
+        bot_data["stats"] = stats
+        bot_data["group_stats"] = build_group_stats(stats)
+        reset_feedback_total()
+        chart_cache.clear()
+        await admin_cache.reload()
+        await pending_store.load()
+        return time.perf_counter() - started
+
+    async def teardown(self) -> None:
+        await self._drain()
+        await self.app.shutdown()
+
+    # --- costruzione degli update -------------------------------------------------
+
+    def _user(self, user_id: int) -> dict:
+        data = self.app.bot_data["group_users"][CHAT_ID].get(user_id)
+        username = data["username"] if data else f"nuovo_{user_id}"
+        return {"id": user_id, "is_bot": False, "first_name": username, "username": username}
+
+    def _message_update(self, user: dict, **fields) -> Update:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": CHAT_ID, "type": "supergroup"},
+            "from": user,
+            **fields,
+        }
+        return Update.de_json({"update_id": next(self._update_ids), "message": message}, self.bot)
+
+    def _callback_update(self, user: dict, data: str) -> Update:
+        query = {
+            "id": str(next(self._update_ids)),
+            "from": user,
+            "chat_instance": "benchmark",
+            "data": data,
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": CHAT_ID, "type": "supergroup"},
+                "caption": "feedback",
+            },
+        }
+        return Update.de_json({"update_id": next(self._update_ids), "callback_query": query}, self.bot)
+
+    # --- misura ----------------------------------------------------------------
+
+    async def _drain(self) -> None:
+        """Attende le scritture in background, così vengono attribuite all'update che le ha generate."""
+        await pending_store.flush()
+        await group_users_writer.flush()
+
+    async def _measure(self, name: str, call: Callable[[], Awaitable]) -> None:
+        result = self.results.setdefault(name, HandlerResult())
+        storage_before = self.backend.total_calls()
+        api_before = self.bot.total_calls()
+        if self.tracing:
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+
+        started = time.perf_counter()
+        await call()
+        elapsed = time.perf_counter() - started
+
+        if self.tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            result.alloc_peak.append(peak - memory_before)
+            result.alloc_net.append(current - memory_before)
+            await self._drain()
+            return
+
+        await self._drain()
+        result.latencies.append(elapsed)
+        result.storage_calls += self.backend.total_calls() - storage_before
+        result.api_calls += self.bot.total_calls() - api_before
+
+    def _context(self, update: Update, args: Optional[List[str]] = None) -> CallbackContext:
+        context = CallbackContext.from_update(update, self.app)
+        context.args = args
+        return context
+
+    async def _handler(self, name: str, handler, update: Update, args: Optional[List[str]] = None) -> None:
+        context = self._context(update, args)
+        await self._measure(name, lambda: handler(update, context))
+
+    # --- scenari ---------------------------------------------------------------
+
+    async def traccia_utente(self) -> None:
+        roll = self.rng.random()
+        if roll < 0.90:
+            user = self._user(self.rng.choice(self.known_ids))
+        elif roll < 0.95:
+            user = self._user(self.rng.choice(self.known_ids))
+            user["username"] = f"{user['username'].split('_r')[0]}_r{next(self._renames)}"
+        elif roll < 0.98 and self.cold_ids:
+            user = self._user(self.cold_ids.pop())
+            user["username"] = f"utente_{user['id'] - FIRST_USER_ID}"
+        else:
+            user = self._user(next(self._new_user_ids))
+        update = self._message_update(user, text="ciao a tutti")
+        await self._handler("traccia_utente", main.traccia_utente, update)
+
+    async def feedback_flow(self) -> None:
+        sender_id, target_id = self.rng.sample(self.known_ids, 2)
+        sender = self._user(sender_id)
+        target = self._user(target_id)
+        update = self._message_update(
+            sender,
+            photo=[{"file_id": "foto", "file_unique_id": "foto", "width": 800, "height": 600}],
+            caption=f"@feedback @{target['username']} scambio perfetto",
+        )
+        request_id = update.message.message_id
+        await self._handler("feedback", main.feedback, update)
+
+        admin = {"id": ADMIN_ID, "is_bot": False, "first_name": "admin", "username": "admin"}
+        await self._handler("button:confirm", main.button, self._callback_update(sender, f"confirm_{request_id}"))
+        await self._handler("button:accept", main.button, self._callback_update(admin, f"accept_{request_id}"))
+        stars = self.rng.randint(0, 6)
+        await self._handler("button:star", main.button, self._callback_update(admin, f"star_{request_id}_{stars}"))
+
+    async def feedback_stats(self) -> None:
+        sender_id, target_id = self.rng.sample(self.known_ids, 2)
+        stats = self.app.bot_data["stats"]
+
+        async def call():
+            apply_feedback_stats(stats, sender_id, f"utente_{sender_id}", target_id, f"utente_{target_id}")
+
+        await self._measure("apply_feedback_stats", call)
+
+    async def paginated(self) -> None:
+        key = self.rng.choice(PAGINATED_KEYS)
+        board = get_leaderboards(self.app.bot_data, CHAT_ID)[key]
+        pages = max(1, -(-len(board) // 25))
+        page = self.rng.randrange(pages)
+        admin = {"id": ADMIN_ID, "is_bot": False, "first_name": "admin", "username": "admin"}
+        update = self._message_update(admin, text=f"/{key}")
+        context = self._context(update)
+        await self._measure(
+            "send_paginated_message",
+            lambda: send_paginated_message(update, context, board, key, f"Utenti {key}", current_page=page),
+        )
+
+    async def run(self, iterations: int) -> None:
+        for _ in range(iterations):
+            await self.traccia_utente()
+            await self.feedback_flow()
+            await self.feedback_stats()
+            await self.paginated()
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+        return result.stdout.strip()
+    except Exception:
+        return None
+
+
+async def run_benchmark(sizes: List[int], iterations: int, alloc_iterations: int, seed: int) -> dict:
+    pending_store.start()
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "git_revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "iterations": iterations,
+            "alloc_iterations": alloc_iterations,
+            "seed": seed,
+        },
+        "sizes": {},
+    }
+    for size in sizes:
+        scenario = Scenario(size, seed)
+        setup_seconds = await scenario.setup()
+        # Qualche giro a vuoto per riscaldare cache e pool di thread
+        await scenario.run(min(10, iterations))
+        scenario.results.clear()
+
+        await scenario.run(iterations)
+
+        # Memoria in un passaggio separato: tracemalloc falserebbe le latenze
+        scenario.tracing = True
+        tracemalloc.start()
+        await scenario.run(alloc_iterations)
+        tracemalloc.stop()
+
+        await scenario.teardown()
+        report["sizes"][str(size)] = {
+            "setup_s": round(setup_seconds, 3),
+            "handlers": {name: result.summary() for name, result in scenario.results.items()},
+        }
+        _print_size(size, report["sizes"][str(size)])
+    await pending_store.stop()
+    return report
+
+
+def _print_size(size: int, data: dict) -> None:
+    print(f"\n== {size} utenti (setup {data['setup_s']}s) ==")
+    print(f"{'handler':<24}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'alloc KB':>10}{'storage':>9}{'api':>7}")
+    for name, row in data["handlers"].items():
+        alloc = row["alloc_peak_kb"] if row["alloc_peak_kb"] is not None else "-"
+        print(
+            f"{name:<24}{row['p50_ms']:>10.3f}{row['p95_ms']:>10.3f}{row['p99_ms']:>10.3f}"
+            f"{alloc:>10}{row['storage_calls_per_update']:>9}{row['api_calls_per_update']:>7}"
+        )
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark degli handler del bot su gruppi sintetici.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="numero di utenti per gruppo")
+    parser.add_argument("--iterations", type=int, default=300, help="giri di misura delle latenze per gruppo")
+    parser.add_argument("--alloc-iterations", type=int, default=50, help="giri di misura della memoria per gruppo")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="benchmark.json", help="file JSON dei risultati")
+    return parser.parse_args(argv)
+
+
+def main_cli(argv: List[str]) -> None:
+    args = parse_args(argv)
+    # I log per singolo update falserebbero le misure
+    logging.disable(logging.INFO)
+    report = asyncio.run(run_benchmark(args.sizes, args.iterations, args.alloc_iterations, args.seed))
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nRisultati salvati in {args.output}")
+
+
+if __name__ == "__main__":
+    main_cli(sys.argv[1:])
@@ -0,0 +1,99 @@
+import os
+import logging
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+CHART_CACHE_MAX_BYTES = int(os.getenv("CHART_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+
+# Chiave usata per il grafico complessivo del gruppo (.statistiche)
+GROUP_CHART = "gruppo"
+
+CacheKey = Tuple[Hashable, int, int]
+
+
+class ChartCache:
+    """
+    Cache LRU in memoria dei PNG già generati, con limite in byte.
+    La chiave è (proprietario, giorni, versione): il proprietario è lo user_id
+    o GROUP_CHART, la versione viene incrementata ogni volta che le statistiche
+    del proprietario cambiano, così un grafico vecchio non viene mai servito.
+    """
+
+    def __init__(self, max_bytes: int = CHART_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[CacheKey, bytes]" = OrderedDict()
+        self._versions: Dict[Hashable, int] = {}
+        self._by_owner: Dict[Hashable, Set[CacheKey]] = {}
+
+    def version(self, owner: Hashable) -> int:
+        return self._versions.get(owner, 0)
+
+    def get(self, owner: Hashable, days: int) -> Optional[bytes]:
+        key = (owner, days, self.version(owner))
+        png = self._entries.get(key)
+        if png is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return png
+
+    def put(self, owner: Hashable, days: int, png: bytes, version: int) -> None:
+        """
+        Salva un PNG generato dai dati della versione indicata, letta prima del rendering:
+        se nel frattempo il proprietario è stato invalidato il grafico è già vecchio e non si salva.
+        """
+        size = len(png)
+        if size > self.max_bytes or version != self.version(owner):
+            return
+        key = (owner, days, version)
+        self._remove(key)
+        self._entries[key] = png
+        self._by_owner.setdefault(owner, set()).add(key)
+        self.bytes_used += size
+        while self.bytes_used > self.max_bytes:
+            old_key = next(iter(self._entries))
+            self._remove(old_key)
+            self.evictions += 1
+
+    def invalidate(self, owner: Hashable) -> None:
+        """Segna come obsoleti tutti i grafici di un proprietario."""
+        self._versions[owner] = self.version(owner) + 1
+        for key in list(self._by_owner.get(owner, ())):
+            self._remove(key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._by_owner.clear()
+        self._versions.clear()
+        self.bytes_used = 0
+
+    def _remove(self, key: CacheKey) -> None:
+        png = self._entries.pop(key, None)
+        if png is None:
+            return
+        self.bytes_used -= len(png)
+        owner_keys = self._by_owner.get(key[0])
+        if owner_keys is not None:
+            owner_keys.discard(key)
+            if not owner_keys:
+                del self._by_owner[key[0]]
+
+    def info(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes_used": self.bytes_used,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+chart_cache = ChartCache()
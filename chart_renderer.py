@@ -0,0 +1,141 @@
+import os
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", "1"))
+CHART_MAX_QUEUE = int(os.getenv("CHART_MAX_QUEUE", "8"))
+CHART_TIMEOUT = float(os.getenv("CHART_TIMEOUT", "20"))
+
+
+class ChartRenderError(Exception):
+    """Errore durante la generazione di un grafico (coda piena, timeout o errore nel worker)."""
+
+
+def _new_figure(figsize):
+    # API a oggetti: nessuno stato globale di pyplot, sicura con più render in parallelo
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _to_png(fig) -> bytes:
+    buf = BytesIO()
+    fig.savefig(buf, format="png")
+    return buf.getvalue()
+
+
+def render_trend_png(dates: List[str], feedback_fatti: List[int], feedback_ricevuti: List[int]) -> bytes:
+    """Grafico dell'andamento dei feedback di un singolo utente."""
+    fig = _new_figure((10, 6))
+    ax = fig.add_subplot()
+    ax.plot(dates, feedback_fatti, label="Feedback fatti", marker="o", linestyle="-")
+    ax.plot(dates, feedback_ricevuti, label="Feedback ricevuti", marker="o", linestyle="-")
+    ax.set_xlabel("Date")
+    ax.set_ylabel("Numero di feedback")
+    ax.set_title("Andamento dei feedback negli ultimi giorni")
+    ax.legend()
+    ax.grid(True)
+    ax.tick_params(axis="x", labelrotation=45)
+    fig.tight_layout()
+    return _to_png(fig)
+
+
+def render_totale_png(dates: List[str], totals: List[int]) -> bytes:
+    """Grafico dell'andamento giornaliero dei feedback totali del gruppo."""
+    fig = _new_figure((12, 7))
+    ax = fig.add_subplot()
+    ax.plot(dates, totals, label="Feedback totali nel gruppo", marker="o", linestyle="-", color="blue")
+    ax.set_xlabel("Date")
+    ax.set_ylabel("Numero di feedback")
+    ax.set_title("Andamento giornaliero dei feedback totali nel gruppo")
+    ax.legend()
+    ax.grid(True)
+    ax.tick_params(axis="x", labelrotation=45)
+    fig.tight_layout()
+    return _to_png(fig)
+
+
+class ChartRenderer:
+    """
+    Servizio di rendering dei grafici su un pool di processi limitato.
+    Il loop asyncio resta libero mentre matplotlib lavora; le richieste oltre
+    la profondità massima della coda vengono rifiutate subito.
+    """
+
+    def __init__(self, workers: int = CHART_WORKERS, max_queue: int = CHART_MAX_QUEUE, timeout: float = CHART_TIMEOUT):
+        self.workers = max(1, workers)
+        self.max_queue = max(1, max_queue)
+        self.timeout = timeout
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._in_flight = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # 'forkserver' evita di duplicare via fork i thread di Firebase e del loop e
+            # precarica il modulo dei grafici (con matplotlib) una volta sola. Ogni worker
+            # riesegue comunque main.py come '__mp_main__': a livello di modulo main.py
+            # fa solo import e definizioni, connessioni e thread partono in main()
+            ctx = multiprocessing.get_context("forkserver")
+            ctx.set_forkserver_preload([__name__])
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+        return self._executor
+
+    @property
+    def queue_depth(self) -> int:
+        return self._in_flight
+
+    async def render(self, func: Callable[..., bytes], *args) -> bytes:
+        """Esegue func(*args) in un processo del pool e restituisce i byte PNG."""
+        if self._in_flight >= self.max_queue:
+            raise ChartRenderError("Troppi grafici in coda, riprova tra poco.")
+
+        loop = asyncio.get_running_loop()
+        try:
+            job = self._get_executor().submit(func, *args)
+        except BrokenProcessPool as e:
+            self.shutdown()
+            raise ChartRenderError(f"Pool di rendering non disponibile: {e}") from e
+        # Lo slot resta occupato finché il worker non ha davvero finito, anche dopo un timeout
+        self._in_flight += 1
+        job.add_done_callback(lambda _: self._release(loop))
+        try:
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(job)), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            # Se è ancora in coda non partirà; se è già in esecuzione non si può interrompere
+            job.cancel()
+            raise ChartRenderError(f"Generazione del grafico oltre il limite di {self.timeout}s.")
+        except BrokenProcessPool as e:
+            # Un worker è morto: il pool verrà ricreato alla prossima richiesta
+            self.shutdown()
+            raise ChartRenderError(f"Pool di rendering non disponibile: {e}") from e
+        except Exception as e:
+            raise ChartRenderError(f"Errore nel processo di rendering: {e}") from e
+
+    def _release(self, loop: asyncio.AbstractEventLoop) -> None:
+        # Chiamata dal thread del pool quando il lavoro termina (o viene annullato)
+        try:
+            loop.call_soon_threadsafe(self._decrement)
+        except RuntimeError:
+            # Loop già chiuso (spegnimento): nessuno conta più gli slot
+            pass
+
+    def _decrement(self) -> None:
+        self._in_flight -= 1
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+chart_renderer = ChartRenderer()
@@ -5,8 +5,17 @@ from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
 from telegram.helpers import escape_markdown
 
-from firebase_file import save_group_users, load_group_users, load_stats
+import storage
 from utils import restricted
+from write_behind import mark_user_dirty
+from user_index import find_user_by_username, index_user, build_username_index
+from leaderboard import update_leaderboards, build_leaderboards
+from stats import reset_feedback_total, load_or_build_group_stats
+from chart_cache import chart_cache
+from records import UserRecord, user_counters, counter_deltas
+from live_sync import live_sync
+from snapshot import snapshot_manager
+from admin_cache import admin_cache
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -39,16 +48,7 @@ async def info_utente(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = int(GRUPPO_SCAMBI)
     users_in_chat = group_users.get(chat_id, {})
 
-    target_user = None
-    if identifier.lstrip("-").isdigit():
-        uid = int(identifier)
-        target_user = users_in_chat.get(uid)
-    else:
-        username = identifier.lstrip("@").lower()
-        for user in users_in_chat.values():
-            if user.get("username", "").lower() == username:
-                target_user = user
-                break
+    target_user = await find_target_user(identifier, users_in_chat, context, chat_id)
 
     if not target_user:
         await update.message.reply_text("Utente non trovato nel database.")
@@ -90,40 +90,26 @@ async def add_invio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     stars  = int(args[2]) if len(args) >= 3 and args[2].isdigit() else 0
 
     # Trova o crea target_user
-    uid = None
-    if identifier.lstrip("-").isdigit():
-        uid = int(identifier)
-        target_user = users_in_chat.get(uid)
-    else:
-        username = identifier.lstrip("@").lower()
-        target_user = next(
-            (u for u in users_in_chat.values() if u.get("username", "").lower() == username),
-            None
-        )
+    uid = int(identifier) if identifier.lstrip("-").isdigit() else None
+    target_user = await find_target_user(identifier, users_in_chat, context, chat_id)
 
     if not target_user:
         if not uid:
             await update.message.reply_text("Utente non trovato. Usa l'ID numerico per crearlo.")
             return
         real_username = await get_user_details(uid, context)
-        target_user = {
-            "id": uid,
-            "username": real_username,
-            "feedback_ricevuti": 0,
-            "feedback_fatti": 0,
-            "verified": False,
-            "limited": False,
-            "cards_donate": [0]*7,
-            "cards_ricevute": [0]*7
-        }
+        target_user = UserRecord(uid, real_username)
         users_in_chat[uid] = target_user
+        index_user(context.bot_data, chat_id, uid, real_username)
 
     # Aggiorna
+    before = user_counters(target_user)
     target_user["feedback_fatti"] = target_user.get("feedback_fatti", 0) + amount
     target_user.setdefault("cards_ricevute", [0]*7)
     target_user["cards_ricevute"][stars] += amount
 
-    save_group_users(group_users)
+    update_leaderboards(context.bot_data, chat_id, target_user)
+    mark_user_dirty(chat_id, target_user["id"], target_user, counter_deltas(before, user_counters(target_user)))
 
     nome = escape_markdown(target_user['username'], version=2)
     aggiunt = "Aggiunta" if amount==1 else "Aggiunte"
@@ -155,34 +141,19 @@ async def add_feed(update: Update, context: ContextTypes.DEFAULT_TYPE):
     amount = int(args[1]) if len(args) >= 2 and args[1].isdigit() else 1
     stars  = int(args[2]) if len(args) >= 3 and args[2].isdigit() else 0
 
-    uid = None
-    if identifier.lstrip("-").isdigit():
-        uid = int(identifier)
-        target_user = users_in_chat.get(uid)
-    else:
-        username = identifier.lstrip("@").lower()
-        target_user = next(
-            (u for u in users_in_chat.values() if u.get("username", "").lower() == username),
-            None
-        )
+    uid = int(identifier) if identifier.lstrip("-").isdigit() else None
+    target_user = await find_target_user(identifier, users_in_chat, context, chat_id)
 
     if not target_user:
         if not uid:
             await update.message.reply_text("Utente non trovato. Usa l'ID numerico per crearlo.")
             return
         real_username = await get_user_details(uid, context)
-        target_user = {
-            "id": uid,
-            "username": real_username,
-            "feedback_ricevuti": 0,
-            "feedback_fatti": 0,
-            "verified": False,
-            "limited": False,
-            "cards_donate": [0]*7,
-            "cards_ricevute": [0]*7
-        }
+        target_user = UserRecord(uid, real_username)
         users_in_chat[uid] = target_user
+        index_user(context.bot_data, chat_id, uid, real_username)
 
+    before = user_counters(target_user)
     target_user["feedback_ricevuti"] = target_user.get("feedback_ricevuti", 0) + amount
     target_user.setdefault("cards_donate", [0]*7)
     target_user["cards_donate"][stars] += amount
@@ -200,7 +171,8 @@ async def add_feed(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode=ParseMode.MARKDOWN_V2
         )
 
-    save_group_users(group_users)
+    update_leaderboards(context.bot_data, chat_id, target_user)
+    mark_user_dirty(chat_id, target_user["id"], target_user, counter_deltas(before, user_counters(target_user)))
 
     nome = escape_markdown(target_user['username'], version=2)
     aggiunt = "Aggiunta" if amount==1 else "Aggiunte"
@@ -233,25 +205,19 @@ async def rem_invio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     stars  = int(args[2]) if len(args) >= 3 and args[2].isdigit() else 0
 
     # Trova target_user
-    if identifier.lstrip("-").isdigit():
-        uid = int(identifier)
-        target_user = users_in_chat.get(uid)
-    else:
-        username = identifier.lstrip("@").lower()
-        target_user = next(
-            (u for u in users_in_chat.values() if u.get("username", "").lower() == username),
-            None
-        )
+    target_user = await find_target_user(identifier, users_in_chat, context, chat_id)
 
     if not target_user:
         await update.message.reply_text("Utente non trovato.")
         return
 
+    before = user_counters(target_user)
     target_user["feedback_fatti"] = max(0, target_user.get("feedback_fatti", 0) - amount)
     target_user.setdefault("cards_ricevute", [0]*7)
     target_user["cards_ricevute"][stars] = max(0, target_user["cards_ricevute"][stars] - amount)
 
-    save_group_users(group_users)
+    update_leaderboards(context.bot_data, chat_id, target_user)
+    mark_user_dirty(chat_id, target_user["id"], target_user, counter_deltas(before, user_counters(target_user)))
 
     nome = escape_markdown(target_user['username'], version=2)
     aggiunt = "Rimossa" if amount==1 else "Rimosse"
@@ -284,20 +250,13 @@ async def rem_feed(update: Update, context: ContextTypes.DEFAULT_TYPE):
     stars  = int(args[2]) if len(args) >= 3 and args[2].isdigit() else 0
 
     # Trova target_user
-    if identifier.lstrip("-").isdigit():
-        uid = int(identifier)
-        target_user = users_in_chat.get(uid)
-    else:
-        username = identifier.lstrip("@").lower()
-        target_user = next(
-            (u for u in users_in_chat.values() if u.get("username", "").lower() == username),
-            None
-        )
+    target_user = await find_target_user(identifier, users_in_chat, context, chat_id)
 
     if not target_user:
         await update.message.reply_text("Utente non trovato.")
         return
 
+    before = user_counters(target_user)
     current = target_user.get("feedback_ricevuti", 0)
     target_user["feedback_ricevuti"] = max(0, current - amount)
     target_user.setdefault("cards_donate", [0]*7)
@@ -312,7 +271,8 @@ async def rem_feed(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode=ParseMode.MARKDOWN_V2
         )
 
-    save_group_users(group_users)
+    update_leaderboards(context.bot_data, chat_id, target_user)
+    mark_user_dirty(chat_id, target_user["id"], target_user, counter_deltas(before, user_counters(target_user)))
 
     nome = escape_markdown(target_user['username'], version=2)
     aggiunt = "Rimossa" if amount==1 else "Rimosse"
@@ -326,15 +286,11 @@ async def rem_feed(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await check_limit_condition(update, context, target_user)
 
 
-async def find_target_user(identifier: str, users_in_chat: dict) -> dict | None:
+async def find_target_user(identifier: str, users_in_chat: dict, context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> dict | None:
     if identifier.lstrip("-").isdigit():
         return users_in_chat.get(int(identifier))
-    else:
-        username = identifier.lstrip("@").lower()
-        for user in users_in_chat.values():
-            if user.get("username", "").lower() == username:
-                return user
-    return None
+    # Ricerca per username tramite l'indice in memoria
+    return find_user_by_username(context.bot_data, chat_id, identifier)
 
 
 @restricted
@@ -347,7 +303,7 @@ async def verify_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("*🆘 Comando errato\\!*\n\nUsa: /verifica @username|id", parse_mode=ParseMode.MARKDOWN_V2)
         return
 
-    target_user = await find_target_user(context.args[0], users_in_chat)
+    target_user = await find_target_user(context.args[0], users_in_chat, context, chat_id)
     if not target_user:
         await update.message.reply_text("Utente non trovato.")
         return
@@ -357,7 +313,8 @@ async def verify_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     target_user["verified"] = True
-    save_group_users(group_users)
+    update_leaderboards(context.bot_data, chat_id, target_user)
+    mark_user_dirty(chat_id, target_user["id"], target_user)
     nome = escape_markdown(target_user['username'], version=2)
     await update.message.reply_text(f"_✅ L'utente @{nome} è stato verificato\\!_", parse_mode=ParseMode.MARKDOWN_V2)
 
@@ -372,7 +329,7 @@ async def unverify_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("*🆘 Comando errato\\!*\n\nUsa: /sverifica @username|id", parse_mode=ParseMode.MARKDOWN_V2)
         return
     
-    target_user = await find_target_user(context.args[0], users_in_chat)
+    target_user = await find_target_user(context.args[0], users_in_chat, context, chat_id)
     if not target_user:
         await update.message.reply_text("Utente non trovato.")
         return
@@ -382,7 +339,8 @@ async def unverify_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     target_user["verified"] = False
-    save_group_users(group_users)
+    update_leaderboards(context.bot_data, chat_id, target_user)
+    mark_user_dirty(chat_id, target_user["id"], target_user)
     nome = escape_markdown(target_user['username'], version=2)
     await update.message.reply_text(f"_❎ L'utente @{nome} è stato sverificato\\!_", parse_mode=ParseMode.MARKDOWN_V2)
 
@@ -397,7 +355,7 @@ async def limit_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("*🆘 Comando errato\\!*\n\nUsa: /limita @username|id", parse_mode=ParseMode.MARKDOWN_V2)
         return
 
-    target_user = await find_target_user(context.args[0], users_in_chat)
+    target_user = await find_target_user(context.args[0], users_in_chat, context, chat_id)
     if not target_user:
         await update.message.reply_text("Utente non trovato.")
         return
@@ -407,7 +365,8 @@ async def limit_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     target_user["limited"] = True
-    save_group_users(group_users)
+    update_leaderboards(context.bot_data, chat_id, target_user)
+    mark_user_dirty(chat_id, target_user["id"], target_user)
     nome = escape_markdown(target_user['username'], version=2)
     await update.message.reply_text(f"_❎ L'utente @{nome} è stato limitato_", parse_mode=ParseMode.MARKDOWN_V2)
 
@@ -422,7 +381,7 @@ async def unlimit_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("*🆘 Comando errato\\!*\n\nUsa: /unlimita @username|id", parse_mode=ParseMode.MARKDOWN_V2)
         return
 
-    target_user = await find_target_user(context.args[0], users_in_chat)
+    target_user = await find_target_user(context.args[0], users_in_chat, context, chat_id)
     if not target_user:
         await update.message.reply_text("Utente non trovato.")
         return
@@ -432,7 +391,8 @@ async def unlimit_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     target_user["limited"] = False
-    save_group_users(group_users)
+    update_leaderboards(context.bot_data, chat_id, target_user)
+    mark_user_dirty(chat_id, target_user["id"], target_user)
     nome = escape_markdown(target_user['username'], version=2)
     await update.message.reply_text(f"_✅ L'utente @{nome} è stato unlimitato_", parse_mode=ParseMode.MARKDOWN_V2)
 
@@ -474,18 +434,52 @@ async def show_commands(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 @restricted
 async def reload_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Ricarica i dati group_users e stats da Firebase nella memoria del bot.
+    Ricarica group_users e stats da Firebase. Con la sincronizzazione live attiva
+    applica alla memoria solo le differenze (sul posto, tramite live_sync);
+    altrimenti sostituisce i dati in memoria. Le modifiche fatte fuori dal bot
+    non passano dal registro modifiche, quindi lo snapshot locale viene eliminato
+    se i dati sono cambiati: al riavvio non le riporterebbe indietro.
     """
+    if live_sync.running:
+        try:
+            await admin_cache.reload()
+            result = await live_sync.resync()
+            if result["utenti_cambiati"] or result["stats_cambiate"]:
+                await snapshot_manager.discard()
+            logger.info(f"Ricaricamento completo con sincronizzazione live: {result}")
+            await update.message.reply_text(
+                "✅ *Dati ricaricati e confrontati con la memoria\\.*\n\n"
+                f"_👥 Utenti letti\\:_ {result['utenti']}\n"
+                f"_✏️ Utenti aggiornati\\:_ {result['utenti_cambiati']}\n"
+                f"_📊 Statistiche lette\\:_ {result['stats']}\n"
+                f"_✏️ Statistiche aggiornate\\:_ {result['stats_cambiate']}",
+                parse_mode=ParseMode.MARKDOWN_V2
+            )
+        except Exception as e:
+            logger.error(f"Errore durante il ricaricamento dei dati: {e}")
+            await update.message.reply_text(
+                f"*❌ Si è verificato un errore durante il ricaricamento dei dati\\:*\n`{e}`",
+                parse_mode=ParseMode.MARKDOWN_V2
+            )
+        return
+
     try:
         logger.info("Avvio ricaricamento dati da Firebase su richiesta...")
         
         # Ricarica i dati degli utenti e delle statistiche da Firebase
-        group_users = load_group_users()
-        stats = load_stats()
+        group_users = await storage.load_group_users()
+        stats = await storage.load_stats()
 
         # Aggiorna il contesto del bot (bot_data) con i dati freschi
         context.bot_data['group_users'] = group_users
+        context.bot_data['username_index'] = build_username_index(group_users)
+        context.bot_data['leaderboards'] = build_leaderboards(group_users)
         context.bot_data['stats'] = stats
+        context.bot_data['group_stats'] = await load_or_build_group_stats(stats)
+        reset_feedback_total()
+        chart_cache.clear()
+        # I dati in memoria sono stati sostituiti: lo snapshot vecchio non va più usato
+        await snapshot_manager.discard()
         
         logger.info("Dati ricaricati e aggiornati con successo in memoria.")
         await update.message.reply_text(
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from typing import Optional, Set
+
+import storage
+from stats import apply_feedback_stats, apply_group_stats_on_feedback
+from leaderboard import update_leaderboards
+from pending_store import pending_store
+from write_behind import user_write_paths
+from replicas import REPLICA_MODE
+
+logger = logging.getLogger(__name__)
+
+COMMIT_RETRIES = 3
+# Attesa massima (secondi) tra i tentativi del commit in background
+COMMIT_MAX_BACKOFF = 60
+
+# Commit ancora da confermare, tenuti qui finché il task non termina
+_background: Set[asyncio.Task] = set()
+
+
+async def accept_feedback(bot_data: dict, request_id: str, pending: dict, stars: int) -> bool:
+    """
+    Applica in memoria un feedback accettato e lo salva con un unico commit atomico
+    (contatori dei due utenti, loro stats, contatori del gruppo ed eliminazione del
+    feedback in sospeso). Il feedback deve essere già stato tolto con pending_store.claim.
+    Il commit porta un marcatore, così i tentativi ripetuti non lo applicano due volte.
+    Restituisce True se il destinatario è appena stato verificato.
+    """
+    origin_chat = pending["origin_chat_id"]
+    sender_id, target_id = pending["user_id"], pending["target_user_id"]
+    users = bot_data['group_users'][origin_chat]
+    sender, target = users[sender_id], users[target_id]
+
+    sender["feedback_fatti"] = sender.get("feedback_fatti", 0) + 1
+    target["feedback_ricevuti"] = target.get("feedback_ricevuti", 0) + 1
+    sender.setdefault("cards_ricevute", [0]*7)[stars] += 1
+    target.setdefault("cards_donate", [0]*7)[stars] += 1
+
+    newly_verified = target["feedback_ricevuti"] >= 25 and not target.get("verified")
+    if newly_verified:
+        target["verified"] = True
+
+    update_leaderboards(bot_data, origin_chat, sender)
+    update_leaderboards(bot_data, origin_chat, target)
+    # La memoria è già avanti rispetto allo storage: gli eventi dei listener su questi
+    # record vanno ignorati finché il commit non è arrivato
+    storage.note_local_writes("group_users", [f"{origin_chat}/{sender_id}", f"{origin_chat}/{target_id}"])
+    storage.note_local_writes("stats", [str(sender_id), str(target_id)])
+    storage.note_local_writes("group_stats")
+
+    stats = bot_data['stats']
+    stats_updates = apply_feedback_stats(
+        stats, sender_id, pending["sender_username"], target_id, pending["target_username"]
+    )
+    group_updates = apply_group_stats_on_feedback(
+        bot_data.setdefault('group_stats', {}), stats,
+        sender_id, pending["sender_username"], target_id, pending["target_username"]
+    )
+    sender_deltas = {"feedback_fatti": 1, f"cards_ricevute/{stars}": 1}
+    target_deltas = {"feedback_ricevuti": 1, f"cards_donate/{stars}": 1}
+    if REPLICA_MODE:
+        # Gli stessi utenti possono essere modificati da un'altra replica (gruppo scambi,
+        # comandi): i contatori vanno scritti come incrementi lato database
+        user_updates = user_write_paths(origin_chat, sender_id, sender, sender_deltas)
+        user_updates.update(user_write_paths(origin_chat, target_id, target, target_deltas))
+        today = next(path for path in group_updates if path.startswith("daily/"))
+        group_updates[today] = storage.increment(1)
+    else:
+        user_updates = {
+            f"{origin_chat}/{sender_id}": sender,
+            f"{origin_chat}/{target_id}": target,
+        }
+
+    # Le modifiche al feedback ancora in coda (es. l'id del messaggio nel gruppo staff)
+    # vanno scritte prima, altrimenti ricreerebbero la voce eliminata dal commit
+    await pending_store.flush()
+
+    # Marcatore legato alla richiesta, non al tentativo: qualunque commit dello
+    # stesso feedback trova il marcatore di quello già applicato
+    marker = storage.new_write_marker(f"feedback-{request_id}")
+    commit = (request_id, marker, user_updates, stats_updates, group_updates)
+    if await _commit(commit, COMMIT_RETRIES):
+        pending_store.settle(request_id)
+    else:
+        # Esito ancora incerto o commit sempre rifiutato: si continua in background
+        # con lo stesso marcatore, che impedisce di applicarlo due volte
+        logger.error(f"Commit del feedback {request_id} non confermato dopo {COMMIT_RETRIES} tentativi, continuo in background.")
+        task = asyncio.create_task(_commit(commit, None, applied=None))
+        task.add_done_callback(lambda done: done.cancelled() or pending_store.settle(request_id))
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+    return newly_verified
+
+
+async def _commit(commit: tuple, attempts: Optional[int], applied: Optional[bool] = False) -> bool:
+    """
+    Prova il commit fino ad attempts volte (None = finché non riesce); con applied=None
+    l'esito del tentativo precedente è incerto e il primo passo è rileggere il marcatore.
+    Un commit fallito può essere arrivato lo stesso (es. risposta persa), e con gli
+    incrementi ripeterlo conterebbe il feedback due volte: prima di ogni nuovo tentativo
+    si controlla il marcatore e, se non si riesce a leggerlo, si aspetta invece di riscrivere.
+    Restituisce True quando il commit risulta applicato.
+    """
+    request_id, marker = commit[0], commit[1]
+    attempt = 0
+    while attempts is None or attempt < attempts:
+        attempt += 1
+        if applied is False:
+            if await storage.commit_accepted_feedback(*commit):
+                return True
+        await asyncio.sleep(min(attempt, COMMIT_MAX_BACKOFF))
+        applied = await storage.is_write_applied(marker)
+        if applied:
+            logger.warning(f"Commit del feedback {request_id} risultato fallito ma già applicato.")
+            return True
+    return False
@@ -1,10 +1,13 @@
 import os
+import re
+import time
+import uuid
+import socket
 import logging
-from typing import Set, Dict, Optional
+from typing import Any, List, Set, Dict, Optional
 import firebase_admin
 from firebase_admin import credentials, db
 from dotenv import load_dotenv
-import json
 
 load_dotenv()
 
@@ -14,6 +17,25 @@ FIREBASE_DATABASE_URL = os.getenv("FIREBASE_DATABASE_URL")
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# Registro delle modifiche a 'group_users' e 'stats', usato per il riallineamento
+# incrementale dello snapshot locale. Le chiavi iniziano con il timestamp in ms
+# a 13 cifre, quindi l'ordine lessicografico coincide con quello temporale.
+CHANGES_NODE = "modifiche"
+# Chiave dell'ultima voce del registro, scritta nello stesso update: un listener su
+# questo solo valore sa quando leggere le voci nuove senza scaricare i nodi interi
+CHANGES_HEAD = "modifiche_ultima"
+
+# Marcatori delle scritture con incrementi, scritti nello stesso update atomico: dopo
+# un errore dicono se la scrittura è arrivata lo stesso, così non viene ripetuta
+# contando due volte. La chiave identifica la scrittura (es. 'feedback-{request_id}'),
+# il valore è la versione in cui è stata applicata: serve a ripulirli insieme al
+# registro modifiche.
+APPLIED_NODE = "scritture_applicate"
+
+# Identificativo di questo processo: finisce nelle voci del registro modifiche e
+# nei lease delle shard, così ogni replica riconosce le proprie scritture
+REPLICA_ID = os.getenv("REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
 # Initialize Firebase Admin SDK if not already initialized
 def initialize_firebase():
     if not firebase_admin._apps:
@@ -29,7 +51,37 @@ def initialize_firebase():
             except Exception as e:
                 logger.error(f"Errore inizializzazione Firebase: {e}")
 
-initialize_firebase()
+
+def reference(path: str):
+    """Riferimento a un nodo del database; l'SDK viene inizializzato al primo utilizzo."""
+    initialize_firebase()
+    return db.reference(path)
+
+
+def change_stamp(timestamp: Optional[float] = None) -> str:
+    """Versione ordinabile per il registro modifiche (ms a 13 cifre)."""
+    return f"{int((time.time() if timestamp is None else timestamp) * 1000):013d}"
+
+
+def _change_entry(node: str, paths: Optional[List[str]]) -> Dict[str, dict]:
+    """Voce del registro modifiche; paths=None indica una riscrittura completa del nodo."""
+    key = f"{change_stamp()}-{uuid.uuid4().hex[:8]}"
+    entry = {"nodo": node, "completo": True} if paths is None else {"nodo": node, "percorsi": paths}
+    entry["origine"] = REPLICA_ID
+    return {f"{CHANGES_NODE}/{key}": entry, CHANGES_HEAD: key}
+
+
+def new_write_marker(label: Optional[str] = None) -> str:
+    """
+    Marcatore per una scrittura da rendere idempotente: label, che deve identificare
+    la scrittura e non il singolo tentativo, oppure un identificativo casuale.
+    """
+    return label or uuid.uuid4().hex
+
+
+def increment(amount: int) -> dict:
+    """Incremento lato server (ServerValue.increment): sicuro anche con più processi che scrivono."""
+    return {".sv": {"increment": amount}}
 
 
 def load_admin_ids() -> Set[int]:
@@ -38,7 +90,7 @@ def load_admin_ids() -> Set[int]:
     """
     admins: Set[int] = set()
     try:
-        ref = db.reference('admin_ids')
+        ref = reference('admin_ids')
         data = ref.get() or {}
         admins = {int(uid) for uid in data.get('admin_ids', [])}
     except Exception as e:
@@ -49,15 +101,18 @@ def load_admin_ids() -> Set[int]:
     return admins
 
 
-def save_admin_ids(admin_ids: Set[int]) -> None:
+def save_admin_ids(admin_ids: Set[int]) -> bool:
     """
     Salva gli ID degli admin sul nodo 'admin_ids' di Firebase Realtime Database.
+    Restituisce False se la scrittura non è riuscita.
     """
     try:
-        ref = db.reference('admin_ids')
+        ref = reference('admin_ids')
         ref.set({'admin_ids': list(admin_ids)})
+        return True
     except Exception as e:
         logger.error(f"Errore save_admin_ids su Firebase: {e}")
+        return False
 
 
 def load_group_users() -> Dict[int, Dict[int, dict]]:
@@ -65,7 +120,7 @@ def load_group_users() -> Dict[int, Dict[int, dict]]:
     Carica i dati dei group users dal nodo 'group_users' di Firebase Realtime Database.
     """
     try:
-        ref = db.reference('group_users')
+        ref = reference('group_users')
         raw = ref.get() or {}
         result: Dict[int, Dict[int, dict]] = {}
         for chat_id_str, users_map in raw.items():
@@ -99,18 +154,41 @@ def save_group_users(group_users: Dict[int, Dict[int, dict]]) -> None:
             str(chat_id): {str(uid): info for uid, info in users.items()}
             for chat_id, users in group_users.items()
         }
-        ref = db.reference('group_users')
+        ref = reference('group_users')
         ref.set(payload)
+        reference('/').update(_change_entry('group_users', None))
     except Exception as e:
         logger.error(f"Errore save_group_users su Firebase: {e}")
 
 
+def update_group_users(updates: Dict[str, dict], marker: Optional[str] = None) -> bool:
+    """
+    Applica un aggiornamento multi-path sotto il nodo 'group_users'.
+    Le chiavi sono percorsi relativi nella forma '{chat_id}/{user_id}'.
+    La scrittura, la voce nel registro modifiche e l'eventuale marcatore
+    (vedi is_write_applied) avvengono in un unico update atomico.
+    Restituisce True se la scrittura è andata a buon fine.
+    """
+    if not updates:
+        return True
+    try:
+        payload = {f"group_users/{path}": data for path, data in updates.items()}
+        payload.update(_change_entry('group_users', list(updates)))
+        if marker:
+            payload[f"{APPLIED_NODE}/{marker}"] = change_stamp()
+        reference('/').update(payload)
+        return True
+    except Exception as e:
+        logger.error(f"Errore update_group_users su Firebase: {e}")
+        return False
+
+
 def load_stats() -> Dict[int, dict]:
     """
     Carica le statistiche dal nodo 'stats' di Firebase Realtime Database.
     """
     try:
-        ref = db.reference('stats')
+        ref = reference('stats')
         raw = ref.get() or {}
         return {int(uid): data for uid, data in raw.items()}
     except Exception as e:
@@ -124,17 +202,130 @@ def save_stats(stats: Dict[int, dict]) -> None:
     """
     try:
         payload = {str(uid): data for uid, data in stats.items()}
-        ref = db.reference('stats')
+        ref = reference('stats')
         ref.set(payload)
+        reference('/').update(_change_entry('stats', None))
     except Exception as e:
         logger.error(f"Errore save_stats su Firebase: {e}")
 
+def load_stats_entry(user_id: int) -> Optional[dict]:
+    """
+    Carica le statistiche di un singolo utente. Restituisce None se assenti o in caso di errore.
+    """
+    try:
+        return reference(f'stats/{user_id}').get()
+    except Exception as e:
+        logger.error(f"Errore load_stats_entry per l'utente {user_id}: {e}")
+        return None
+
+def load_changes_since(version: str) -> Optional[Dict[str, dict]]:
+    """
+    Carica le voci del registro modifiche con versione >= version.
+    Restituisce None in caso di errore, per distinguerlo da "nessuna modifica".
+    """
+    try:
+        return reference(CHANGES_NODE).order_by_key().start_at(version).get() or {}
+    except Exception as e:
+        logger.error(f"Errore load_changes_since da Firebase: {e}")
+        return None
+
+def prune_changes(before: str) -> bool:
+    """
+    Elimina dal registro modifiche (e dai marcatori delle scritture) le voci con
+    versione precedente a before. Restituisce True se l'operazione è andata a buon fine.
+    """
+    try:
+        ref = reference(CHANGES_NODE)
+        old = ref.order_by_key().end_at(before).get() or {}
+        if old:
+            ref.update({key: None for key in old})
+        # I marcatori scadono insieme al registro, in base alla versione salvata come valore
+        # (i marcatori del formato precedente, con valore True, hanno la versione nella chiave)
+        ref = reference(APPLIED_NODE)
+        markers = ref.get() or {}
+        old = [key for key, stamp in markers.items() if (stamp if isinstance(stamp, str) else key[:13]) < before]
+        if old:
+            ref.update({key: None for key in old})
+        return True
+    except Exception as e:
+        logger.error(f"Errore prune_changes su Firebase: {e}")
+        return False
+
+def load_group_stats() -> dict:
+    """
+    Carica i contatori aggregati del gruppo dal nodo 'group_stats' di Firebase.
+    """
+    try:
+        ref = reference('group_stats')
+        return ref.get() or {}
+    except Exception as e:
+        logger.error(f"Errore load_group_stats da Firebase: {e}")
+        return {}
+
+def save_group_stats(group_stats: dict) -> None:
+    """
+    Salva i contatori aggregati del gruppo sul nodo 'group_stats' di Firebase.
+    """
+    try:
+        ref = reference('group_stats')
+        ref.set(group_stats)
+    except Exception as e:
+        logger.error(f"Errore save_group_stats su Firebase: {e}")
+
+def commit_accepted_feedback(request_id: str, marker: str, users: Dict[str, dict], stats: Dict[str, dict],
+                             group_stats: Dict[str, object]) -> bool:
+    """
+    Salva un feedback accettato con un unico update multi-path sulla radice:
+    utenti coinvolti, loro statistiche, contatori del gruppo, eliminazione del
+    feedback in sospeso, voci del registro modifiche e marcatore del commit.
+    O si applica tutto o niente. Con più repliche i contatori sono incrementi,
+    quindi un commit va ripetuto solo se is_write_applied(marker) è False:
+    un errore (es. risposta persa) non esclude che l'update sia arrivato.
+    Restituisce True se la scrittura è andata a buon fine.
+    """
+    try:
+        payload: Dict[str, object] = {f"group_users/{path}": data for path, data in users.items()}
+        payload.update({f"stats/{path}": data for path, data in stats.items()})
+        payload.update({f"group_stats/{path}": value for path, value in group_stats.items()})
+        payload[f"pending_feedback/{request_id}"] = None
+        payload[f"{APPLIED_NODE}/{marker}"] = change_stamp()
+        if users:
+            payload.update(_change_entry('group_users', list(users)))
+        if stats:
+            payload.update(_change_entry('stats', list(stats)))
+        reference('/').update(payload)
+        return True
+    except Exception as e:
+        logger.error(f"Errore commit del feedback {request_id} su Firebase: {e}")
+        return False
+
+def is_write_applied(marker: str) -> Optional[bool]:
+    """
+    True se la scrittura con questo marcatore è stata applicata, False se non lo è,
+    None se non si riesce a saperlo (errore di lettura): in quel caso non va ripetuta.
+    """
+    try:
+        return reference(f"{APPLIED_NODE}/{marker}").get(shallow=True) is not None
+    except Exception as e:
+        logger.error(f"Errore is_write_applied per {marker}: {e}")
+        return None
+
+def load_pending_feedback_entry(request_id: str) -> Optional[dict]:
+    """
+    Carica una singola voce di feedback in sospeso. Restituisce None se assente o in caso di errore.
+    """
+    try:
+        return reference(f'pending_feedback/{request_id}').get()
+    except Exception as e:
+        logger.error(f"Errore load_pending_feedback_entry per {request_id}: {e}")
+        return None
+
 def load_pending_feedback() -> Dict[str, dict]:
     """
     Carica i dati dei feedback in sospeso dal nodo 'pending_feedback' di Firebase.
     """
     try:
-        ref = db.reference('pending_feedback')
+        ref = reference('pending_feedback')
         return ref.get() or {}
     except Exception as e:
         logger.error(f"Errore load_pending_feedback da Firebase: {e}")
@@ -145,20 +336,49 @@ def save_pending_feedback(pending_feedback: Dict[str, dict]) -> None:
     Salva i dati dei feedback in sospeso sul nodo 'pending_feedback' di Firebase.
     """
     try:
-        ref = db.reference('pending_feedback')
+        ref = reference('pending_feedback')
         ref.set(pending_feedback)
     except Exception as e:
         logger.error(f"Errore save_pending_feedback su Firebase: {e}")
 
-def delete_pending_feedback_entry(request_id: str) -> None:
+def set_pending_feedback_entry(request_id: str, data: dict) -> bool:
+    """
+    Salva una specifica voce di feedback in sospeso su Firebase.
+    Restituisce True se la scrittura è andata a buon fine.
+    """
+    try:
+        ref = reference(f'pending_feedback/{request_id}')
+        ref.set(data)
+        return True
+    except Exception as e:
+        logger.error(f"Errore set_pending_feedback_entry su Firebase: {e}")
+        return False
+
+def update_pending_feedback_entry(request_id: str, fields: dict) -> bool:
+    """
+    Aggiorna alcuni campi di una voce di feedback in sospeso su Firebase.
+    Restituisce True se la scrittura è andata a buon fine.
+    """
+    try:
+        ref = reference(f'pending_feedback/{request_id}')
+        ref.update(fields)
+        return True
+    except Exception as e:
+        logger.error(f"Errore update_pending_feedback_entry su Firebase: {e}")
+        return False
+
+def delete_pending_feedback_entry(request_id: str) -> bool:
     """
     Elimina una specifica voce di feedback in sospeso da Firebase.
+    Restituisce True se l'eliminazione è andata a buon fine.
     """
     try:
-        ref = db.reference(f'pending_feedback/{request_id}')
+        ref = reference(f'pending_feedback/{request_id}')
         ref.delete()
+        return True
     except Exception as e:
         logger.error(f"Errore delete_pending_feedback_entry su Firebase: {e}")
+        return False
 
 def load_user_data(chat_id: int, user_id: int) -> Optional[Dict]:
     """
@@ -166,21 +386,150 @@ def load_user_data(chat_id: int, user_id: int) -> Optional[Dict]:
     Restituisce i dati dell'utente se esiste, altrimenti None.
     """
     try:
-        ref = db.reference(f'group_users/{chat_id}/{user_id}')
+        ref = reference(f'group_users/{chat_id}/{user_id}')
         user_data = ref.get()
         return user_data
     except Exception as e:
         logger.error(f"Errore nel caricamento dei dati per l'utente {user_id} nella chat {chat_id}: {e}")
         return None
 
-def backup_to_json():
-    """Esegue il backup dell'intero database Firebase in un file JSON."""
+def load_leases() -> Dict[int, dict]:
+    """
+    Carica i lease delle shard dal nodo 'leases' ({shard: {owner, url, expires}}).
+    """
     try:
-        ref = db.reference('/')
-        data = ref.get()
-        with open('firebase_backup.json', 'w') as f:
-            json.dump(data, f, indent=4)
-        logger.info("Backup del database completato con successo.")
+        raw = reference('leases').get() or {}
+        if isinstance(raw, list):
+            raw = dict(enumerate(raw))
+        return {int(shard): lease for shard, lease in raw.items() if isinstance(lease, dict)}
     except Exception as e:
-        logger.error(f"Errore durante il backup del database: {e}")
+        logger.error(f"Errore load_leases da Firebase: {e}")
+        return {}
+
+def acquire_lease(shard: int, owner: str, url: str, ttl: float) -> Optional[dict]:
+    """
+    Prende o rinnova il lease di una shard con una transazione: riesce solo se il
+    lease è libero, scaduto o già di owner. Restituisce il lease risultante
+    (di owner se acquisito, altrimenti quello di chi lo detiene), None in caso di errore.
+    """
+    def take(current):
+        now = time.time()
+        if isinstance(current, dict) and current.get("owner") != owner and current.get("expires", 0) > now:
+            return current
+        return {"owner": owner, "url": url, "expires": now + ttl}
+
+    try:
+        return reference(f'leases/{shard}').transaction(take)
+    except Exception as e:
+        logger.error(f"Errore acquire_lease della shard {shard}: {e}")
+        return None
+
+def release_lease(shard: int, owner: str) -> bool:
+    """
+    Rilascia il lease di una shard, solo se appartiene ancora a owner.
+    Restituisce True se l'operazione è andata a buon fine.
+    """
+    def release(current):
+        if isinstance(current, dict) and current.get("owner") == owner:
+            return None
+        return current
+
+    try:
+        reference(f'leases/{shard}').transaction(release)
+        return True
+    except Exception as e:
+        logger.error(f"Errore release_lease della shard {shard}: {e}")
+        return False
+
+def _replica_key(owner: str) -> str:
+    # Le chiavi di Firebase non possono contenere . # $ [ ] /
+    return re.sub(r"[.#$\[\]/]", "_", owner)
+
+def touch_replica(owner: str, url: str, ttl: float) -> bool:
+    """
+    Registra (o rinnova) la presenza di una replica nel nodo 'replicas', valida per ttl secondi.
+    Restituisce True se la scrittura è andata a buon fine.
+    """
+    try:
+        reference(f'replicas/{_replica_key(owner)}').set({"owner": owner, "url": url, "expires": time.time() + ttl})
+        return True
+    except Exception as e:
+        logger.error(f"Errore touch_replica per {owner}: {e}")
+        return False
+
+def load_replicas() -> Dict[str, dict]:
+    """
+    Carica le repliche registrate ({owner: {url, expires}}), anche quelle scadute.
+    """
+    try:
+        raw = reference('replicas').get() or {}
+        return {
+            entry["owner"]: {"url": entry.get("url"), "expires": entry.get("expires", 0)}
+            for entry in raw.values() if isinstance(entry, dict) and "owner" in entry
+        }
+    except Exception as e:
+        logger.error(f"Errore load_replicas da Firebase: {e}")
+        return {}
+
+def remove_replica(owner: str) -> bool:
+    """
+    Cancella la registrazione di una replica (allo spegnimento).
+    Restituisce True se l'operazione è andata a buon fine.
+    """
+    try:
+        reference(f'replicas/{_replica_key(owner)}').delete()
+        return True
+    except Exception as e:
+        logger.error(f"Errore remove_replica per {owner}: {e}")
+        return False
+
+# Primitive per backup.py: a differenza delle altre funzioni propagano le eccezioni,
+# così un backup o un ripristino a metà non sembra mai riuscito.
+
+def list_keys(path: str) -> List[str]:
+    """Chiavi figlie di un nodo ('' per la radice) senza scaricarne il contenuto (lettura shallow)."""
+    data = reference(path or '/').get(shallow=True)
+    if isinstance(data, dict):
+        return [str(key) for key in data]
+    if isinstance(data, list):
+        return [str(i) for i, value in enumerate(data) if value is not None]
+    return []
+
+def load_page(path: str, start_after: Optional[str], limit: int) -> Dict[str, Any]:
+    """
+    Fino a limit figli di un nodo in ordine di chiave, a partire da quello dopo start_after.
+    """
+    query = reference(path).order_by_key()
+    if start_after is None:
+        page = query.limit_to_first(limit).get()
+    else:
+        # start_at è inclusivo: si chiede un figlio in più e si scarta il cursore
+        page = query.start_at(start_after).limit_to_first(limit + 1).get()
+    if isinstance(page, list):
+        page = {str(i): value for i, value in enumerate(page) if value is not None}
+    return {str(key): value for key, value in (page or {}).items() if str(key) != start_after}
+
+def load_path(path: str) -> Any:
+    """Valore di un singolo percorso (None se assente)."""
+    return reference(path).get()
+
+def restore_batch(updates: Dict[str, Any]) -> None:
+    """
+    Scrive un blocco di percorsi dalla radice con un unico update multi-path.
+    Per 'group_users' e 'stats' aggiunge la voce del registro modifiche, così lo
+    snapshot locale si riallinea al prossimo avvio.
+    """
+    payload = dict(updates)
+    logged: Dict[str, Optional[List[str]]] = {}
+    for path in updates:
+        node, _, rest = path.strip("/").partition("/")
+        if node not in ("group_users", "stats"):
+            continue
+        if not rest:
+            logged[node] = None
+        elif logged.get(node, []) is not None:
+            logged.setdefault(node, []).append(rest)
+    for node, paths in logged.items():
+        payload.update(_change_entry(node, paths))
+    reference('/').update(payload)
 
@@ -0,0 +1,252 @@
+import os
+import bisect
+import datetime
+from array import array
+from collections.abc import Mapping
+from typing import Iterator, List, Optional, Tuple
+
+# Storico dei feedback di un utente, in colonne ordinate per data.
+# I giorni più vecchi di HISTORY_DAYS vengono accorpati in settimane e le
+# settimane più vecchie di HISTORY_WEEKS in mesi, così la dimensione resta
+# limitata (al massimo HISTORY_DAYS giorni, poche decine di settimane e un
+# bucket per mese). Le settimane non scavalcano mai l'inizio di un mese, quindi
+# l'accorpamento in mesi è esatto.
+
+HISTORY_DAYS = int(os.getenv("HISTORY_DAYS", "90"))
+HISTORY_WEEKS = int(os.getenv("HISTORY_WEEKS", "26"))
+
+DAYS, WEEKS, MONTHS = "giorni", "settimane", "mesi"
+TIERS = (DAYS, WEEKS, MONTHS)
+
+
+def _ordinal(date) -> int:
+    if isinstance(date, int):
+        return date
+    if isinstance(date, datetime.date):
+        return date.toordinal()
+    return datetime.date.fromisoformat(str(date)).toordinal()
+
+
+def _iso(ordinal: int) -> str:
+    return datetime.date.fromordinal(ordinal).isoformat()
+
+
+def _month_start(ordinal: int) -> int:
+    return datetime.date.fromordinal(ordinal).replace(day=1).toordinal()
+
+
+def _week_start(ordinal: int) -> int:
+    """Lunedì della settimana, ma mai prima del primo giorno del mese."""
+    monday = ordinal - datetime.date.fromordinal(ordinal).weekday()
+    return max(monday, _month_start(ordinal))
+
+
+def _tier_for(day: int, today_ord: int) -> Tuple[str, int]:
+    """Livello ('days', 'weeks' o 'months') e inizio del periodo in cui va un giorno, data la sua età."""
+    if day >= today_ord - HISTORY_DAYS:
+        return "days", day
+    week = _week_start(day)
+    if week >= today_ord - HISTORY_WEEKS * 7:
+        return "weeks", week
+    return "months", _month_start(day)
+
+
+class _Column:
+    """Una serie ordinata: inizio del periodo (ordinale) e i due contatori."""
+
+    __slots__ = ("starts", "fatti", "ricevuti")
+
+    def __init__(self):
+        self.starts = array("I")
+        self.fatti = array("I")
+        self.ricevuti = array("I")
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def set(self, start: int, fatti: int, ricevuti: int) -> None:
+        i = bisect.bisect_left(self.starts, start)
+        if i < len(self.starts) and self.starts[i] == start:
+            self.fatti[i] = fatti
+            self.ricevuti[i] = ricevuti
+        else:
+            self.starts.insert(i, start)
+            self.fatti.insert(i, fatti)
+            self.ricevuti.insert(i, ricevuti)
+
+    def add(self, start: int, fatti: int, ricevuti: int) -> None:
+        i = bisect.bisect_left(self.starts, start)
+        if i < len(self.starts) and self.starts[i] == start:
+            self.fatti[i] += fatti
+            self.ricevuti[i] += ricevuti
+        else:
+            self.starts.insert(i, start)
+            self.fatti.insert(i, fatti)
+            self.ricevuti.insert(i, ricevuti)
+
+    def pop_before(self, cutoff: int) -> List[Tuple[int, int, int]]:
+        """Rimuove e restituisce le voci che iniziano prima di cutoff."""
+        n = bisect.bisect_left(self.starts, cutoff)
+        if not n:
+            return []
+        popped = list(zip(self.starts[:n], self.fatti[:n], self.ricevuti[:n]))
+        del self.starts[:n], self.fatti[:n], self.ricevuti[:n]
+        return popped
+
+    def slice(self, lo: int, hi: int) -> List[Tuple[int, int, int]]:
+        return list(zip(self.starts[lo:hi], self.fatti[lo:hi], self.ricevuti[lo:hi]))
+
+    def to_dict(self) -> dict:
+        return {"inizio": self.starts.tolist(), "fatti": self.fatti.tolist(), "ricevuti": self.ricevuti.tolist()}
+
+    @classmethod
+    def from_entries(cls, entries) -> "_Column":
+        """Costruisce la colonna in blocco (senza inserimenti uno a uno), sommando gli inizi ripetuti."""
+        merged: dict = {}
+        for start, fatti, ricevuti in entries:
+            previous = merged.get(start, (0, 0))
+            merged[start] = (previous[0] + fatti, previous[1] + ricevuti)
+        column = cls()
+        ordered = sorted(merged.items())
+        column.starts = array("I", [start for start, _ in ordered])
+        column.fatti = array("I", [counts[0] for _, counts in ordered])
+        column.ricevuti = array("I", [counts[1] for _, counts in ordered])
+        return column
+
+    @classmethod
+    def from_dict(cls, data) -> "_Column":
+        if not isinstance(data, Mapping):
+            return cls()
+        return cls.from_entries(
+            (int(start), max(0, int(fatti or 0)), max(0, int(ricevuti or 0)))
+            for start, fatti, ricevuti in zip(data.get("inizio") or [], data.get("fatti") or [], data.get("ricevuti") or [])
+        )
+
+
+# Livello vuoto condiviso: la maggior parte degli utenti non ha settimane né mesi,
+# quindi le colonne vengono allocate solo alla prima scrittura
+_EMPTY = _Column()
+
+
+class StatsHistory:
+    """
+    Storico giornaliero di un utente con accorpamento automatico in settimane e mesi.
+    Le letture degli ultimi N periodi o di un intervallo di date costano O(log n + N).
+    """
+
+    __slots__ = ("days", "weeks", "months")
+
+    def __init__(self):
+        self.days = _EMPTY
+        self.weeks = _EMPTY
+        self.months = _EMPTY
+
+    def _writable(self, name: str) -> _Column:
+        column = getattr(self, name)
+        if column is _EMPTY:
+            column = _Column()
+            setattr(self, name, column)
+        return column
+
+    def __len__(self) -> int:
+        return len(self.days) + len(self.weeks) + len(self.months)
+
+    def __getstate__(self):
+        # Nello snapshot i livelli vuoti diventano None, così al caricamento tornano a condividere _EMPTY
+        return tuple(None if column is _EMPTY else column for column in (self.days, self.weeks, self.months))
+
+    def __setstate__(self, state) -> None:
+        self.days, self.weeks, self.months = (_EMPTY if column is None else column for column in state)
+
+    def __contains__(self, date) -> bool:
+        """True se il giorno è presente nello storico giornaliero."""
+        try:
+            start = _ordinal(date)
+        except (TypeError, ValueError):
+            return False
+        i = bisect.bisect_left(self.days.starts, start)
+        return i < len(self.days.starts) and self.days.starts[i] == start
+
+    def record(self, date, fatti: int, ricevuti: int, today: Optional[datetime.date] = None) -> None:
+        """Registra i contatori di un giorno concluso (sovrascrive se il giorno è già presente)."""
+        day = _ordinal(date)
+        fatti, ricevuti = max(0, int(fatti or 0)), max(0, int(ricevuti or 0))
+        name, start = _tier_for(day, (today or datetime.date.today()).toordinal())
+        if name == "days":
+            self._writable("days").set(start, fatti, ricevuti)
+        else:
+            # Un giorno arrivato in ritardo si somma al bucket già accorpato
+            self._writable(name).add(start, fatti, ricevuti)
+        self.compact(today)
+
+    def compact(self, today: Optional[datetime.date] = None) -> None:
+        """Accorpa i giorni oltre la finestra giornaliera in settimane e le settimane vecchie in mesi."""
+        today_ord = (today or datetime.date.today()).toordinal()
+        for day, fatti, ricevuti in self.days.pop_before(today_ord - HISTORY_DAYS):
+            self._writable("weeks").add(_week_start(day), fatti, ricevuti)
+        for week, fatti, ricevuti in self.weeks.pop_before(today_ord - HISTORY_WEEKS * 7):
+            self._writable("months").add(_month_start(week), fatti, ricevuti)
+
+    def last(self, n: int) -> List[Tuple[str, int, int]]:
+        """
+        Ultimi n giorni registrati, dal più vecchio: solo lo storico giornaliero,
+        mai le settimane o i mesi accorpati. Ogni voce è (data ISO, fatti, ricevuti).
+        """
+        days = self.days
+        return [(_iso(day), fatti, ricevuti) for day, fatti, ricevuti in days.slice(max(0, len(days) - n), len(days))]
+
+    def days_between(self, start, end) -> List[Tuple[str, int, int]]:
+        """Giorni registrati nell'intervallo [start, end] (date o stringhe ISO)."""
+        starts = self.days.starts
+        lo = bisect.bisect_left(starts, _ordinal(start))
+        hi = bisect.bisect_right(starts, _ordinal(end))
+        return [(_iso(day), fatti, ricevuti) for day, fatti, ricevuti in self.days.slice(lo, hi)]
+
+    def entries(self) -> Iterator[Tuple[str, int, int]]:
+        """Tutte le voci in ordine cronologico: mesi, poi settimane, poi giorni."""
+        for column in (self.months, self.weeks, self.days):
+            for start, fatti, ricevuti in column.slice(0, len(column)):
+                yield _iso(start), fatti, ricevuti
+
+    def to_dict(self) -> dict:
+        """Formato salvato: per ogni livello, colonne parallele di ordinali di inizio e contatori."""
+        data = {}
+        for name, column in zip(TIERS, (self.days, self.weeks, self.months)):
+            if len(column):
+                data[name] = column.to_dict()
+        return data
+
+    @classmethod
+    def from_value(cls, value) -> "StatsHistory":
+        """Accetta il formato a colonne oppure quello vecchio {data ISO: {feedback_fatti, feedback_ricevuti}}."""
+        if isinstance(value, cls):
+            return value
+        history = cls()
+        if not isinstance(value, Mapping):
+            return history
+        if any(name in value for name in TIERS):
+            for name, key in (("days", DAYS), ("weeks", WEEKS), ("months", MONTHS)):
+                if value.get(key):
+                    setattr(history, name, _Column.from_dict(value[key]))
+        else:
+            # Vecchio formato: ogni giorno va direttamente nel livello giusto per la sua età
+            today_ord = datetime.date.today().toordinal()
+            tiers = {"days": [], "weeks": [], "months": []}
+            for date, day in value.items():
+                if not isinstance(day, Mapping):
+                    continue
+                try:
+                    ordinal = _ordinal(date)
+                    counts = (max(0, int(day.get("feedback_fatti") or 0)), max(0, int(day.get("feedback_ricevuti") or 0)))
+                except (TypeError, ValueError):
+                    continue
+                name, start = _tier_for(ordinal, today_ord)
+                tiers[name].append((start, *counts))
+            for name, entries in tiers.items():
+                if entries:
+                    setattr(history, name, _Column.from_entries(entries))
+        history.compact()
+        return history
+
+    def __repr__(self) -> str:
+        return f"StatsHistory({len(self.days)} giorni, {len(self.weeks)} settimane, {len(self.months)} mesi)"
@@ -0,0 +1,256 @@
+import os
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+from telegram import Update
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:  # orjson è opzionale: senza, si usa il parser della libreria standard
+    import json
+    json_loads = json.loads
+
+logger = logging.getLogger(__name__)
+
+INGRESS_WORKERS = int(os.getenv("INGRESS_WORKERS", "8"))
+INGRESS_MAX_QUEUE = int(os.getenv("INGRESS_MAX_QUEUE", "1000"))
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", "4096"))
+
+
+def ordering_key(update: Update) -> Tuple[int, int]:
+    """
+    Chiave di ordinamento: (chat, utente). Gli update dello stesso utente nella
+    stessa chat restano in ordine, quelli di utenti diversi procedono in parallelo.
+    Senza chat né utente l'update fa chiave a sé.
+    """
+    chat_id = update.effective_chat.id if update.effective_chat else None
+    user_id = update.effective_user.id if update.effective_user else None
+    if chat_id is None and user_id is None:
+        return (0, update.update_id)
+    return (chat_id or 0, user_id or 0)
+
+
+# Chiavi dell'update che contengono un messaggio, nell'ordine usato da PTB per effective_message
+MESSAGE_KEYS = ("message", "edited_message", "channel_post", "edited_channel_post")
+
+
+def raw_ordering_key(data: dict) -> int:
+    """Come ordering_key, ma sul dict grezzo: serve a instradare l'update prima di deserializzarlo."""
+    for key in MESSAGE_KEYS:
+        message = data.get(key)
+        if isinstance(message, dict):
+            chat = message.get("chat") or {}
+            if "id" in chat:
+                return chat["id"]
+            sender = message.get("from") or {}
+            if "id" in sender:
+                return sender["id"]
+    query = data.get("callback_query")
+    if isinstance(query, dict):
+        chat = (query.get("message") or {}).get("chat") or {}
+        if "id" in chat:
+            return chat["id"]
+        sender = query.get("from") or {}
+        if "id" in sender:
+            return sender["id"]
+    return data.get("update_id", 0)
+
+
+class UpdatePrefilter:
+    """
+    Controllo economico sul dict grezzo dell'update, prima di Update.de_json.
+    Scarta gli update che nessun handler userebbe: tipi senza handler, chiacchiere
+    fuori dal gruppo scambi e messaggi di utenti già in cache con lo stesso
+    username (per i quali traccia_utente non farebbe nulla).
+    """
+
+    def __init__(self, group_chat_id: int, cached_username: Callable[[int, int], Optional[str]]):
+        self.group_chat_id = group_chat_id
+        self._cached_username = cached_username
+        self.passed = 0
+        self.filtered = 0
+
+    def is_relevant(self, data: dict) -> bool:
+        relevant = self._check(data)
+        if relevant:
+            self.passed += 1
+        else:
+            self.filtered += 1
+        return relevant
+
+    def _check(self, data: dict) -> bool:
+        if "callback_query" in data:
+            return True
+
+        message = None
+        for key in MESSAGE_KEYS:
+            message = data.get(key)
+            if message is not None:
+                break
+        if not isinstance(message, dict):
+            return False
+
+        text = message.get("text")
+        if text is not None:
+            # Comandi con '/' o '.': accettati da qualsiasi chat
+            if text.startswith(("/", ".")):
+                return True
+            return self._needs_tracking(message)
+
+        caption = message.get("caption")
+        if message.get("photo") and caption and caption.startswith("@feedback"):
+            return (message.get("chat") or {}).get("id") == self.group_chat_id
+        return False
+
+    def _needs_tracking(self, message: dict) -> bool:
+        """True se traccia_utente avrebbe qualcosa da fare: utente nuovo o username cambiato."""
+        if (message.get("chat") or {}).get("id") != self.group_chat_id:
+            return False
+        sender = message.get("from")
+        if not sender or "id" not in sender:
+            return False
+        username = sender.get("username") or f"user_{sender['id']}"
+        return self._cached_username(self.group_chat_id, sender["id"]) != username
+
+    def metrics(self) -> dict:
+        return {"passed": self.passed, "filtered": self.filtered}
+
+
+class UpdateDeduplicator:
+    """
+    Finestra degli ultimi update_id accettati (ring buffer + set).
+    Telegram riconsegna gli update quando la risposta tarda: le copie vengono
+    riconosciute in O(1) prima ancora di costruire l'oggetto Update.
+    """
+
+    def __init__(self, window: int = DEDUP_WINDOW):
+        self.window = max(1, window)
+        self._ring: deque = deque()
+        self._seen: set = set()
+        self.suppressed = 0
+
+    def is_duplicate(self, update_id: int) -> bool:
+        if update_id in self._seen:
+            self.suppressed += 1
+            return True
+        return False
+
+    def add(self, update_id: int) -> None:
+        """Registra un update come accettato, scartando il più vecchio se la finestra è piena."""
+        if update_id in self._seen:
+            return
+        if len(self._ring) >= self.window:
+            self._seen.discard(self._ring.popleft())
+        self._ring.append(update_id)
+        self._seen.add(update_id)
+
+    def metrics(self) -> dict:
+        return {"window": self.window, "tracked": len(self._ring), "suppressed": self.suppressed}
+
+
+class IngressQueue:
+    """
+    Coda limitata degli update in ingresso, servita da un pool fisso di worker.
+    La capienza è unica e condivisa: gli update attendono in una fila per
+    chiave (chat, utente) e ogni chiave è in mano a un solo worker alla volta,
+    quindi gli update di uno stesso utente vengono elaborati nell'ordine di
+    arrivo mentre utenti diversi, anche nello stesso gruppo, non si aspettano
+    a vicenda. Se la coda è piena, submit() restituisce False e il webhook
+    risponde con un errore, così Telegram ritenta più tardi.
+    """
+
+    def __init__(self, process: Callable[[Update], Awaitable], workers: int = INGRESS_WORKERS, max_size: int = INGRESS_MAX_QUEUE):
+        self._process = process
+        self.workers = max(1, workers)
+        self.max_size = max(self.workers, max_size)
+        # Update in attesa per chiave; una chiave è presente finché ha update da elaborare
+        self._pending: Dict[Hashable, Deque[Tuple[float, Update]]] = {}
+        # Chiavi pronte per un worker: ognuna compare al massimo una volta
+        self._ready: "asyncio.Queue[Hashable]" = asyncio.Queue()
+        self._size = 0
+        self._tasks: List[asyncio.Task] = []
+        self.accepted = 0
+        self.dropped = 0
+        self.processed = 0
+        self.errors = 0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+        self._total_wait = 0.0
+
+    def submit(self, update: Update, key: Optional[Hashable] = None) -> bool:
+        if self._size >= self.max_size:
+            self.dropped += 1
+            return False
+        if key is None:
+            key = ordering_key(update)
+        item = (asyncio.get_running_loop().time(), update)
+        waiting = self._pending.get(key)
+        if waiting is not None:
+            # La chiave è già in fila o in elaborazione: chi la tiene smaltirà anche questo
+            waiting.append(item)
+        else:
+            self._pending[key] = deque((item,))
+            self._ready.put_nowait(key)
+        self._size += 1
+        self.accepted += 1
+        return True
+
+    @property
+    def depth(self) -> int:
+        return self._size
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            key = await self._ready.get()
+            waiting = self._pending[key]
+            enqueued_at, update = waiting.popleft()
+            wait = loop.time() - enqueued_at
+            self.last_wait = wait
+            self.max_wait = max(self.max_wait, wait)
+            self._total_wait += wait
+            try:
+                await self._process(update)
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Errore nell'elaborazione dell'update {update.update_id}: {e}")
+            finally:
+                self.processed += 1
+                self._size -= 1
+                # Un update per turno: la chiave torna in fondo alla fila se ne ha altri
+                if waiting:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+                self._ready.task_done()
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            logger.info(f"Coda di ingresso avviata ({self.workers} worker, max {self.max_size} update).")
+
+    async def stop(self) -> None:
+        """Elabora gli update ancora in coda e ferma i worker."""
+        await self._ready.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def metrics(self) -> dict:
+        return {
+            "depth": self.depth,
+            "keys": len(self._pending),
+            "max_size": self.max_size,
+            "workers": self.workers,
+            "accepted": self.accepted,
+            "dropped": self.dropped,
+            "processed": self.processed,
+            "errors": self.errors,
+            "last_wait": round(self.last_wait, 4),
+            "max_wait": round(self.max_wait, 4),
+            "avg_wait": round(self._total_wait / self.processed, 4) if self.processed else 0.0,
+        }
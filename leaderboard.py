@@ -0,0 +1,155 @@
+import logging
+from bisect import bisect_left, insort
+from collections.abc import Mapping, Sequence
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _username_key(user_data: dict) -> str:
+    return (user_data.get("username") or "N/A").lower()
+
+
+def _divario(user_data: dict) -> int:
+    return user_data.get("feedback_ricevuti", 0) - user_data.get("feedback_fatti", 0)
+
+
+# Per ogni classifica: filtro di appartenenza e chiave di ordinamento (lo user_id rende la chiave univoca)
+BOARDS: Dict[str, tuple] = {
+    'verificati': (
+        lambda u: bool(u.get("verified")),
+        lambda uid, u: (u.get("feedback_ricevuti", 0), _username_key(u), uid),
+    ),
+    'ricevuti': (
+        lambda u: u.get("feedback_ricevuti", 0) > 0,
+        lambda uid, u: (-u.get("feedback_ricevuti", 0), _username_key(u), uid),
+    ),
+    'inviati': (
+        lambda u: u.get("feedback_fatti", 0) > 0,
+        lambda uid, u: (-u.get("feedback_fatti", 0), _username_key(u), uid),
+    ),
+    'limitati': (
+        lambda u: bool(u.get("limited")),
+        lambda uid, u: (_divario(u), _username_key(u), uid),
+    ),
+}
+
+
+class Leaderboard(Sequence):
+    """
+    Classifica ordinata mantenuta in modo incrementale.
+    Le chiavi sono tenute in una lista ordinata: pagina e posizione di un utente
+    si ottengono con bisect e slicing, senza riordinare né rileggere Firebase.
+    Gli elementi restituiti sono costruiti al volo dai dati utente correnti.
+    """
+
+    def __init__(self, users: Dict[int, dict], include: Callable[[dict], bool], sort_key: Callable[[int, dict], tuple]):
+        self._users = users
+        self._include = include
+        self._sort_key = sort_key
+        self._keys: List[tuple] = []
+        self._key_of: Dict[int, tuple] = {}
+        # Incrementata a ogni modifica: identifica lo "snapshot" mostrato in una pagina
+        self.version = 0
+
+    def update(self, user_id: int, user_data: dict) -> None:
+        """Riposiziona un utente dopo una modifica dei suoi contatori o flag."""
+        old_key = self._key_of.get(user_id)
+        new_key = self._sort_key(user_id, user_data) if self._include(user_data) else None
+        if old_key == new_key:
+            return
+        self.version += 1
+        if old_key is not None:
+            del self._keys[bisect_left(self._keys, old_key)]
+            del self._key_of[user_id]
+        if new_key is not None:
+            insort(self._keys, new_key)
+            self._key_of[user_id] = new_key
+
+    def remove(self, user_id: int) -> None:
+        old_key = self._key_of.pop(user_id, None)
+        if old_key is not None:
+            del self._keys[bisect_left(self._keys, old_key)]
+            self.version += 1
+
+    def rank(self, user_id: int) -> Optional[int]:
+        """Posizione (0-based) dell'utente nella classifica, None se non presente."""
+        key = self._key_of.get(user_id)
+        if key is None:
+            return None
+        return bisect_left(self._keys, key)
+
+    def _item(self, key: tuple) -> dict:
+        user_id = key[-1]
+        user_data = self._users.get(user_id, {})
+        return {
+            "id": user_id,
+            "username": user_data.get("username", "N/A"),
+            "feedback_ricevuti": user_data.get("feedback_ricevuti", 0),
+            "feedback_fatti": user_data.get("feedback_fatti", 0),
+            "divario": _divario(user_data),
+        }
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._item(key) for key in self._keys[index]]
+        return self._item(self._keys[index])
+
+
+class ChatLeaderboards:
+    """Le classifiche di una singola chat, aggiornate insieme."""
+
+    def __init__(self, users: Dict[int, dict]):
+        self.boards: Dict[str, Leaderboard] = {
+            name: Leaderboard(users, include, sort_key)
+            for name, (include, sort_key) in BOARDS.items()
+        }
+        for user_id, user_data in users.items():
+            if isinstance(user_data, Mapping):
+                self.update(user_id, user_data)
+
+    def update(self, user_id: int, user_data: dict) -> None:
+        for board in self.boards.values():
+            board.update(user_id, user_data)
+
+    def remove(self, user_id: int) -> None:
+        for board in self.boards.values():
+            board.remove(user_id)
+
+    def __getitem__(self, name: str) -> Leaderboard:
+        return self.boards[name]
+
+
+def build_leaderboards(group_users: Dict[int, Dict[int, dict]]) -> Dict[int, ChatLeaderboards]:
+    """
+    Costruisce le classifiche di tutte le chat a partire da group_users.
+    """
+    return {
+        chat_id: ChatLeaderboards(users)
+        for chat_id, users in group_users.items()
+        if isinstance(users, Mapping)
+    }
+
+
+def get_leaderboards(bot_data: dict, chat_id: int) -> ChatLeaderboards:
+    """
+    Restituisce le classifiche di una chat, costruendole al primo accesso.
+    """
+    leaderboards = bot_data.get('leaderboards')
+    if leaderboards is None:
+        leaderboards = build_leaderboards(bot_data.get('group_users', {}))
+        bot_data['leaderboards'] = leaderboards
+    if chat_id not in leaderboards:
+        users = bot_data.setdefault('group_users', {}).setdefault(chat_id, {})
+        leaderboards[chat_id] = ChatLeaderboards(users)
+    return leaderboards[chat_id]
+
+
+def update_leaderboards(bot_data: dict, chat_id: int, user_data: dict) -> None:
+    """
+    Aggiorna la posizione di un utente in tutte le classifiche della sua chat.
+    """
+    get_leaderboards(bot_data, chat_id).update(user_data["id"], user_data)
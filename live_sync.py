@@ -0,0 +1,484 @@
+import os
+import time
+import asyncio
+import logging
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+import storage
+from firebase_file import CHANGES_HEAD, REPLICA_ID, change_stamp, reference
+from records import UserRecord, StatsRecord, to_json
+from user_index import index_user
+from leaderboard import get_leaderboards, update_leaderboards
+from chart_cache import chart_cache, GROUP_CHART
+from stats import reset_feedback_total
+from write_behind import group_users_writer
+from pending_store import pending_store
+
+logger = logging.getLogger(__name__)
+
+# Sincronizzazione live (gli admin hanno già il proprio listener in admin_cache): un listener
+# sull'ultima chiave del registro modifiche fa rileggere solo i record di 'group_users' e
+# 'stats' nominati nelle voci nuove, uno su 'pending_feedback' (piccolo) ne riceve i dati
+LIVE_SYNC = os.getenv("LIVE_SYNC", "1") != "0"
+# Le voci del registro vengono rilette per questa finestra, per non perdere quelle
+# scritte da un processo con l'orologio un po' indietro
+LIVE_SYNC_MARGIN = float(os.getenv("LIVE_SYNC_MARGIN", "10"))
+# Attesa prima di ritentare una lettura del registro non riuscita
+LIVE_SYNC_RETRY = 5.0
+# Ogni quanti record applicati una riscrittura completa cede il loop agli handler
+LIVE_SYNC_YIELD_EVERY = 500
+
+# Profondità del record in ogni nodo: 2 = '{chat}/{user}', 1 = '{id}'
+NODES = {"group_users": 2, "stats": 1, "pending_feedback": 1}
+# Nodi seguiti tramite il registro modifiche; gli altri con un listener sul nodo
+LOGGED_NODES = ("group_users", "stats")
+
+
+def _set_path(target: dict, parts: List[str], value) -> None:
+    """Imposta value al percorso parts dentro target (None cancella), come un evento di Firebase."""
+    for part in parts[:-1]:
+        child = target.get(part)
+        if isinstance(child, list):
+            child = target[part] = {str(i): v for i, v in enumerate(child) if v is not None}
+        elif not isinstance(child, dict):
+            child = target[part] = {}
+        target = child
+    if value is None:
+        target.pop(parts[-1], None)
+    else:
+        target[parts[-1]] = value
+
+
+def _children(value) -> Dict[str, Any]:
+    if isinstance(value, list):
+        return {str(i): v for i, v in enumerate(value) if v is not None}
+    return {str(k): v for k, v in value.items()} if isinstance(value, Mapping) else {}
+
+
+class LiveSync:
+    """
+    Tiene la memoria allineata allo storage tramite i listener dell'SDK.
+    Per 'group_users' e 'stats' il listener è sulla sola chiave dell'ultima voce del
+    registro modifiche: a ogni cambio si leggono le voci nuove (dalla versione dei dati
+    caricati all'avvio) e si rileggono solo i record nominati da altri processi, come
+    fa lo snapshot. 'pending_feedback' è piccolo e ha un listener proprio. Con più
+    repliche e senza listener il registro viene letto a intervalli regolari.
+    Tutto viene accodato sul loop, dove un unico task lo applica in ordine ai record in
+    memoria (aggiornati sul posto), all'indice degli username e alle classifiche.
+    I record con modifiche locali non ancora salvate o scritti da poco
+    (storage.written_locally) non vengono toccati subito, così un evento vecchio non
+    riporta indietro la memoria: vengono riletti dallo storage a finestra scaduta.
+    """
+
+    def __init__(self, margin: float = LIVE_SYNC_MARGIN):
+        self.margin = margin
+        self._bot_data: Optional[dict] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: "asyncio.Queue[Tuple[str, str, str, Any]]" = asyncio.Queue()
+        self._listeners: list = []
+        self._task: Optional[asyncio.Task] = None
+        # Lettura periodica del registro, quando il listener sulla sua testa non c'è
+        self._ticker: Optional[asyncio.Task] = None
+        self._since: Optional[str] = None
+        self._seen: Set[str] = set()
+        self._poll_queued = False
+        # Record saltati perché scritti localmente, da rileggere a finestra scaduta
+        self._deferred: Set[str] = set()
+        self.applied = 0
+        self.skipped = 0
+        self.last_event: Optional[float] = None
+
+    @property
+    def running(self) -> bool:
+        following = bool(self._listeners) or self._ticker is not None
+        return following and self._task is not None and not self._task.done()
+
+    # --- ricezione (thread dei listener) ---
+
+    def _listener(self, node: str):
+        def on_event(event) -> None:
+            self._loop.call_soon_threadsafe(
+                self._queue.put_nowait, (node, event.event_type, event.path, event.data)
+            )
+        return on_event
+
+    def _head_listener(self, event) -> None:
+        # Basta sapere che il registro è cambiato: le voci si leggono dal loop
+        self._loop.call_soon_threadsafe(self._queue_poll)
+
+    def _queue_poll(self) -> None:
+        if not self._poll_queued:
+            self._poll_queued = True
+            self._queue.put_nowait((CHANGES_HEAD, "poll", "", None))
+
+    # --- applicazione (loop) ---
+
+    async def _run(self) -> None:
+        while True:
+            node, event_type, path, data = await self._queue.get()
+            try:
+                if event_type == "poll":
+                    await self._poll()
+                elif event_type == "group_stats":
+                    await self._reload_group_stats()
+                elif event_type == "resync":
+                    try:
+                        result = await self._resync()
+                    except Exception as e:
+                        if not data.done():
+                            data.set_exception(e)
+                    else:
+                        if not data.done():
+                            data.set_result(result)
+                elif event_type == "refresh":
+                    await self._refresh(node, path.split("/"))
+                else:
+                    await self._apply(node, event_type, path, data)
+                self.last_event = time.time()
+            except Exception as e:
+                logger.error(f"Errore nell'applicazione di un evento su '{node}{path}': {e}")
+
+    async def _poll(self) -> None:
+        """Legge le voci nuove del registro modifiche e rilegge i record toccati da altri processi."""
+        self._poll_queued = False
+        now = time.time()
+        changes = await storage.load_changes_since(self._since)
+        if changes is None:
+            self._loop.call_later(LIVE_SYNC_RETRY, self._queue_poll)
+            return
+
+        records: Set[Tuple[str, Tuple[str, ...]]] = set()
+        full: Set[str] = set()
+        for key in sorted(changes):
+            entry = changes[key]
+            if key in self._seen or not isinstance(entry, dict):
+                continue
+            self._seen.add(key)
+            node = entry.get("nodo")
+            # Le proprie scritture sono già in memoria
+            if node not in LOGGED_NODES or entry.get("origine") == REPLICA_ID:
+                continue
+            if entry.get("completo"):
+                full.add(node)
+                continue
+            depth = NODES[node]
+            for path in entry.get("percorsi") or []:
+                parts = str(path).strip("/").split("/")
+                if len(parts) >= depth:
+                    records.add((node, tuple(parts[:depth])))
+        self._since = change_stamp(now - self.margin)
+        horizon = change_stamp(now - 2 * self.margin)
+        self._seen = {key for key in self._seen if key >= horizon}
+
+        stats_changed = 0
+        for node in full:
+            loaded = await (storage.load_group_users() if node == "group_users" else storage.load_stats())
+            if not loaded:
+                logger.warning(f"Nodo '{node}' riscritto per intero ma non rileggibile, resta la copia in memoria.")
+                continue
+            changed = await self._replace(node, [], loaded)
+            if node == "stats":
+                stats_changed += changed
+        for i, (node, key) in enumerate(sorted(records), 1):
+            if node not in full:
+                changed = await self._refresh(node, list(key), notify=False)
+                if node == "stats":
+                    stats_changed += changed
+            if i % LIVE_SYNC_YIELD_EVERY == 0:
+                await asyncio.sleep(0)
+        if stats_changed:
+            # Totali e grafico del gruppo dipendono dalle stats di tutti; i contatori del
+            # gruppo vengono scritti nello stesso commit delle stats, quindi sono cambiati anche loro
+            reset_feedback_total()
+            chart_cache.invalidate(GROUP_CHART)
+            await self._reload_group_stats()
+
+    async def _reload_group_stats(self) -> None:
+        """Rilegge 'group_stats', a finestra scaduta se questo processo l'ha scritto da poco."""
+        if storage.written_locally("group_stats"):
+            self.skipped += 1
+            self._loop.call_later(
+                storage.LOCAL_WRITE_WINDOW, self._queue.put_nowait, ("group_stats", "group_stats", "", None)
+            )
+            return
+        group_stats = await storage.load_group_stats()
+        if group_stats:
+            group_stats.setdefault("daily", {})
+            self._bot_data['group_stats'] = group_stats
+            chart_cache.invalidate(GROUP_CHART)
+
+    async def _refresh(self, node: str, key: List[str], notify: bool = True) -> int:
+        """
+        Rilegge un record dallo storage e lo applica alla memoria. Un record assente
+        o non leggibile (None in entrambi i casi) lascia la memoria com'è.
+        """
+        self._deferred.discard("/".join([node, *key]))
+        try:
+            if node == "group_users":
+                fresh = await storage.load_user_data(int(key[0]), int(key[1]))
+            elif node == "stats":
+                fresh = await storage.load_stats_entry(int(key[0]))
+            else:
+                fresh = await storage.load_pending_feedback_entry(key[0])
+        except ValueError:
+            return 0
+        if not isinstance(fresh, Mapping):
+            return 0
+        changed = self._apply_record(node, key, [], to_json(fresh))
+        if notify and node == "stats" and changed:
+            reset_feedback_total()
+            chart_cache.invalidate(GROUP_CHART)
+        return changed
+
+    def _defer(self, node: str, key: List[str]) -> None:
+        """Rilegge il record quando la finestra delle scritture locali sarà scaduta."""
+        record = "/".join([node, *key])
+        self.skipped += 1
+        if record in self._deferred:
+            return
+        self._deferred.add(record)
+        self._loop.call_later(
+            storage.LOCAL_WRITE_WINDOW, self._queue.put_nowait, (node, "refresh", "/".join(key), None)
+        )
+
+    def _operations(self, depth: int, parts: List[str], event_type: str, data) -> Iterator[Tuple[List[str], Any, bool]]:
+        """
+        Scompone un evento in operazioni (percorso, valore, sostituisci): sostituisci è True
+        per un put sopra il livello dei record, che rimpiazza tutti i record sotto il percorso.
+        """
+        if event_type == "patch":
+            for child, value in _children(data).items():
+                yield from self._operations(depth, parts + child.strip("/").split("/"), "put", value)
+        else:
+            yield parts, data, len(parts) < depth
+
+    async def _apply(self, node: str, event_type: str, path: str, data) -> None:
+        depth = NODES[node]
+        parts = [part for part in path.strip("/").split("/") if part]
+        changed = 0
+        for op_parts, value, replace in self._operations(depth, parts, event_type, data):
+            if replace:
+                changed += await self._replace(node, op_parts, value)
+            else:
+                changed += self._apply_record(node, op_parts[:depth], op_parts[depth:], value)
+        if node == "stats" and changed:
+            # Totali e grafico del gruppo dipendono dalle stats di tutti
+            reset_feedback_total()
+            chart_cache.invalidate(GROUP_CHART)
+
+    async def _replace(self, node: str, prefix: List[str], value) -> int:
+        """Put sopra il livello dei record: allinea tutti i record sotto prefix al nuovo contenuto."""
+        depth = NODES[node]
+        incoming: Dict[Tuple[str, ...], Any] = {}
+
+        def collect(parts: List[str], data) -> None:
+            if len(parts) == depth:
+                incoming[tuple(parts)] = data
+                return
+            for child, child_value in _children(data).items():
+                collect(parts + [child], child_value)
+
+        collect(prefix, value)
+        keys = set(incoming) | {key for key in self._memory_keys(node) if list(key[:len(prefix)]) == prefix}
+        changed = 0
+        for i, key in enumerate(keys, 1):
+            changed += self._apply_record(node, list(key), [], incoming.get(key))
+            if i % LIVE_SYNC_YIELD_EVERY == 0:
+                await asyncio.sleep(0)
+        return changed
+
+    def _memory_keys(self, node: str) -> Iterator[Tuple[str, ...]]:
+        if node == "group_users":
+            for chat_id, users in self._bot_data.get('group_users', {}).items():
+                for user_id in users:
+                    yield str(chat_id), str(user_id)
+        elif node == "stats":
+            for user_id in self._bot_data.get('stats', {}):
+                yield (str(user_id),)
+        else:
+            for request_id in pending_store.ids():
+                yield (request_id,)
+
+    def _apply_record(self, node: str, key: List[str], subpath: List[str], value) -> int:
+        if storage.written_locally("/".join([node, *key])):
+            self._defer(node, key)
+            return 0
+        try:
+            if node == "group_users":
+                changed = self._apply_user(int(key[0]), int(key[1]), subpath, value)
+            elif node == "stats":
+                changed = self._apply_stats(int(key[0]), subpath, value)
+            else:
+                changed = self._apply_pending(key[0], subpath, value)
+        except ValueError:
+            # Chiavi non numeriche in 'group_users' o 'stats': non sono record del bot
+            return 0
+        if changed:
+            self.applied += 1
+        return int(changed)
+
+    @staticmethod
+    def _merge(current: Optional[Mapping], subpath: List[str], value):
+        if not subpath:
+            return value if isinstance(value, Mapping) else None
+        data = to_json(current) if current is not None else {}
+        _set_path(data, subpath, value)
+        return data
+
+    @staticmethod
+    def _update_in_place(current, fresh) -> None:
+        for field, field_value in fresh.items():
+            current[field] = field_value
+        for field in [field for field in (current.extra or ()) if field not in fresh]:
+            del current[field]
+
+    def _apply_user(self, chat_id: int, user_id: int, subpath: List[str], value) -> bool:
+        if group_users_writer.is_dirty(chat_id, user_id):
+            self._defer("group_users", [str(chat_id), str(user_id)])
+            return False
+        bot_data = self._bot_data
+        users = bot_data.setdefault('group_users', {}).setdefault(chat_id, {})
+        current = users.get(user_id)
+        data = self._merge(current, subpath, value)
+        old_username = current.get("username") if current is not None else None
+
+        if data is None:
+            if current is None:
+                return False
+            del users[user_id]
+            index_user(bot_data, chat_id, user_id, None, old_username)
+            get_leaderboards(bot_data, chat_id).remove(user_id)
+            return True
+
+        fresh = UserRecord.from_dict(data, user_id)
+        if current is not None and to_json(current) == to_json(fresh):
+            return False
+        if current is None:
+            users[user_id] = current = fresh
+        else:
+            self._update_in_place(current, fresh)
+        index_user(bot_data, chat_id, user_id, current.get("username"), old_username)
+        update_leaderboards(bot_data, chat_id, current)
+        return True
+
+    def _apply_stats(self, user_id: int, subpath: List[str], value) -> bool:
+        stats = self._bot_data.setdefault('stats', {})
+        current = stats.get(user_id)
+        data = self._merge(current, subpath, value)
+        if data is None:
+            if stats.pop(user_id, None) is None:
+                return False
+        else:
+            fresh = StatsRecord.from_dict(data)
+            if current is not None and to_json(current) == to_json(fresh):
+                return False
+            if current is None:
+                stats[user_id] = fresh
+            else:
+                self._update_in_place(current, fresh)
+        chart_cache.invalidate(user_id)
+        return True
+
+    def _apply_pending(self, request_id: str, subpath: List[str], value) -> bool:
+        data = self._merge(pending_store.get(request_id), subpath, value)
+        return pending_store.apply_remote(request_id, data, storage.LOCAL_WRITE_WINDOW)
+
+    # --- ciclo di vita ---
+
+    def start(self, bot_data: dict, since: Optional[str] = None, interval: Optional[float] = None) -> None:
+        """
+        Avvia i listener (solo con Firebase: SQLite non ha notifiche delle modifiche).
+        since è la versione del registro da cui i dati in memoria vanno riallineati
+        (snapshot_manager.loaded_version); la prima lettura del listener la usa.
+        Con interval (più repliche) il registro viene comunque seguito: se il listener
+        sulla sua testa non è disponibile, viene letto ogni interval secondi.
+        """
+        listen = LIVE_SYNC and storage.STORAGE_BACKEND != "sqlite"
+        if self._task is not None or (not listen and interval is None):
+            return
+        self._bot_data = bot_data
+        self._loop = asyncio.get_running_loop()
+        self._since = since or change_stamp(time.time() - self.margin)
+        self._task = asyncio.create_task(self._run())
+        head_listener = False
+        if listen:
+            listeners = {CHANGES_HEAD: self._head_listener}
+            listeners.update({node: self._listener(node) for node in NODES if node not in LOGGED_NODES})
+            for node, callback in listeners.items():
+                try:
+                    self._listeners.append(reference(node).listen(callback))
+                    head_listener = head_listener or node == CHANGES_HEAD
+                except Exception as e:
+                    logger.warning(f"Listener su '{node}' non disponibile: {e}")
+        if interval is not None and not head_listener:
+            self._ticker = asyncio.create_task(self._tick(interval))
+            logger.info(f"Registro modifiche letto ogni {interval}s (nessun listener sulla testa).")
+        logger.info(f"Sincronizzazione live avviata su {len(self._listeners)} nodi (registro da {self._since}).")
+
+    async def _tick(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            self._queue_poll()
+
+    async def stop(self) -> None:
+        for listener in self._listeners:
+            listener.close()
+        self._listeners = []
+        if self._ticker is not None:
+            self._ticker.cancel()
+            self._ticker = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def metrics(self) -> dict:
+        return {
+            "running": self.running,
+            "listeners": len(self._listeners),
+            "polling": self._ticker is not None,
+            "applied": self.applied,
+            "skipped": self.skipped,
+            "deferred": len(self._deferred),
+            "queued": self._queue.qsize(),
+            "last_event_age": None if self.last_event is None else round(time.time() - self.last_event, 1),
+        }
+
+    async def resync(self) -> Dict[str, int]:
+        """
+        Ricarica per intero 'group_users' e 'stats' e applica alla memoria solo le
+        differenze, sul posto e con le regole degli eventi (i record con scritture
+        locali in corso vengono riletti più tardi). Serve per le modifiche fatte fuori
+        dal bot, ad esempio dalla console di Firebase, che non passano dal registro
+        modifiche. Gira nel task della sincronizzazione, dopo gli eventi già in coda.
+        Restituisce i conteggi di utenti e statistiche letti e cambiati.
+        """
+        done = self._loop.create_future()
+        self._queue.put_nowait(("", "resync", "", done))
+        return await done
+
+    async def _resync(self) -> Dict[str, int]:
+        bot_data = self._bot_data
+        group_users, stats = await asyncio.gather(storage.load_group_users(), storage.load_stats())
+        # Una lettura fallita restituisce un nodo vuoto: non deve svuotare la memoria
+        if not group_users and bot_data.get('group_users'):
+            raise RuntimeError("lettura di group_users non riuscita")
+        if not stats and bot_data.get('stats'):
+            raise RuntimeError("lettura di stats non riuscita")
+        result = {
+            "utenti": sum(len(users) for users in group_users.values()),
+            "utenti_cambiati": await self._replace("group_users", [], group_users),
+            "stats": len(stats),
+            "stats_cambiate": await self._replace("stats", [], stats),
+        }
+        if result["stats_cambiate"]:
+            reset_feedback_total()
+            chart_cache.invalidate(GROUP_CHART)
+        await self._reload_group_stats()
+        return result
+
+live_sync = LiveSync()
@@ -1,3 +1,7 @@
+import time
+
+_IMPORT_START = time.perf_counter()
+
 import logging
 import os
 import asyncio
@@ -9,13 +13,19 @@ from telegram import (
 )
 from telegram.ext import (
     Application, MessageHandler, CallbackQueryHandler, filters,
-    ContextTypes, CommandHandler
+    ContextTypes
 )
 from telegram.constants import ParseMode
 from telegram.helpers import escape_markdown
-from firebase_admin import db
-from firebase_file import load_stats, save_group_users, load_group_users, load_user_data
-from stats import update_feedback_stats, start, genera_grafico_totale, save_stats
+import storage
+from stats import load_or_build_group_stats, start, genera_grafico_totale
+from feedback_commit import accept_feedback
+from write_behind import group_users_writer, mark_user_dirty
+from chart_renderer import chart_renderer
+from chart_cache import chart_cache
+from user_index import build_username_index, find_user_by_username, index_user
+from leaderboard import build_leaderboards, update_leaderboards
+from records import UserRecord
 from telegram.error import BadRequest
 
 # Importa i comandi personalizzati
@@ -32,7 +42,13 @@ from comandi import (
     unverify_user,
     show_commands
 )
-from utils import add_auth, remove_auth, list_admins, list_verified_users, list_feedback_received, list_feedback_sent, handle_pagination_callback, load_admin_ids, list_limited_users
+from utils import add_auth, remove_auth, list_admins, list_verified_users, list_feedback_received, list_feedback_sent, handle_pagination_callback, list_limited_users, PAGINATION_DATA_STORE
+from admin_cache import admin_cache
+from pending_store import pending_store
+from snapshot import snapshot_manager
+from live_sync import live_sync
+from ingress import IngressQueue, UpdateDeduplicator, UpdatePrefilter, json_loads, raw_ordering_key
+from replicas import REPLICA_MODE, REPLICA_SECRET, FORWARD_HEADER, REPLICA_SYNC_INTERVAL, shard_for, shard_leases
 
 load_dotenv()
 
@@ -48,25 +64,43 @@ GRUPPO_FEEDBACK_DA_ACCETTARE = int(os.getenv("GRUPPO_FEEDBACK_DA_ACCETTARE"))
 GRUPPO_FEEDBACK = int(os.getenv("GRUPPO_FEEDBACK"))
 GRUPPO_STAFF = os.getenv("GRUPPO_STAFF")
 
-pending_feedback: Dict[str, dict] = {}
-group_users: dict = {}
 feedback_messages: Dict[int, int] = {}
+ingress: Optional[IngressQueue] = None
+deduplicator = UpdateDeduplicator()
+
+
+def _cached_username(chat_id: int, user_id: int) -> Optional[str]:
+    user_data = application.bot_data.get('group_users', {}).get(chat_id, {}).get(user_id)
+    return user_data.get('username') if user_data else None
+
+
+prefilter = UpdatePrefilter(GRUPPO_SCAMBI, _cached_username)
+
+
+class StartupTimer:
+    """Misura la durata delle fasi di avvio e le riassume nel log."""
+
+    def __init__(self, started_at: float):
+        self._last = started_at
+        self._started_at = started_at
+        self._phases = []
+
+    def mark(self, phase: str) -> None:
+        now = time.perf_counter()
+        self._phases.append((phase, now - self._last))
+        self._last = now
+
+    def report(self) -> None:
+        lines = [f"  {phase:<24} {seconds * 1000:8.1f} ms" for phase, seconds in self._phases]
+        total = (self._last - self._started_at) * 1000
+        logger.info("Tempi di avvio:\n" + "\n".join(lines) + f"\n  {'totale':<24} {total:8.1f} ms")
 
-stats = load_stats()
 
 async def get_user_from_dict_or_telegram(chat_id: int, username: str, context: ContextTypes.DEFAULT_TYPE) -> Optional[dict]:
     if chat_id != GRUPPO_SCAMBI:
         return None
 
-    global group_users
-    if chat_id not in group_users:
-        group_users[chat_id] = {}
-
-    for user_id, user_data in group_users[chat_id].items():
-        if user_data.get("username", "").lower() == username.lower():
-            return user_data
-
-    return None
+    return find_user_by_username(context.bot_data, chat_id, username)
 
 
 async def traccia_utente(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -95,26 +129,22 @@ async def traccia_utente(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user.id not in context.bot_data['group_users'][chat_id]:
         
         # 2. Se non è in cache, controlla se esiste già su Firebase
-        user_data_from_firebase = load_user_data(chat_id, user.id)
+        user_data_from_firebase = await storage.load_user_data(chat_id, user.id)
 
         if user_data_from_firebase:
             # 2a. Utente trovato su Firebase: carica i suoi dati nella cache locale
             context.bot_data['group_users'][chat_id][user.id] = user_data_from_firebase
+            index_user(context.bot_data, chat_id, user.id, user_data_from_firebase.get('username'))
+            update_leaderboards(context.bot_data, chat_id, user_data_from_firebase)
             logger.info(f"Dati per l'utente {username} (ID: {user.id}) ricaricati da Firebase.")
         else:
             # 2b. L'utente è veramente nuovo: crea un profilo e invia notifica
             logger.info(f"Nuovo utente {username} (ID: {user.id}) rilevato. Creo un nuovo profilo.")
-            new_user = {
-                "id": user.id,
-                "username": username,
-                "verified": False,
-                "limited": False,
-                "feedback_fatti": 0,
-                "feedback_ricevuti": 0,
-                "cards_donate": [0] * 7,
-                "cards_ricevute": [0] * 7,
-            }
+            new_user = UserRecord(user.id, username)
             context.bot_data['group_users'][chat_id][user.id] = new_user
+            index_user(context.bot_data, chat_id, user.id, username)
+            update_leaderboards(context.bot_data, chat_id, new_user)
+            mark_user_dirty(chat_id, user.id, new_user)
             
             # Invia notifica al gruppo di monitoraggio
             # FIX: Escaping dello username per evitare errori di parsing Markdown
@@ -125,8 +155,7 @@ async def traccia_utente(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 text=(
                     f"*👤 Nuovo utente aggiunto al database\\!*\n"
                     f"_🌐 Username\\:_ @{safe_username}\n"
-                    f"_🔢 ID\\:_ {user.id}\n\n"
-                    f"_Usa il comando \\.leggi per aggiornare il database\\._"
+                    f"_🔢 ID\\:_ {user.id}"
                 ),
                 parse_mode=ParseMode.MARKDOWN_V2
             )
@@ -134,14 +163,15 @@ async def traccia_utente(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 3. A prescindere da tutto, aggiorna lo username se è cambiato
     current_user_data = context.bot_data['group_users'][chat_id][user.id]
     if current_user_data.get('username') != username:
+        old_username = current_user_data.get('username')
         current_user_data['username'] = username
+        index_user(context.bot_data, chat_id, user.id, username, old_username)
+        update_leaderboards(context.bot_data, chat_id, current_user_data)
         logger.info(f"Username per l'utente {user.id} aggiornato a {username}.")
-
-    # 4. Salva lo stato attuale (aggiornato) su Firebase
-    save_group_users(context.bot_data['group_users'])
+        # 4. Solo in caso di modifica l'utente viene accodato per il salvataggio su Firebase
+        mark_user_dirty(chat_id, user.id, current_user_data)
 
 async def feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global pending_feedback
     message = update.message
     user = update.effective_user
     chat_id = update.effective_chat.id
@@ -157,14 +187,8 @@ async def feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if len(parts) >= 2 and parts[0] == "@feedback":
             target_username = parts[1].lstrip("@")
             
-            group_users_data = context.bot_data.get('group_users', {})
-            target_user_info = None
-            
-            # FIX: Usa group_users_data (aggiornato) invece della variabile globale group_users (statica)
-            for uid, u_data in group_users_data.get(chat_id, {}).items():
-                if u_data.get("username", "").lower() == target_username.lower():
-                    target_user_info = u_data
-                    break
+            # Ricerca O(1) tramite l'indice degli username in bot_data
+            target_user_info = find_user_by_username(context.bot_data, chat_id, target_username)
             
             if target_user_info:
                 feedback_text = " ".join(parts[2:]) if len(parts) > 2 else ""
@@ -189,15 +213,8 @@ async def feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     "sender_username": user.username,
                     "origin_chat_id": chat_id,
                 }
-                try:
-                    ref = db.reference(f'pending_feedback/{message.message_id}')
-                    ref.set(feedback_data)
-                    logger.info(f"Feedback pendente salvato su Firebase per il messaggio {message.message_id}")
-                except Exception as e:
-                    logger.error(f"Errore nel salvare il feedback pendente su Firebase: {e}")
-                    await message.reply_text("*Si è verificato un errore, riprova\\.*", parse_mode=ParseMode.MARKDOWN_V2)
-                    return
-
+                # Salvato in memoria; la copia su Firebase viene scritta in background
+                pending_store.set(message.message_id, feedback_data)
                 logger.info(f"Feedback pendente salvato per il messaggio {message.message_id}")
             else:
                 await message.reply_text("*⚠️ Utente non trovato\\.*", parse_mode=ParseMode.MARKDOWN_V2)
@@ -228,11 +245,9 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
 
             username = escape_markdown(user_data.get("username", "N/A"), 2)
-            cards = user_data.get("cards_donate", [0] * 7)
-            received = user_data.get("cards_ricevute", [0] * 7)
-
-            cards = cards if isinstance(cards, list) else [0] * 7
-            received = received if isinstance(received, list) else [0] * 7
+            # I contatori sono array('I') di 7 elementi, uno per numero di stelle
+            cards = list(user_data.get("cards_donate") or [0] * 7)
+            received = list(user_data.get("cards_ricevute") or [0] * 7)
             cards += [0] * (7 - len(cards))
             received += [0] * (7 - len(received))
 
@@ -287,9 +302,8 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     request_id = parts[1]
     
-    # Recupera i dati del feedback pendente da Firebase
-    pending_ref = db.reference(f'pending_feedback/{request_id}')
-    pending = pending_ref.get()
+    # Recupera i dati del feedback pendente dalla copia in memoria (o dallo storage, con più repliche)
+    pending = await pending_store.fetch(request_id)
 
     if not pending:
         await query.edit_message_caption(
@@ -318,7 +332,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             chat_id=GRUPPO_FEEDBACK_DA_ACCETTARE, photo=pending["photo_id"],
             caption=caption, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN_V2
         )
-        pending_ref.update({"feedback_group_message_id": sent.message_id})
+        pending_store.update(request_id, {"feedback_group_message_id": sent.message_id})
         
         # Gestisce i clic ripetuti intercettando l'errore
         try:
@@ -335,12 +349,11 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if pending["user_id"] != user.id:
             await query.answer("Non puoi annullare questo feedback.", show_alert=True)
             return
-        pending_ref.delete()
+        pending_store.delete(request_id)
         await query.edit_message_text("_🪃 Feedback annullato\\!_", parse_mode=ParseMode.MARKDOWN_V2)
 
     elif action == "reject":
-        admin_ids = load_admin_ids()
-        if user.id not in admin_ids:
+        if not admin_cache.is_admin(user.id):
             await query.answer("⛔ Non sei autorizzato ad eseguire questa azione.", show_alert=True)
             return
 
@@ -352,11 +365,10 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                    f"*Per\\:* @{destinatario} \\[`{pending['target_user_id']}`\\]\n"
                    f"*Messaggio\\:* {mex}\n\n*🤌 Feedback rifiutato\\.*")
         await query.edit_message_caption(caption=caption, parse_mode=ParseMode.MARKDOWN_V2)
-        pending_ref.delete()
+        pending_store.delete(request_id)
 
     elif action == "accept":
-        admin_ids = load_admin_ids()
-        if user.id not in admin_ids:
+        if not admin_cache.is_admin(user.id):
             await query.answer("⛔ Non sei autorizzato ad eseguire questa azione.", show_alert=True)
             return
 
@@ -376,8 +388,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
     elif action == "star":
-        admin_ids = load_admin_ids()
-        if user.id not in admin_ids:
+        if not admin_cache.is_admin(user.id):
             await query.answer("⛔ Non sei autorizzato ad eseguire questa azione.", show_alert=True)
             return
 
@@ -387,7 +398,6 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         stars = int(parts[2])
         group_users = context.bot_data['group_users']
-        stats = context.bot_data['stats']
         origin_chat = pending["origin_chat_id"]
         sender = group_users[origin_chat].get(pending["user_id"])
         target = group_users[origin_chat].get(pending["target_user_id"])
@@ -396,23 +406,20 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_caption(caption="*Errore\\: utente non trovato nel database\\.*", parse_mode=ParseMode.MARKDOWN_V2)
             return
 
-        sender["feedback_fatti"] = sender.get("feedback_fatti", 0) + 1
-        target["feedback_ricevuti"] = target.get("feedback_ricevuti", 0) + 1
-        sender.setdefault("cards_ricevute", [0]*7)[stars] += 1
-        target.setdefault("cards_donate", [0]*7)[stars] += 1
-
-        if target["feedback_ricevuti"] >= 25 and not target.get("verified"):
-            target["verified"] = True
+        # Da qui il feedback non è più in sospeso: un secondo clic trova "già elaborato".
+        # Il claim può fallire se un altro admin ha scelto le stelle mentre questo update
+        # aspettava la lettura del feedback: in quel caso non va applicato una seconda volta
+        # (la didascalia la aggiorna chi l'ha accettato)
+        if pending_store.claim(request_id) is None:
+            logger.info(f"Feedback {request_id} già accettato da un altro admin, clic ignorato.")
+            return
+        if await accept_feedback(context.bot_data, request_id, pending, stars):
             nome_verificato = escape_markdown(target["username"], version=2)
             await context.bot.send_message(
                 chat_id=GRUPPO_STAFF,
                 text=f"_➕ L'utente @{nome_verificato} ha raggiunto i 25 feedback\\._\n\n*🔝 È stato verificato\\!*",
                 parse_mode=ParseMode.MARKDOWN_V2
             )
-        
-        save_group_users(group_users)
-        update_feedback_stats(stats, pending["user_id"], pending["sender_username"], pending["target_user_id"], pending["target_username"])
-        save_stats(stats)
 
         stelle_text = "Generico" if stars == 0 else f"{stars} ⭐" 
         mittente = escape_markdown(pending['sender_username'], version=2)
@@ -430,8 +437,6 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             caption=final_caption, parse_mode=ParseMode.MARKDOWN_V2
         )
         await query.edit_message_caption(caption=final_caption, parse_mode=ParseMode.MARKDOWN_V2)
-        
-        pending_ref.delete()
 
 COMMAND_MAP = {
     "inf": info_utente,
@@ -455,43 +460,95 @@ COMMAND_MAP = {
     "leggi": reload_data
 }
 
+# Comandi accettati solo nella forma '/comando', come con i CommandHandler originali
+SLASH_COMMAND_MAP = {"start": start, **COMMAND_MAP}
 
-async def dot_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if update.message and update.message.text and update.message.text.startswith('.'):
-        command_text = update.message.text[1:]
-        parts = command_text.split()
-        if not parts:
+
+async def command_dispatcher(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Instrada '/comando' e '.comando' tramite COMMAND_MAP.
+    L'handler riceve l'update originale, con gli argomenti già in context.args.
+    Stesse regole dei vecchi CommandHandler e dot_command_handler:
+    - '/comando' ignora maiuscole/minuscole, accetta '@NomeBot' e include /start;
+    - '.comando' è sensibile alle maiuscole e non include .start.
+    I messaggi modificati non vengono instradati: gli handler rispondono con
+    update.message, che per una modifica è None (prima finivano in errore).
+    """
+    text = update.message.text
+    parts = text[1:].split()
+    if not parts:
+        return
+
+    if text.startswith("/"):
+        # '/comando@NomeBot' è valido solo se rivolto a questo bot
+        command_name, _, bot_username = parts[0].partition("@")
+        if bot_username and bot_username.lower() != (context.bot.username or "").lower():
             return
-            
-        command_name = parts[0]
-        context.args = parts[1:]
-        
-        if command_name in COMMAND_MAP:
-            # Crea un nuovo oggetto messaggio per non interferire con altri handler
-            new_message = update.message.to_dict()
-            new_message['text'] = '/' + command_text
-            new_update = Update.de_json(data={'update_id': update.update_id, 'message': new_message}, bot=context.bot)
-            await COMMAND_MAP[command_name](new_update, context)
-
-async def on_startup(app: Application):
-    global ALLOWED_USER_IDS
-    ALLOWED_USER_IDS = load_admin_ids()
-    logger.info(f"Admin inizializzati: {ALLOWED_USER_IDS}")
+        handler = SLASH_COMMAND_MAP.get(command_name.lower())
+    else:
+        handler = COMMAND_MAP.get(parts[0])
+    if handler is None:
+        return
+    context.args = parts[1:]
+    await handler(update, context)
 
 async def health_check(request: web.Request) -> web.Response:
     return web.Response(text="OK")
 
 
+async def metrics(request: web.Request) -> web.Response:
+    return web.json_response({
+        "ingress": ingress.metrics() if ingress else {},
+        "dedup": deduplicator.metrics(),
+        "prefilter": prefilter.metrics(),
+        "replicas": shard_leases.metrics() if REPLICA_MODE else {},
+        "live_sync": live_sync.metrics(),
+        "chart_cache": chart_cache.info(),
+        "pagination": PAGINATION_DATA_STORE.info(),
+    })
+
+
 async def handle_webhook(request: web.Request) -> web.Response:
     try:
-        data = await request.json()
+        data = json_loads(await request.read())
     except Exception as e:
         logger.error(f"Errore nel parse del JSON: {e}")
         return web.Response(status=400, text="Invalid JSON")
 
+    # Le riconsegne di Telegram vengono scartate prima della deserializzazione
+    update_id = data.get("update_id") if isinstance(data, dict) else None
+    if update_id is not None and deduplicator.is_duplicate(update_id):
+        logger.info(f"Update duplicato {update_id} ignorato.")
+        return web.Response(text="OK")
+
+    # Con più repliche ogni chat è servita solo dalla replica che ne detiene la shard
+    if REPLICA_MODE and isinstance(data, dict):
+        shard = shard_for(raw_ordering_key(data))
+        if not shard_leases.owns(shard):
+            # Già inoltrato da un'altra replica: niente secondo salto, Telegram ritenterà
+            if request.headers.get(FORWARD_HEADER) == REPLICA_SECRET:
+                return web.Response(status=503, text="Not owner")
+            status = await shard_leases.forward(shard, await request.read())
+            if status is None:
+                return web.Response(status=503, text="No owner")
+            return web.Response(status=status, text="Forwarded")
+
+    # Gli update che nessun handler userebbe non vengono nemmeno deserializzati
+    if not isinstance(data, dict) or not prefilter.is_relevant(data):
+        if update_id is not None:
+            deduplicator.add(update_id)
+        return web.Response(text="OK")
+
     update = Update.de_json(data, application.bot)
 
-    asyncio.create_task(application.process_update(update))
+    # Coda piena: una risposta non-2xx fa ritentare la consegna a Telegram
+    if not ingress.submit(update):
+        logger.warning(f"Coda di ingresso piena, update {update.update_id} rifiutato.")
+        return web.Response(status=503, text="Busy")
+
+    # Registrato solo se accettato, così la riconsegna di un update rifiutato viene elaborata
+    if update_id is not None:
+        deduplicator.add(update_id)
 
     return web.Response(text="OK")
 
@@ -503,6 +560,7 @@ async def start_webserver() -> None:
     webapp = web.Application()
     webapp.router.add_get('/', health_check)       
     webapp.router.add_get('/health', health_check)  
+    webapp.router.add_get('/metrics', metrics)
     webapp.router.add_post('/webhook', handle_webhook)
 
     runner = web.AppRunner(webapp)
@@ -515,46 +573,45 @@ async def start_webserver() -> None:
 
 
 async def main() -> None:
-    global group_users, stats
-    group_users = load_group_users()
-    stats = load_stats()
+    timer = StartupTimer(_IMPORT_START)
+    timer.mark("import moduli")
     WEBHOOK_URL = os.getenv('WEBHOOK_URL')  
 
     if not TOKEN or not WEBHOOK_URL:
         logger.error("Le variabili d'ambiente TOKEN e WEBHOOK_URL devono essere definite.")
         return
 
-    global application
+    storage.initialize()
+    timer.mark("init storage")
+
+    global application, ingress
     application = Application.builder().token(TOKEN).build()
-    application.bot_data['group_users'] = load_group_users()
-    application.bot_data['stats'] = load_stats()
-    logger.info("Dati utenti e statistiche caricati in memoria.")
-
-
-    # Comandi standard
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("inf", info_utente))
-    application.add_handler(CommandHandler("addinv", add_invio))
-    application.add_handler(CommandHandler("addfeed", add_feed))
-    application.add_handler(CommandHandler("reminv", rem_invio))
-    application.add_handler(CommandHandler("remfeed", rem_feed))
-    application.add_handler(CommandHandler("verifica", verify_user))
-    application.add_handler(CommandHandler("sverifica", unverify_user))
-    application.add_handler(CommandHandler("limita", limit_user))
-    application.add_handler(CommandHandler("unlimita", unlimit_user))
-    application.add_handler(CommandHandler("limitati", list_limited_users))
-    application.add_handler(CommandHandler("admin", add_auth))
-    application.add_handler(CommandHandler("remadmin", remove_auth))
-    application.add_handler(CommandHandler("statistiche", genera_grafico_totale))
-    application.add_handler(CommandHandler("listadmin", list_admins))
-    application.add_handler(CommandHandler("verificati", list_verified_users)) 
-    application.add_handler(CommandHandler("inviati", list_feedback_sent))
-    application.add_handler(CommandHandler("ricevuti", list_feedback_received))
-    application.add_handler(CommandHandler("comandi", show_commands))
-    application.add_handler(CommandHandler("leggi", reload_data))
-
-    # Handler per i comandi che iniziano con '.'
-    application.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"^\."), dot_command_handler))
+
+    # Ogni nodo viene letto una sola volta, con le letture in parallelo sul pool di storage;
+    # utenti e statistiche partono dallo snapshot locale, se presente
+    (group_users, stats), _, _ = await asyncio.gather(
+        snapshot_manager.load(),
+        admin_cache.reload(),
+        pending_store.load(),
+    )
+    timer.mark("caricamento dati")
+
+    application.bot_data['group_users'] = group_users
+    application.bot_data['username_index'] = build_username_index(group_users)
+    application.bot_data['leaderboards'] = build_leaderboards(group_users)
+    application.bot_data['stats'] = stats
+    timer.mark("indici e classifiche")
+    application.bot_data['group_stats'] = await load_or_build_group_stats(stats)
+    timer.mark("statistiche gruppo")
+    logger.info(f"Dati utenti, statistiche e admin caricati in memoria ({len(admin_cache.ids())} admin).")
+
+
+    # Comandi: '/comando' e '.comando' condividono la stessa tabella di instradamento
+    # (solo messaggi nuovi, non modificati: vedi command_dispatcher)
+    application.add_handler(MessageHandler(
+        filters.UpdateType.MESSAGE & filters.TEXT & (filters.COMMAND | filters.Regex(r"^\.")),
+        command_dispatcher
+    ))
     application.add_handler(CallbackQueryHandler(handle_pagination_callback, pattern=r"^(pagina_verificati|pagina_ricevuti|pagina_inviati|pagina_limitati|pagina_admin)_(\d+)$"))
 
     # Handler principali
@@ -563,13 +620,45 @@ async def main() -> None:
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, traccia_utente))
 
     await application.initialize()
+    timer.mark("init applicazione")
 
     await application.bot.set_webhook(WEBHOOK_URL)
     logger.info(f"Webhook impostato su: {WEBHOOK_URL}")
+    timer.mark("set webhook")
+
+    if REPLICA_MODE:
+        # Le shard vanno prese prima di ricevere update
+        await shard_leases.start()
+    group_users_writer.start()
+    admin_cache.start()
+    pending_store.start()
+    snapshot_manager.start(application.bot_data)
+    # Con più repliche le scritture delle altre arrivano da qui, anche senza listener
+    live_sync.start(
+        application.bot_data, snapshot_manager.loaded_version,
+        interval=REPLICA_SYNC_INTERVAL if REPLICA_MODE else None,
+    )
+    ingress = IngressQueue(application.process_update)
+    ingress.start()
 
     await start_webserver()
+    timer.mark("avvio webserver")
+    timer.report()
 
-    await asyncio.Event().wait()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        # Elabora gli update ricevuti e salva gli utenti ancora in coda prima di uscire
+        await ingress.stop()
+        if REPLICA_MODE:
+            await shard_leases.stop()
+        admin_cache.stop()
+        await live_sync.stop()
+        await pending_store.stop()
+        await group_users_writer.stop()
+        await snapshot_manager.stop()
+        chart_renderer.shutdown()
+        storage.shutdown()
 
 
 if __name__ == '__main__':
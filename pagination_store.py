@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import logging
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PAGINATION_MAX_ENTRIES = int(os.getenv("PAGINATION_MAX_ENTRIES", "1000"))
+PAGINATION_TTL = float(os.getenv("PAGINATION_TTL", "900"))
+
+
+class PageDescriptor(NamedTuple):
+    """Stato compatto di una paginazione: i dati vengono riletti dalla sorgente live."""
+    kind: str
+    version: int
+    page: int
+    created: float
+
+
+class PaginationStore:
+    """
+    Archivio limitato degli stati di paginazione, con eviction LRU e scadenza (TTL).
+    Per ogni (utente, comando) conserva solo un PageDescriptor, non la lista dei dati.
+    """
+
+    def __init__(self, max_entries: int = PAGINATION_MAX_ENTRIES, ttl: float = PAGINATION_TTL):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.evictions = 0
+        self.expired = 0
+        self._entries: "OrderedDict[Tuple[int, str], PageDescriptor]" = OrderedDict()
+
+    def put(self, user_id: int, kind: str, version: int, page: int) -> None:
+        key = (user_id, kind)
+        self._entries[key] = PageDescriptor(kind, version, page, time.monotonic())
+        self._entries.move_to_end(key)
+        self._purge()
+
+    def get(self, user_id: int, kind: str) -> Optional[PageDescriptor]:
+        key = (user_id, kind)
+        descriptor = self._entries.get(key)
+        if descriptor is None:
+            return None
+        if time.monotonic() - descriptor.created > self.ttl:
+            del self._entries[key]
+            self.expired += 1
+            return None
+        self._entries.move_to_end(key)
+        return descriptor
+
+    def _purge(self) -> None:
+        now = time.monotonic()
+        # Le voci usate meno di recente sono in testa: si scartano quelle scadute e le eccedenti
+        while self._entries:
+            key, descriptor = next(iter(self._entries.items()))
+            if now - descriptor.created > self.ttl:
+                self.expired += 1
+            elif len(self._entries) > self.max_entries:
+                self.evictions += 1
+            else:
+                break
+            del self._entries[key]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def memory_usage(self) -> int:
+        """Stima in byte della memoria occupata da chiavi e descrittori."""
+        total = sys.getsizeof(self._entries)
+        for key, descriptor in self._entries.items():
+            total += sys.getsizeof(key) + sys.getsizeof(descriptor)
+        return total
+
+    def info(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "bytes": self.memory_usage(),
+            "evictions": self.evictions,
+            "expired": self.expired,
+        }
@@ -0,0 +1,167 @@
+import time
+import asyncio
+import logging
+from typing import Dict, Optional, Tuple
+
+import storage
+from replicas import REPLICA_MODE
+
+logger = logging.getLogger(__name__)
+
+WRITE_RETRIES = 3
+
+
+class PendingFeedbackStore:
+    """
+    Feedback in sospeso tenuti in memoria, con scrittura asincrona su Firebase.
+    Le letture non toccano la rete; ogni modifica viene accodata e scritta su
+    'pending_feedback/' da un unico task, nell'ordine in cui è avvenuta, così
+    dopo un riavvio load() ritrova lo stato corretto.
+    """
+
+    def __init__(self):
+        self._items: Dict[str, dict] = {}
+        # Feedback tolti con claim: un evento remoto (es. la lettura iniziale di un listener)
+        # o una lettura dallo storage non deve rimetterli in sospeso. Il valore è None finché
+        # il commit non è confermato, poi l'istante della conferma (vedi settle)
+        self._claimed: Dict[str, Optional[float]] = {}
+        self._queue: "asyncio.Queue[Tuple[str, str, Optional[dict]]]" = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    async def load(self) -> None:
+        """Carica i feedback in sospeso da Firebase (all'avvio)."""
+        pending = await storage.load_pending_feedback()
+        self._items = {str(k): v for k, v in pending.items() if isinstance(v, dict)}
+        logger.info(f"{len(self._items)} feedback in sospeso caricati.")
+
+    def get(self, request_id) -> Optional[dict]:
+        return self._items.get(str(request_id))
+
+    async def fetch(self, request_id) -> Optional[dict]:
+        """
+        Come get, ma con più repliche un feedback assente in memoria viene letto dallo
+        storage: può essere stato creato dalla replica che serve il gruppo scambi.
+        """
+        request_id = str(request_id)
+        data = self._items.get(request_id)
+        if data is None and REPLICA_MODE and not self._is_claimed(request_id, storage.LOCAL_WRITE_WINDOW):
+            data = await storage.load_pending_feedback_entry(request_id)
+            # Il claim può essere arrivato durante la lettura
+            if isinstance(data, dict) and not self._is_claimed(request_id, storage.LOCAL_WRITE_WINDOW):
+                self._items[request_id] = data
+            else:
+                data = None
+        return data
+
+    def set(self, request_id, data: dict) -> None:
+        request_id = str(request_id)
+        self._items[request_id] = data
+        self._enqueue("set", request_id, dict(data))
+
+    def update(self, request_id, fields: dict) -> None:
+        request_id = str(request_id)
+        if request_id in self._items:
+            self._items[request_id].update(fields)
+        self._enqueue("update", request_id, dict(fields))
+
+    def delete(self, request_id) -> None:
+        request_id = str(request_id)
+        self._items.pop(request_id, None)
+        self._enqueue("delete", request_id, None)
+
+    def _enqueue(self, op: str, request_id: str, data: Optional[dict]) -> None:
+        # Registrata già in coda: un evento remoto non deve annullare una modifica non ancora scritta
+        storage.note_local_writes("pending_feedback", [request_id])
+        self._queue.put_nowait((op, request_id, data))
+
+    def claim(self, request_id) -> Optional[dict]:
+        """
+        Toglie un feedback dalla memoria senza accodarne l'eliminazione, che avverrà
+        nel commit atomico dell'accettazione. Un secondo claim restituisce None,
+        quindi i doppi clic non vengono elaborati due volte.
+        """
+        request_id = str(request_id)
+        data = self._items.pop(request_id, None)
+        if data is not None:
+            self._claimed[request_id] = None
+        return data
+
+    def settle(self, request_id) -> None:
+        """Segna come confermato il commit di un feedback tolto con claim: da qui parte la finestra."""
+        request_id = str(request_id)
+        if request_id in self._claimed:
+            self._claimed[request_id] = time.monotonic()
+
+    def _is_claimed(self, request_id: str, window: float) -> bool:
+        """True se il feedback è stato tolto con claim e il commit è in corso o confermato da meno di window secondi."""
+        now = time.monotonic()
+        self._claimed = {rid: at for rid, at in self._claimed.items() if at is None or now - at < window}
+        return request_id in self._claimed
+
+    def apply_remote(self, request_id, data: Optional[dict], window: float) -> bool:
+        """
+        Applica alla memoria una modifica arrivata dallo storage (senza riscriverla).
+        Ignora i feedback tolti con claim (vedi _is_claimed).
+        Restituisce True se la memoria è cambiata.
+        """
+        request_id = str(request_id)
+        if self._is_claimed(request_id, window):
+            return False
+        if data is None:
+            return self._items.pop(request_id, None) is not None
+        if self._items.get(request_id) == data:
+            return False
+        self._items[request_id] = data
+        return True
+
+    def ids(self):
+        return list(self._items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @staticmethod
+    async def _write(op: str, request_id: str, data: Optional[dict]) -> bool:
+        if op == "set":
+            return await storage.set_pending_feedback_entry(request_id, data)
+        if op == "update":
+            return await storage.update_pending_feedback_entry(request_id, data)
+        return await storage.delete_pending_feedback_entry(request_id)
+
+    async def _apply(self, op: str, request_id: str, data: Optional[dict]) -> None:
+        for attempt in range(1, WRITE_RETRIES + 1):
+            if await self._write(op, request_id, data):
+                return
+            await asyncio.sleep(attempt)
+        logger.error(f"Scrittura '{op}' del feedback {request_id} fallita dopo {WRITE_RETRIES} tentativi.")
+
+    async def _run(self) -> None:
+        while True:
+            op, request_id, data = await self._queue.get()
+            try:
+                await self._apply(op, request_id, data)
+            finally:
+                self._queue.task_done()
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def flush(self) -> None:
+        """Attende che tutte le modifiche in coda siano state scritte."""
+        if self._task is not None:
+            await self._queue.join()
+
+    async def stop(self) -> None:
+        """Attende la scrittura delle modifiche in coda e ferma il task."""
+        if self._task is not None:
+            await self.flush()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+pending_store = PendingFeedbackStore()
@@ -0,0 +1,405 @@
+import sys
+import datetime
+from array import array
+from collections.abc import Mapping, MutableMapping
+from typing import Any, Dict, Iterator, Optional
+
+from history import StatsHistory
+
+# Record compatti per utenti e statistiche in memoria.
+# Si comportano come dict (lettura, assegnazione, get/setdefault), quindi gli
+# handler esistenti funzionano senza modifiche, ma occupano molta meno RAM:
+# attributi in __slots__, contatori delle carte in array('I'), stringhe
+# ripetute (username, date) internate e storico a colonne (vedi history.py).
+# La conversione da e verso il formato JSON di Firebase avviene solo ai
+# confini con lo storage.
+
+CARD_SLOTS = 7
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+def _card_counts(values) -> list:
+    """Contatori delle carte per stelle (0 = generico); accetta anche le liste sparse di Firebase."""
+    if isinstance(values, Mapping):
+        items = {int(k): v for k, v in values.items() if str(k).isdigit()}
+        values = [items.get(i, 0) for i in range(CARD_SLOTS)]
+    counts = [max(0, int(v or 0)) for v in list(values or [])[:CARD_SLOTS]]
+    return counts + [0] * (CARD_SLOTS - len(counts))
+
+
+def _cards(values) -> array:
+    # Costruito da una lista completa, così l'array non ha spazio sovra-allocato
+    return array("I", _card_counts(values))
+
+
+class _Record(MutableMapping):
+    """Base dei record: campi fissi in __slots__, eventuali chiavi sconosciute in extra."""
+
+    __slots__ = ("extra",)
+    _fields: tuple = ()
+    _converters: Dict[str, Any] = {}
+
+    def __getitem__(self, key: str):
+        if key in self._converters:
+            return getattr(self, key)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value) -> None:
+        converter = self._converters.get(key)
+        if converter is not None:
+            setattr(self, key, converter(value))
+            return
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if self.extra and key in self.extra:
+            del self.extra[key]
+            return
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self._fields
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self) -> int:
+        return len(self._fields) + (len(self.extra) if self.extra else 0)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+    def to_dict(self) -> dict:
+        raise NotImplementedError
+
+
+def _int(value) -> int:
+    return int(value or 0)
+
+
+def _count(value) -> int:
+    return max(0, int(value or 0))
+
+
+# Posizioni nell'array dei contatori di UserRecord
+_FATTI, _RICEVUTI = 0, 1
+_DONATE = slice(2, 2 + CARD_SLOTS)
+_CARDS_RICEVUTE = slice(2 + CARD_SLOTS, 2 + 2 * CARD_SLOTS)
+_VERIFIED, _LIMITED = 1, 2
+
+
+class UserRecord(_Record):
+    """
+    Utente di una chat (voce di 'group_users').
+    I contatori e le carte stanno in un unico array('I') di larghezza fissa e i flag in
+    un intero; 'cards_donate' e 'cards_ricevute' sono viste (memoryview) sulla parte
+    dell'array che le contiene, quindi user["cards_donate"][stelle] += 1 scrive nel record.
+    """
+
+    __slots__ = ("id", "username", "_flags", "_counts")
+    _fields = ("id", "username", "verified", "limited", "feedback_fatti", "feedback_ricevuti",
+               "cards_donate", "cards_ricevute")
+    _converters = {
+        "id": int,
+        "username": _intern,
+        "verified": bool,
+        "limited": bool,
+        "feedback_fatti": _count,
+        "feedback_ricevuti": _count,
+        "cards_donate": _cards,
+        "cards_ricevute": _cards,
+    }
+
+    def __init__(self, id: int, username: Optional[str] = None, verified: bool = False, limited: bool = False,
+                 feedback_fatti: int = 0, feedback_ricevuti: int = 0, cards_donate=None, cards_ricevute=None):
+        self.id = int(id)
+        self.username = _intern(username)
+        self._flags = (_VERIFIED if verified else 0) | (_LIMITED if limited else 0)
+        self._counts = array("I", [_count(feedback_fatti), _count(feedback_ricevuti),
+                                   *_card_counts(cards_donate), *_card_counts(cards_ricevute)])
+        self.extra = None
+
+    def _flag(self, bit: int, value) -> None:
+        self._flags = self._flags | bit if value else self._flags & ~bit
+
+    @property
+    def verified(self) -> bool:
+        return bool(self._flags & _VERIFIED)
+
+    @verified.setter
+    def verified(self, value) -> None:
+        self._flag(_VERIFIED, value)
+
+    @property
+    def limited(self) -> bool:
+        return bool(self._flags & _LIMITED)
+
+    @limited.setter
+    def limited(self, value) -> None:
+        self._flag(_LIMITED, value)
+
+    @property
+    def feedback_fatti(self) -> int:
+        return self._counts[_FATTI]
+
+    @feedback_fatti.setter
+    def feedback_fatti(self, value) -> None:
+        self._counts[_FATTI] = _count(value)
+
+    @property
+    def feedback_ricevuti(self) -> int:
+        return self._counts[_RICEVUTI]
+
+    @feedback_ricevuti.setter
+    def feedback_ricevuti(self, value) -> None:
+        self._counts[_RICEVUTI] = _count(value)
+
+    @property
+    def cards_donate(self) -> memoryview:
+        return memoryview(self._counts)[_DONATE]
+
+    @cards_donate.setter
+    def cards_donate(self, value) -> None:
+        self._counts[_DONATE] = _cards(value)
+
+    @property
+    def cards_ricevute(self) -> memoryview:
+        return memoryview(self._counts)[_CARDS_RICEVUTE]
+
+    @cards_ricevute.setter
+    def cards_ricevute(self, value) -> None:
+        self._counts[_CARDS_RICEVUTE] = _cards(value)
+
+    @classmethod
+    def from_dict(cls, data: Mapping, user_id: Optional[int] = None) -> "UserRecord":
+        record_id = data.get("id", user_id)
+        if user_id is not None and record_id == user_id:
+            # Stesso oggetto int della chiave del dizionario della chat
+            record_id = user_id
+        record = cls(
+            record_id,
+            data.get("username"),
+            data.get("verified", False),
+            data.get("limited", False),
+            data.get("feedback_fatti", 0),
+            data.get("feedback_ricevuti", 0),
+            data.get("cards_donate"),
+            data.get("cards_ricevute"),
+        )
+        extra = {k: v for k, v in data.items() if k not in cls._converters}
+        record.extra = extra or None
+        return record
+
+    def to_dict(self) -> dict:
+        counts = self._counts
+        data = {
+            "id": self.id,
+            "username": self.username,
+            "verified": self.verified,
+            "limited": self.limited,
+            "feedback_fatti": counts[_FATTI],
+            "feedback_ricevuti": counts[_RICEVUTI],
+            "cards_donate": counts[_DONATE].tolist(),
+            "cards_ricevute": counts[_CARDS_RICEVUTE].tolist(),
+        }
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+
+class LastFeedback(Mapping):
+    """
+    Ultimo feedback inviato o ricevuto. Il ruolo ('target' o 'sender') decide i
+    nomi delle chiavi; il timestamp è tenuto come epoch e restituito in ISO.
+    """
+
+    __slots__ = ("role", "peer_id", "peer_username", "timestamp")
+
+    def __init__(self, role: str, peer_id: int, peer_username: Optional[str], timestamp: float):
+        self.role = role
+        self.peer_id = peer_id
+        self.peer_username = _intern(peer_username)
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_value(cls, value):
+        """Converte il dict di Firebase; i valori non riconosciuti vengono lasciati com'erano."""
+        if not isinstance(value, Mapping) or isinstance(value, cls):
+            return value
+        role = "target" if "target_id" in value else "sender"
+        if set(value) != {f"{role}_id", f"{role}_username", "timestamp"}:
+            return dict(value)
+        try:
+            timestamp = datetime.datetime.fromisoformat(value["timestamp"]).timestamp()
+        except (TypeError, ValueError):
+            return dict(value)
+        return cls(role, value[f"{role}_id"], value[f"{role}_username"], timestamp)
+
+    def __getitem__(self, key: str):
+        if key == "timestamp":
+            return datetime.datetime.fromtimestamp(self.timestamp).isoformat()
+        if key == f"{self.role}_id":
+            return self.peer_id
+        if key == f"{self.role}_username":
+            return self.peer_username
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter((f"{self.role}_id", f"{self.role}_username", "timestamp"))
+
+    def __len__(self) -> int:
+        return 3
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+
+def _last_to_json(last):
+    return last.to_dict() if isinstance(last, LastFeedback) else last
+
+
+class FeedbackCounter(_Record):
+    """Contatori di feedback fatti o ricevuti di un utente."""
+
+    __slots__ = ("count", "daily_count", "daily_date", "last")
+    _fields = __slots__
+    _converters = {
+        "count": _int,
+        "daily_count": _int,
+        "daily_date": _intern,
+        "last": LastFeedback.from_value,
+    }
+
+    def __init__(self, count: int = 0, daily_count: int = 0, daily_date: Optional[str] = None, last=None):
+        self.count = _int(count)
+        self.daily_count = _int(daily_count)
+        self.daily_date = _intern(daily_date)
+        self.last = LastFeedback.from_value(last)
+        self.extra = None
+
+    @classmethod
+    def from_dict(cls, data: Optional[Mapping]) -> "FeedbackCounter":
+        if isinstance(data, cls):
+            return data
+        data = data or {}
+        record = cls(data.get("count", 0), data.get("daily_count", 0), data.get("daily_date"), data.get("last"))
+        extra = {k: v for k, v in data.items() if k not in cls._converters}
+        record.extra = extra or None
+        return record
+
+    def to_dict(self) -> dict:
+        data = {
+            "count": self.count,
+            "daily_count": self.daily_count,
+            "daily_date": self.daily_date,
+            "last": _last_to_json(self.last),
+        }
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+
+class StatsRecord(_Record):
+    """Statistiche di un utente (voce di 'stats')."""
+
+    __slots__ = ("username", "feedback_fatti", "feedback_ricevuti", "history")
+    _fields = __slots__
+    _converters = {
+        "username": _intern,
+        "feedback_fatti": FeedbackCounter.from_dict,
+        "feedback_ricevuti": FeedbackCounter.from_dict,
+        "history": StatsHistory.from_value,
+    }
+    # Campi non più usati, scartati al caricamento: spariscono dallo storage alla prossima scrittura
+    _obsolete = frozenset({"proporzione"})
+
+    def __init__(self, username: Optional[str] = None, feedback_fatti=None, feedback_ricevuti=None, history=None):
+        self.username = _intern(username)
+        self.feedback_fatti = FeedbackCounter.from_dict(feedback_fatti)
+        self.feedback_ricevuti = FeedbackCounter.from_dict(feedback_ricevuti)
+        self.history = StatsHistory.from_value(history)
+        self.extra = None
+
+    @classmethod
+    def from_dict(cls, data: Mapping) -> "StatsRecord":
+        record = cls(data.get("username"), data.get("feedback_fatti"), data.get("feedback_ricevuti"), data.get("history"))
+        extra = {k: v for k, v in data.items() if k not in cls._converters and k not in cls._obsolete}
+        record.extra = extra or None
+        return record
+
+    def to_dict(self) -> dict:
+        data = {
+            "username": self.username,
+            "feedback_fatti": self.feedback_fatti.to_dict(),
+            "feedback_ricevuti": self.feedback_ricevuti.to_dict(),
+            "history": self.history.to_dict(),
+        }
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+
+# Campi contatore di un utente: con più repliche vengono scritti come incrementi,
+# non come valori assoluti, così le scritture concorrenti si sommano invece di sovrascriversi
+COUNTER_FIELDS = ("feedback_fatti", "feedback_ricevuti")
+CARD_FIELDS = ("cards_donate", "cards_ricevute")
+
+
+def user_counters(user: Mapping) -> Dict[str, int]:
+    """Contatori di un utente per percorso relativo ('feedback_fatti', 'cards_donate/3', ...)."""
+    values = {field: int(user.get(field) or 0) for field in COUNTER_FIELDS}
+    for field in CARD_FIELDS:
+        for i, count in enumerate(user.get(field) or ()):
+            values[f"{field}/{i}"] = int(count or 0)
+    return values
+
+
+def counter_deltas(before: Mapping[str, int], after: Mapping[str, int]) -> Dict[str, int]:
+    """Differenze non nulle tra due letture di user_counters."""
+    deltas = {}
+    for path in before.keys() | after.keys():
+        delta = after.get(path, 0) - before.get(path, 0)
+        if delta:
+            deltas[path] = delta
+    return deltas
+
+
+def to_json(value) -> dict:
+    """Copia di un record (o di un dict) nel formato JSON di Firebase."""
+    to_dict = getattr(value, "to_dict", None)
+    return to_dict() if to_dict is not None else dict(value)
+
+
+def users_from_json(group_users: Dict[int, Dict[int, Mapping]]) -> Dict[int, Dict[int, UserRecord]]:
+    return {
+        chat_id: {
+            user_id: data if isinstance(data, UserRecord) else UserRecord.from_dict(data, user_id)
+            for user_id, data in users.items() if isinstance(data, Mapping)
+        }
+        for chat_id, users in group_users.items()
+    }
+
+
+def user_from_json(data: Optional[Mapping], user_id: Optional[int] = None) -> Optional[UserRecord]:
+    if not isinstance(data, Mapping) or isinstance(data, UserRecord):
+        return data
+    return UserRecord.from_dict(data, user_id)
+
+
+def stats_from_json(stats: Dict[int, Mapping]) -> Dict[int, StatsRecord]:
+    return {
+        user_id: data if isinstance(data, StatsRecord) else StatsRecord.from_dict(data)
+        for user_id, data in stats.items() if isinstance(data, Mapping)
+    }
+
+
+def stats_entry_from_json(data: Optional[Mapping]) -> Optional[StatsRecord]:
+    if not isinstance(data, Mapping) or isinstance(data, StatsRecord):
+        return data
+    return StatsRecord.from_dict(data)
@@ -0,0 +1,190 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Optional, Set
+
+import aiohttp
+
+import storage
+from firebase_file import REPLICA_ID
+
+logger = logging.getLogger(__name__)
+
+# Modalità multi-replica: con REPLICA_SHARDS > 0 le chat vengono divise in shard
+# (chat_id % REPLICA_SHARDS) e ogni replica elabora solo gli update delle shard di cui
+# detiene il lease nello storage; gli altri vengono inoltrati alla replica proprietaria.
+REPLICA_SHARDS = int(os.getenv("REPLICA_SHARDS", "0"))
+REPLICA_MODE = REPLICA_SHARDS > 0
+# Indirizzo a cui le altre repliche inoltrano gli update di questa (es. http://10.0.0.5:8443)
+REPLICA_URL = os.getenv("REPLICA_URL", "")
+# Segreto condiviso che identifica gli update inoltrati da un'altra replica
+REPLICA_SECRET = os.getenv("REPLICA_SECRET", "")
+FORWARD_HEADER = "X-Replica-Forward"
+FORWARD_TIMEOUT = float(os.getenv("REPLICA_FORWARD_TIMEOUT", "5"))
+
+LEASE_TTL = float(os.getenv("LEASE_TTL", "30"))
+LEASE_RENEW = float(os.getenv("LEASE_RENEW", "10"))
+# Una shard smette di essere elaborata un po' prima della scadenza del lease,
+# così due repliche non la servono mai insieme anche con orologi leggermente diversi
+LEASE_SAFETY = float(os.getenv("LEASE_SAFETY", "5"))
+
+# Le scritture delle altre repliche arrivano in memoria tramite live_sync; senza il listener
+# sul registro modifiche (SQLite o LIVE_SYNC=0) il registro viene letto ogni REPLICA_SYNC_INTERVAL secondi
+REPLICA_SYNC_INTERVAL = float(os.getenv("REPLICA_SYNC_INTERVAL", "2"))
+
+
+def shard_for(key: int, shards: int = REPLICA_SHARDS) -> int:
+    return int(key) % shards
+
+
+class ShardLeases:
+    """
+    Lease delle shard di chat, salvati nello storage e presi con scritture condizionali.
+    A ogni giro la replica rinnova la propria presenza e i propri lease, ne prende di
+    liberi o scaduti fino alla sua quota (shard divise tra le repliche vive) e rilascia
+    quelli in eccesso, così aggiungendo o togliendo un processo il carico si
+    ridistribuisce da solo in un paio di giri.
+    """
+
+    def __init__(self, shards: int = REPLICA_SHARDS, replica_id: str = REPLICA_ID, url: str = REPLICA_URL,
+                 ttl: float = LEASE_TTL, renew_every: float = LEASE_RENEW):
+        self.shards = shards
+        self.replica_id = replica_id
+        self.url = url
+        self.ttl = ttl
+        self.renew_every = renew_every
+        self._leases: Dict[int, dict] = {}
+        self._owned: Dict[int, float] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.forwarded = 0
+        self.rejected = 0
+
+    def owns(self, shard: int) -> bool:
+        expires = self._owned.get(shard)
+        return expires is not None and expires - LEASE_SAFETY > time.time()
+
+    def owned(self) -> Set[int]:
+        return {shard for shard in self._owned if self.owns(shard)}
+
+    def _owner_url(self, shard: int) -> Optional[str]:
+        lease = self._leases.get(shard)
+        if not lease or lease.get("owner") == self.replica_id or lease.get("expires", 0) <= time.time():
+            return None
+        return lease.get("url") or None
+
+    def _record(self, shard: int, lease: Optional[dict]) -> None:
+        if lease is None:
+            return
+        self._leases[shard] = lease
+        if lease.get("owner") == self.replica_id:
+            self._owned[shard] = lease.get("expires", 0)
+        else:
+            self._owned.pop(shard, None)
+
+    async def _acquire(self, shard: int) -> None:
+        self._record(shard, await storage.acquire_lease(shard, self.replica_id, self.url, self.ttl))
+
+    def _share(self, live: Set[str]) -> int:
+        """Quota di shard di questa replica: le shard avanzate vanno alle prime repliche in ordine di id."""
+        ordered = sorted(live)
+        base, extra = divmod(self.shards, len(ordered))
+        return base + (1 if ordered.index(self.replica_id) < extra else 0)
+
+    async def rebalance(self) -> None:
+        await storage.touch_replica(self.replica_id, self.url, self.ttl)
+        self._leases, replicas = await asyncio.gather(storage.load_leases(), storage.load_replicas())
+        now = time.time()
+        live = {owner for owner, entry in replicas.items() if entry.get("expires", 0) > now}
+        live |= {lease.get("owner") for lease in self._leases.values() if lease.get("expires", 0) > now}
+        live.add(self.replica_id)
+        share = self._share(live)
+
+        mine = sorted(
+            shard for shard, lease in self._leases.items()
+            if lease.get("owner") == self.replica_id and lease.get("expires", 0) > now
+        )
+        # Quota superata (è arrivata un'altra replica): si smette subito di servire le shard in più
+        for shard in mine[share:]:
+            self._owned.pop(shard, None)
+            self._leases.pop(shard, None)
+            await storage.release_lease(shard, self.replica_id)
+        mine = mine[:share]
+
+        free = [
+            shard for shard in range(self.shards)
+            if shard not in mine and self._leases.get(shard, {}).get("expires", 0) <= now
+        ]
+        await asyncio.gather(*(self._acquire(shard) for shard in mine + free[:share - len(mine)]))
+        for shard in list(self._owned):
+            if shard >= self.shards or not self.owns(shard):
+                self._owned.pop(shard, None)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.renew_every)
+            try:
+                await self.rebalance()
+            except Exception as e:
+                logger.error(f"Errore nel rinnovo dei lease: {e}")
+
+    async def start(self) -> None:
+        """Prende la prima quota di shard prima di servire il webhook, poi la rinnova in background."""
+        await self.rebalance()
+        logger.info(f"Replica {self.replica_id}: shard {sorted(self.owned())} di {self.shards}.")
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Rilascia i lease, così le altre repliche prendono subito le shard."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        owned, self._owned = list(self._owned), {}
+        await asyncio.gather(
+            storage.remove_replica(self.replica_id),
+            *(storage.release_lease(shard, self.replica_id) for shard in owned),
+        )
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def forward(self, shard: int, body: bytes) -> Optional[int]:
+        """
+        Inoltra il corpo grezzo di un update alla replica che detiene la shard.
+        Restituisce lo status HTTP della risposta, None se la shard non ha un proprietario raggiungibile.
+        """
+        url = self._owner_url(shard)
+        if url is None:
+            self.rejected += 1
+            return None
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=FORWARD_TIMEOUT))
+        try:
+            async with self._session.post(
+                f"{url.rstrip('/')}/webhook", data=body,
+                headers={FORWARD_HEADER: REPLICA_SECRET, "Content-Type": "application/json"},
+            ) as response:
+                self.forwarded += 1
+                return response.status
+        except Exception as e:
+            self.rejected += 1
+            logger.warning(f"Inoltro dell'update alla shard {shard} ({url}) fallito: {e}")
+            return None
+
+    def metrics(self) -> dict:
+        return {
+            "replica": self.replica_id,
+            "shards": self.shards,
+            "owned": sorted(self.owned()),
+            "forwarded": self.forwarded,
+            "rejected": self.rejected,
+        }
+
+
+shard_leases = ShardLeases()
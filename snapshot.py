@@ -0,0 +1,202 @@
+import os
+import time
+import pickle
+import asyncio
+import logging
+from collections.abc import Mapping
+from typing import Dict, Optional, Tuple
+
+import lz4.frame
+
+import storage
+from firebase_file import change_stamp
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "snapshot.bin")
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "300"))
+# Oltre questa età lo snapshot viene ignorato e il registro modifiche ripulito
+SNAPSHOT_MAX_AGE = float(os.getenv("SNAPSHOT_MAX_AGE", str(7 * 24 * 3600)))
+# Oltre questo numero di percorsi modificati conviene ricaricare tutto
+SNAPSHOT_MAX_CHANGES = int(os.getenv("SNAPSHOT_MAX_CHANGES", "5000"))
+# Margine per gli orologi non sincronizzati tra chi scrive il registro e questo processo
+SNAPSHOT_CLOCK_MARGIN = 60.0
+SNAPSHOT_FORMAT = 5
+
+
+class SnapshotManager:
+    """
+    Snapshot locale di 'group_users' e 'stats' (pickle compresso con lz4).
+    All'avvio si carica lo snapshot e si rileggono da Firebase solo i percorsi
+    comparsi nel registro modifiche dopo la sua versione; se lo snapshot manca,
+    è troppo vecchio o le modifiche sono troppe, si ricarica tutto.
+    Lo snapshot viene riscritto periodicamente e allo spegnimento.
+    """
+
+    def __init__(self, path: str = SNAPSHOT_PATH, interval: float = SNAPSHOT_INTERVAL,
+                 max_age: float = SNAPSHOT_MAX_AGE, max_changes: int = SNAPSHOT_MAX_CHANGES):
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self.max_changes = max_changes
+        self._bot_data: Optional[dict] = None
+        self._task: Optional[asyncio.Task] = None
+        # Salvataggi ed eliminazione dello snapshot non si sovrappongono
+        self._lock = asyncio.Lock()
+        # Versione del registro da cui i dati caricati potrebbero non essere aggiornati:
+        # da qui la sincronizzazione live rilegge le modifiche
+        self.loaded_version: Optional[str] = None
+
+    def _read(self) -> Optional[dict]:
+        try:
+            with open(self.path, "rb") as f:
+                snapshot = pickle.loads(lz4.frame.decompress(f.read()))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Snapshot {self.path} illeggibile, verrà ignorato: {e}")
+            return None
+        if not isinstance(snapshot, dict) or snapshot.get("format") != SNAPSHOT_FORMAT:
+            logger.warning(f"Snapshot {self.path} in un formato non supportato, verrà ignorato.")
+            return None
+        return snapshot
+
+    def _write(self, raw: bytes) -> None:
+        # Scrittura atomica: un crash a metà non lascia uno snapshot troncato
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(lz4.frame.compress(raw))
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    async def _full_load() -> Tuple[Dict[int, Dict[int, dict]], Dict[int, dict]]:
+        group_users, stats = await asyncio.gather(storage.load_group_users(), storage.load_stats())
+        return group_users, stats
+
+    async def load(self) -> Tuple[Dict[int, Dict[int, dict]], Dict[int, dict]]:
+        """Restituisce (group_users, stats), dallo snapshot più le modifiche successive se possibile."""
+        self.loaded_version = change_stamp(time.time() - SNAPSHOT_CLOCK_MARGIN)
+        snapshot = await asyncio.to_thread(self._read)
+        if snapshot is None:
+            return await self._full_load()
+        if time.time() - snapshot["saved_at"] > self.max_age:
+            logger.info("Snapshot troppo vecchio, caricamento completo da Firebase.")
+            return await self._full_load()
+
+        changes = await storage.load_changes_since(snapshot["version"])
+        if changes is None:
+            return await self._full_load()
+
+        user_paths = set()
+        stats_paths = set()
+        for entry in changes.values():
+            if not isinstance(entry, dict):
+                continue
+            if entry.get("completo"):
+                logger.info(f"Nodo '{entry.get('nodo')}' riscritto per intero, caricamento completo.")
+                return await self._full_load()
+            target = user_paths if entry.get("nodo") == "group_users" else stats_paths
+            target.update(entry.get("percorsi") or [])
+        if len(user_paths) + len(stats_paths) > self.max_changes:
+            logger.info(f"{len(user_paths) + len(stats_paths)} modifiche dallo snapshot, caricamento completo.")
+            return await self._full_load()
+
+        group_users: Dict[int, Dict[int, dict]] = snapshot["group_users"]
+        stats: Dict[int, dict] = snapshot["stats"]
+        await asyncio.gather(
+            *(self._refresh_user(group_users, path) for path in user_paths),
+            *(self._refresh_stats(stats, path) for path in stats_paths),
+        )
+        logger.info(
+            f"Snapshot {snapshot['version']} caricato, riallineati {len(user_paths)} utenti "
+            f"e {len(stats_paths)} statistiche da Firebase."
+        )
+        return group_users, stats
+
+    @staticmethod
+    async def _refresh_user(group_users: Dict[int, Dict[int, dict]], path: str) -> None:
+        try:
+            parts = path.split("/")
+            chat_id, user_id = int(parts[0]), int(parts[1])
+        except (ValueError, IndexError):
+            return
+        data = await storage.load_user_data(chat_id, user_id)
+        if isinstance(data, Mapping):
+            group_users.setdefault(chat_id, {})[user_id] = data
+
+    @staticmethod
+    async def _refresh_stats(stats: Dict[int, dict], path: str) -> None:
+        try:
+            user_id = int(path.split("/")[0])
+        except ValueError:
+            return
+        data = await storage.load_stats_entry(user_id)
+        if isinstance(data, Mapping):
+            stats[user_id] = data
+
+    async def save(self) -> None:
+        """Scrive lo snapshot dei dati in bot_data."""
+        if self._bot_data is None:
+            return
+        async with self._lock:
+            await self._save()
+
+    async def _save(self) -> None:
+        now = time.time()
+        # La serializzazione avviene sul loop, quindi vede uno stato coerente dei dict;
+        # compressione e scrittura su disco vanno in un thread
+        raw = pickle.dumps({
+            "format": SNAPSHOT_FORMAT,
+            "version": change_stamp(now - SNAPSHOT_CLOCK_MARGIN),
+            "saved_at": now,
+            "group_users": self._bot_data.get("group_users", {}),
+            "stats": self._bot_data.get("stats", {}),
+        }, protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            await asyncio.to_thread(self._write, raw)
+            logger.debug(f"Snapshot salvato in {self.path} ({len(raw)} byte non compressi).")
+        except OSError as e:
+            logger.error(f"Errore nel salvataggio dello snapshot: {e}")
+
+    async def discard(self) -> None:
+        """
+        Elimina lo snapshot su disco, quando si scopre che non rispecchia più lo storage
+        (modifiche fatte fuori dal registro): il prossimo avvio ricarica tutto, a meno
+        che nel frattempo non venga salvato uno snapshot nuovo dalla memoria corretta.
+        """
+        async with self._lock:
+            try:
+                await asyncio.to_thread(os.remove, self.path)
+                logger.info(f"Snapshot {self.path} eliminato.")
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Errore nell'eliminazione dello snapshot: {e}")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.save()
+                await storage.prune_changes(change_stamp(time.time() - self.max_age))
+            except Exception as e:
+                logger.error(f"Errore nel salvataggio periodico dello snapshot: {e}")
+
+    def start(self, bot_data: dict) -> None:
+        self._bot_data = bot_data
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Ferma il task periodico e salva un ultimo snapshot."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.save()
+
+
+snapshot_manager = SnapshotManager()
@@ -0,0 +1,865 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SQLITE_PATH = os.getenv("SQLITE_PATH", "feedback.db")
+
+logger = logging.getLogger(__name__)
+
+# Stesse funzioni di firebase_file, su un database SQLite locale.
+# Ogni thread del pool di storage usa la propria connessione; il journal WAL
+# permette letture concorrenti mentre un'altra connessione scrive.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS admins (
+    user_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS users (
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    username TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (chat_id, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_users_username ON users (chat_id, username COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS stats (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stats_history (
+    user_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    feedback_fatti INTEGER NOT NULL DEFAULT 0,
+    feedback_ricevuti INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, date)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_stats_history_date ON stats_history (date);
+CREATE TABLE IF NOT EXISTS group_daily (
+    date TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS group_stats (
+    key TEXT PRIMARY KEY,
+    value TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS pending_feedback (
+    request_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS changes (
+    version TEXT PRIMARY KEY,
+    nodo TEXT NOT NULL,
+    percorsi TEXT,
+    completo INTEGER NOT NULL DEFAULT 0,
+    origine TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS applied_writes (
+    marker TEXT PRIMARY KEY,
+    stamp TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS leases (
+    shard INTEGER PRIMARY KEY,
+    owner TEXT NOT NULL,
+    url TEXT,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS replicas (
+    owner TEXT PRIMARY KEY,
+    url TEXT,
+    expires REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def initialize() -> None:
+    """Crea le tabelle se non esistono e abilita il journal WAL."""
+    global _initialized
+    with _init_lock:
+        if _initialized:
+            return
+        conn = sqlite3.connect(SQLITE_PATH)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            # Database creati prima dell'introduzione delle repliche
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(changes)")}
+            if "origine" not in columns:
+                conn.execute("ALTER TABLE changes ADD COLUMN origine TEXT")
+            # Marcatori del formato precedente, con la versione all'inizio della chiave
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(applied_writes)")}
+            if "stamp" not in columns:
+                conn.execute("ALTER TABLE applied_writes ADD COLUMN stamp TEXT NOT NULL DEFAULT ''")
+                conn.execute("UPDATE applied_writes SET stamp = substr(marker, 1, 13)")
+            conn.commit()
+        finally:
+            conn.close()
+        _initialized = True
+        logger.info(f"Database SQLite inizializzato in {SQLITE_PATH}.")
+
+
+def _conn() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        initialize()
+        conn = sqlite3.connect(SQLITE_PATH, timeout=10)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+    return conn
+
+
+def _dumps(data) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def _is_increment(value) -> bool:
+    return isinstance(value, dict) and isinstance(value.get(".sv"), dict) and "increment" in value[".sv"]
+
+
+def _set_path(target: dict, parts: List[str], value) -> None:
+    """
+    Imposta value al percorso parts dentro target, come farebbe un update multi-path.
+    Le liste attraversate diventano dict con indici stringa (come gli array di Firebase)
+    e gli incrementi lato server vengono sommati al valore corrente.
+    """
+    for part in parts[:-1]:
+        child = target.get(part)
+        if isinstance(child, list):
+            child = target[part] = {str(i): v for i, v in enumerate(child) if v is not None}
+        elif not isinstance(child, dict):
+            child = target[part] = {}
+        target = child
+    if value is None:
+        target.pop(parts[-1], None)
+    elif _is_increment(value):
+        current = target.get(parts[-1])
+        target[parts[-1]] = (current if isinstance(current, (int, float)) else 0) + value[".sv"]["increment"]
+    else:
+        target[parts[-1]] = value
+
+
+def _log_change(conn: sqlite3.Connection, node: str, paths: Optional[Iterable[str]]) -> None:
+    # Import locale: firebase_file inizializza l'SDK solo al primo utilizzo
+    from firebase_file import change_stamp, REPLICA_ID
+    conn.execute(
+        "INSERT INTO changes (version, nodo, percorsi, completo, origine) VALUES (?, ?, ?, ?, ?)",
+        (f"{change_stamp()}-{uuid.uuid4().hex[:8]}", node,
+         None if paths is None else _dumps(list(paths)), 1 if paths is None else 0, REPLICA_ID),
+    )
+
+
+def load_admin_ids() -> Set[int]:
+    """
+    Carica gli ID degli admin dalla tabella 'admins'.
+    """
+    try:
+        admins = {row[0] for row in _conn().execute("SELECT user_id FROM admins")}
+    except Exception as e:
+        logger.error(f"Errore load_admin_ids da SQLite: {e}")
+        admins = set()
+    if not admins:
+        logger.warning("Nessun admin trovato in SQLite, la lista admin è vuota.")
+    return admins
+
+
+def save_admin_ids(admin_ids: Set[int]) -> bool:
+    """
+    Sostituisce la lista degli admin nella tabella 'admins'.
+    Restituisce False se la scrittura non è riuscita.
+    """
+    try:
+        conn = _conn()
+        with conn:
+            conn.execute("DELETE FROM admins")
+            conn.executemany("INSERT INTO admins (user_id) VALUES (?)", [(int(uid),) for uid in admin_ids])
+        return True
+    except Exception as e:
+        logger.error(f"Errore save_admin_ids su SQLite: {e}")
+        return False
+
+
+def load_group_users() -> Dict[int, Dict[int, dict]]:
+    """
+    Carica tutti gli utenti dalla tabella 'users', raggruppati per chat.
+    """
+    try:
+        result: Dict[int, Dict[int, dict]] = {}
+        for chat_id, user_id, data in _conn().execute("SELECT chat_id, user_id, data FROM users"):
+            result.setdefault(chat_id, {})[user_id] = json.loads(data)
+        return result
+    except Exception as e:
+        logger.error(f"Errore load_group_users da SQLite: {e}")
+        return {}
+
+
+def _user_rows(items: Iterable[Tuple[int, int, dict]]) -> List[tuple]:
+    return [(chat_id, user_id, info.get("username"), _dumps(info)) for chat_id, user_id, info in items]
+
+
+def save_group_users(group_users: Dict[int, Dict[int, dict]]) -> None:
+    """
+    Sostituisce tutti gli utenti nella tabella 'users' in un'unica transazione.
+    """
+    try:
+        conn = _conn()
+        with conn:
+            conn.execute("DELETE FROM users")
+            conn.executemany(
+                "INSERT INTO users (chat_id, user_id, username, data) VALUES (?, ?, ?, ?)",
+                _user_rows(
+                    (int(chat_id), int(uid), info)
+                    for chat_id, users in group_users.items()
+                    for uid, info in users.items()
+                ),
+            )
+            _log_change(conn, 'group_users', None)
+    except Exception as e:
+        logger.error(f"Errore save_group_users su SQLite: {e}")
+
+
+def _write_user_updates(conn: sqlite3.Connection, updates: Dict[str, dict]) -> None:
+    # Stato dei record toccati nell'update: più percorsi dello stesso utente si sommano
+    rows: Dict[Tuple[int, int], Optional[dict]] = {}
+    for path, value in updates.items():
+        parts = path.strip("/").split("/")
+        key = (int(parts[0]), int(parts[1]))
+        if len(parts) == 2:
+            rows[key] = value
+            continue
+        info = rows.get(key)
+        if info is None:
+            row = conn.execute("SELECT data FROM users WHERE chat_id = ? AND user_id = ?", key).fetchone()
+            info = rows[key] = json.loads(row[0]) if row else {}
+        _set_path(info, parts[2:], value)
+    deleted = [key for key, info in rows.items() if info is None]
+    if deleted:
+        conn.executemany("DELETE FROM users WHERE chat_id = ? AND user_id = ?", deleted)
+    conn.executemany(
+        "INSERT OR REPLACE INTO users (chat_id, user_id, username, data) VALUES (?, ?, ?, ?)",
+        _user_rows((chat_id, user_id, info) for (chat_id, user_id), info in rows.items() if info is not None),
+    )
+    _log_change(conn, 'group_users', updates)
+
+
+def _claim_marker(conn: sqlite3.Connection, marker: Optional[str]) -> bool:
+    """Registra il marcatore nella transazione corrente; False se c'era già (scrittura già applicata)."""
+    if not marker:
+        return True
+    from firebase_file import change_stamp
+    return conn.execute(
+        "INSERT OR IGNORE INTO applied_writes (marker, stamp) VALUES (?, ?)", (marker, change_stamp())
+    ).rowcount == 1
+
+
+def update_group_users(updates: Dict[str, dict], marker: Optional[str] = None) -> bool:
+    """
+    Applica un aggiornamento multi-path agli utenti, in un'unica transazione.
+    Le chiavi sono percorsi nella forma '{chat_id}/{user_id}' (o più profondi).
+    Con un marcatore già registrato la scrittura non viene ripetuta.
+    Restituisce True se la scrittura è andata a buon fine.
+    """
+    if not updates:
+        return True
+    try:
+        conn = _conn()
+        with conn:
+            if _claim_marker(conn, marker):
+                _write_user_updates(conn, updates)
+        return True
+    except Exception as e:
+        logger.error(f"Errore update_group_users su SQLite: {e}")
+        return False
+
+
+def _load_history(conn: sqlite3.Connection, user_id: Optional[int] = None) -> Dict[int, Dict[str, dict]]:
+    """Storico giornaliero nel vecchio formato a righe, letto solo per gli utenti non ancora migrati."""
+    query = "SELECT user_id, date, feedback_fatti, feedback_ricevuti FROM stats_history"
+    params: tuple = ()
+    if user_id is not None:
+        query += " WHERE user_id = ?"
+        params = (user_id,)
+    history: Dict[int, Dict[str, dict]] = {}
+    for uid, date, fatti, ricevuti in conn.execute(query, params):
+        history.setdefault(uid, {})[date] = {"feedback_fatti": fatti, "feedback_ricevuti": ricevuti}
+    return history
+
+
+def _write_user_stats(conn: sqlite3.Connection, user_id: int, data: dict) -> None:
+    """
+    Scrive le stats di un utente. Lo storico (già compatto, a colonne) resta nel JSON;
+    le eventuali righe del vecchio formato in stats_history vengono rimosse.
+    """
+    conn.execute(
+        "INSERT OR REPLACE INTO stats (user_id, username, data) VALUES (?, ?, ?)",
+        (user_id, data.get("username"), _dumps(data)),
+    )
+    conn.execute("DELETE FROM stats_history WHERE user_id = ?", (user_id,))
+
+
+def load_stats() -> Dict[int, dict]:
+    """
+    Carica le statistiche di tutti gli utenti, con lo storico.
+    """
+    try:
+        conn = _conn()
+        history = _load_history(conn)
+        result: Dict[int, dict] = {}
+        for user_id, data in conn.execute("SELECT user_id, data FROM stats"):
+            user_stats = json.loads(data)
+            if "history" not in user_stats:
+                user_stats["history"] = history.get(user_id, {})
+            result[user_id] = user_stats
+        return result
+    except Exception as e:
+        logger.error(f"Errore load_stats da SQLite: {e}")
+        return {}
+
+
+def save_stats(stats: Dict[int, dict]) -> None:
+    """
+    Sostituisce tutte le statistiche in un'unica transazione.
+    """
+    try:
+        conn = _conn()
+        with conn:
+            conn.execute("DELETE FROM stats")
+            conn.execute("DELETE FROM stats_history")
+            for uid, data in stats.items():
+                _write_user_stats(conn, int(uid), data)
+            _log_change(conn, 'stats', None)
+    except Exception as e:
+        logger.error(f"Errore save_stats su SQLite: {e}")
+
+
+def _load_user_stats(conn: sqlite3.Connection, user_id: int) -> Optional[dict]:
+    row = conn.execute("SELECT data FROM stats WHERE user_id = ?", (user_id,)).fetchone()
+    if row is None:
+        return None
+    user_stats = json.loads(row[0])
+    if "history" not in user_stats:
+        user_stats["history"] = _load_history(conn, user_id).get(user_id, {})
+    return user_stats
+
+
+def _write_stats_updates(conn: sqlite3.Connection, updates: Dict[str, dict]) -> None:
+    for path, value in updates.items():
+        parts = path.strip("/").split("/")
+        user_id = int(parts[0])
+        if len(parts) > 1:
+            user_stats = _load_user_stats(conn, user_id) or {}
+            _set_path(user_stats, parts[1:], value)
+            value = user_stats
+        if value is None:
+            conn.execute("DELETE FROM stats WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM stats_history WHERE user_id = ?", (user_id,))
+        else:
+            _write_user_stats(conn, user_id, value)
+    _log_change(conn, 'stats', updates)
+
+
+def load_stats_entry(user_id: int) -> Optional[dict]:
+    """
+    Carica le statistiche di un singolo utente. Restituisce None se assenti o in caso di errore.
+    """
+    try:
+        return _load_user_stats(_conn(), int(user_id))
+    except Exception as e:
+        logger.error(f"Errore load_stats_entry per l'utente {user_id}: {e}")
+        return None
+
+
+def load_changes_since(version: str) -> Optional[Dict[str, dict]]:
+    """
+    Carica le voci del registro modifiche con versione >= version.
+    Restituisce None in caso di errore, per distinguerlo da "nessuna modifica".
+    """
+    try:
+        result: Dict[str, dict] = {}
+        rows = _conn().execute(
+            "SELECT version, nodo, percorsi, completo, origine FROM changes WHERE version >= ? ORDER BY version",
+            (version,),
+        )
+        for key, node, paths, complete, origin in rows:
+            entry = {"nodo": node, "completo": True} if complete else {"nodo": node, "percorsi": json.loads(paths)}
+            entry["origine"] = origin
+            result[key] = entry
+        return result
+    except Exception as e:
+        logger.error(f"Errore load_changes_since da SQLite: {e}")
+        return None
+
+
+def prune_changes(before: str) -> bool:
+    """
+    Elimina dal registro modifiche (e dai marcatori delle scritture) le voci con
+    versione precedente a before. Restituisce True se l'operazione è andata a buon fine.
+    """
+    try:
+        conn = _conn()
+        with conn:
+            conn.execute("DELETE FROM changes WHERE version < ?", (before,))
+            conn.execute("DELETE FROM applied_writes WHERE stamp < ?", (before,))
+        return True
+    except Exception as e:
+        logger.error(f"Errore prune_changes su SQLite: {e}")
+        return False
+
+
+def load_group_stats() -> dict:
+    """
+    Carica i contatori aggregati del gruppo.
+    """
+    try:
+        conn = _conn()
+        group_stats = {key: json.loads(value) for key, value in conn.execute("SELECT key, value FROM group_stats")}
+        daily = dict(conn.execute("SELECT date, count FROM group_daily"))
+        if daily:
+            group_stats["daily"] = daily
+        return group_stats
+    except Exception as e:
+        logger.error(f"Errore load_group_stats da SQLite: {e}")
+        return {}
+
+
+def _write_group_stats(conn: sqlite3.Connection, updates: Dict[str, object]) -> None:
+    for path, value in updates.items():
+        parts = path.strip("/").split("/")
+        if parts[0] == "daily":
+            if len(parts) == 1:
+                conn.execute("DELETE FROM group_daily")
+                conn.executemany(
+                    "INSERT INTO group_daily (date, count) VALUES (?, ?)", list((value or {}).items())
+                )
+            elif value is None:
+                conn.execute("DELETE FROM group_daily WHERE date = ?", (parts[1],))
+            elif _is_increment(value):
+                conn.execute(
+                    "INSERT INTO group_daily (date, count) VALUES (?, ?) "
+                    "ON CONFLICT(date) DO UPDATE SET count = count + excluded.count",
+                    (parts[1], value[".sv"]["increment"]),
+                )
+            else:
+                conn.execute("INSERT OR REPLACE INTO group_daily (date, count) VALUES (?, ?)", (parts[1], value))
+            continue
+        if len(parts) > 1:
+            row = conn.execute("SELECT value FROM group_stats WHERE key = ?", (parts[0],)).fetchone()
+            current = json.loads(row[0]) if row and row[0] else {}
+            _set_path(current, parts[1:], value)
+            value = current
+        if value is None:
+            conn.execute("DELETE FROM group_stats WHERE key = ?", (parts[0],))
+        else:
+            conn.execute("INSERT OR REPLACE INTO group_stats (key, value) VALUES (?, ?)", (parts[0], _dumps(value)))
+
+
+def save_group_stats(group_stats: dict) -> None:
+    """
+    Sostituisce i contatori aggregati del gruppo.
+    """
+    try:
+        conn = _conn()
+        with conn:
+            conn.execute("DELETE FROM group_stats")
+            conn.execute("DELETE FROM group_daily")
+            _write_group_stats(conn, group_stats)
+    except Exception as e:
+        logger.error(f"Errore save_group_stats su SQLite: {e}")
+
+
+def commit_accepted_feedback(request_id: str, marker: str, users: Dict[str, dict], stats: Dict[str, dict],
+                             group_stats: Dict[str, object]) -> bool:
+    """
+    Salva un feedback accettato in un'unica transazione: utenti coinvolti, loro
+    statistiche, contatori del gruppo ed eliminazione del feedback in sospeso.
+    Un commit con un marcatore già registrato non viene ripetuto.
+    Restituisce True se la scrittura è andata a buon fine.
+    """
+    try:
+        conn = _conn()
+        with conn:
+            if not _claim_marker(conn, marker):
+                return True
+            if users:
+                _write_user_updates(conn, users)
+            if stats:
+                _write_stats_updates(conn, stats)
+            _write_group_stats(conn, group_stats)
+            conn.execute("DELETE FROM pending_feedback WHERE request_id = ?", (str(request_id),))
+        return True
+    except Exception as e:
+        logger.error(f"Errore commit del feedback {request_id} su SQLite: {e}")
+        return False
+
+
+def is_write_applied(marker: str) -> Optional[bool]:
+    """True se la scrittura con questo marcatore è stata applicata, False se no, None in caso di errore."""
+    try:
+        return _conn().execute("SELECT 1 FROM applied_writes WHERE marker = ?", (marker,)).fetchone() is not None
+    except Exception as e:
+        logger.error(f"Errore is_write_applied per {marker}: {e}")
+        return None
+
+
+def load_pending_feedback_entry(request_id: str) -> Optional[dict]:
+    """
+    Carica una singola voce di feedback in sospeso. Restituisce None se assente o in caso di errore.
+    """
+    try:
+        row = _conn().execute("SELECT data FROM pending_feedback WHERE request_id = ?", (str(request_id),)).fetchone()
+        return json.loads(row[0]) if row else None
+    except Exception as e:
+        logger.error(f"Errore load_pending_feedback_entry per {request_id}: {e}")
+        return None
+
+
+def load_pending_feedback() -> Dict[str, dict]:
+    """
+    Carica i feedback in sospeso.
+    """
+    try:
+        return {rid: json.loads(data) for rid, data in _conn().execute("SELECT request_id, data FROM pending_feedback")}
+    except Exception as e:
+        logger.error(f"Errore load_pending_feedback da SQLite: {e}")
+        return {}
+
+
+def save_pending_feedback(pending_feedback: Dict[str, dict]) -> None:
+    """
+    Sostituisce tutti i feedback in sospeso.
+    """
+    try:
+        conn = _conn()
+        with conn:
+            conn.execute("DELETE FROM pending_feedback")
+            conn.executemany(
+                "INSERT INTO pending_feedback (request_id, data) VALUES (?, ?)",
+                [(str(rid), _dumps(data)) for rid, data in pending_feedback.items()],
+            )
+    except Exception as e:
+        logger.error(f"Errore save_pending_feedback su SQLite: {e}")
+
+
+def set_pending_feedback_entry(request_id: str, data: dict) -> bool:
+    """
+    Salva una specifica voce di feedback in sospeso.
+    Restituisce True se la scrittura è andata a buon fine.
+    """
+    try:
+        conn = _conn()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO pending_feedback (request_id, data) VALUES (?, ?)",
+                (str(request_id), _dumps(data)),
+            )
+        return True
+    except Exception as e:
+        logger.error(f"Errore set_pending_feedback_entry su SQLite: {e}")
+        return False
+
+
+def update_pending_feedback_entry(request_id: str, fields: dict) -> bool:
+    """
+    Aggiorna alcuni campi di una voce di feedback in sospeso.
+    Restituisce True se la scrittura è andata a buon fine.
+    """
+    try:
+        conn = _conn()
+        with conn:
+            row = conn.execute("SELECT data FROM pending_feedback WHERE request_id = ?", (str(request_id),)).fetchone()
+            data = json.loads(row[0]) if row else {}
+            data.update(fields)
+            conn.execute(
+                "INSERT OR REPLACE INTO pending_feedback (request_id, data) VALUES (?, ?)",
+                (str(request_id), _dumps(data)),
+            )
+        return True
+    except Exception as e:
+        logger.error(f"Errore update_pending_feedback_entry su SQLite: {e}")
+        return False
+
+
+def delete_pending_feedback_entry(request_id: str) -> bool:
+    """
+    Elimina una specifica voce di feedback in sospeso.
+    Restituisce True se l'eliminazione è andata a buon fine.
+    """
+    try:
+        conn = _conn()
+        with conn:
+            conn.execute("DELETE FROM pending_feedback WHERE request_id = ?", (str(request_id),))
+        return True
+    except Exception as e:
+        logger.error(f"Errore delete_pending_feedback_entry su SQLite: {e}")
+        return False
+
+
+def load_user_data(chat_id: int, user_id: int) -> Optional[Dict]:
+    """
+    Carica i dati di un utente specifico.
+    Restituisce i dati dell'utente se esiste, altrimenti None.
+    """
+    try:
+        row = _conn().execute(
+            "SELECT data FROM users WHERE chat_id = ? AND user_id = ?", (int(chat_id), int(user_id))
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+    except Exception as e:
+        logger.error(f"Errore nel caricamento dei dati per l'utente {user_id} nella chat {chat_id}: {e}")
+        return None
+
+
+# Primitive per backup.py, con gli stessi percorsi di Firebase: a differenza delle altre
+# funzioni propagano le eccezioni, così un backup o un ripristino a metà non sembra mai riuscito.
+
+BACKUP_NODES = ("admin_ids", "group_users", "stats", "group_stats", "pending_feedback")
+
+
+def list_keys(path: str) -> List[str]:
+    """Chiavi figlie della radice, di 'group_users', di 'group_users/{chat}' o di 'stats'."""
+    path = path.strip("/")
+    if not path:
+        return list(BACKUP_NODES)
+    if path == "group_users":
+        return [str(row[0]) for row in _conn().execute("SELECT DISTINCT chat_id FROM users ORDER BY chat_id")]
+    parts = path.split("/")
+    if parts[0] == "group_users" and len(parts) == 2:
+        rows = _conn().execute("SELECT user_id FROM users WHERE chat_id = ? ORDER BY user_id", (int(parts[1]),))
+        return [str(row[0]) for row in rows]
+    if path == "stats":
+        return [str(row[0]) for row in _conn().execute("SELECT user_id FROM stats ORDER BY user_id")]
+    raise ValueError(f"Lettura shallow non supportata per '{path}'.")
+
+
+def load_page(path: str, start_after: Optional[str], limit: int) -> Dict[str, object]:
+    """
+    Fino a limit figli di 'group_users/{chat}', 'stats' o 'pending_feedback', in ordine
+    di chiave, a partire da quello dopo start_after.
+    """
+    conn = _conn()
+    parts = path.strip("/").split("/")
+    if parts[0] == "group_users" and len(parts) == 2:
+        after = int(start_after) if start_after is not None else None
+        rows = conn.execute(
+            "SELECT user_id, data FROM users WHERE chat_id = ? AND (? IS NULL OR user_id > ?) "
+            "ORDER BY user_id LIMIT ?",
+            (int(parts[1]), after, after, limit),
+        )
+        return {str(user_id): json.loads(data) for user_id, data in rows}
+    if parts == ["stats"]:
+        after = int(start_after) if start_after is not None else None
+        rows = conn.execute(
+            "SELECT user_id, data FROM stats WHERE (? IS NULL OR user_id > ?) ORDER BY user_id LIMIT ?",
+            (after, after, limit),
+        ).fetchall()
+        page = {}
+        for user_id, data in rows:
+            user_stats = json.loads(data)
+            if "history" not in user_stats:
+                user_stats["history"] = _load_history(conn, user_id).get(user_id, {})
+            page[str(user_id)] = user_stats
+        return page
+    if parts == ["pending_feedback"]:
+        rows = conn.execute(
+            "SELECT request_id, data FROM pending_feedback WHERE (? IS NULL OR request_id > ?) "
+            "ORDER BY request_id LIMIT ?",
+            (start_after, start_after, limit),
+        )
+        return {request_id: json.loads(data) for request_id, data in rows}
+    raise ValueError(f"Lettura a pagine non supportata per '{path}'.")
+
+
+def load_path(path: str) -> object:
+    """Valore di un singolo percorso (None se assente)."""
+    conn = _conn()
+    parts = path.strip("/").split("/")
+    if parts == ["admin_ids"]:
+        return {"admin_ids": [row[0] for row in conn.execute("SELECT user_id FROM admins ORDER BY user_id")]}
+    if parts == ["group_stats"]:
+        group_stats = {key: json.loads(value) for key, value in conn.execute("SELECT key, value FROM group_stats")}
+        daily = dict(conn.execute("SELECT date, count FROM group_daily"))
+        if daily:
+            group_stats["daily"] = daily
+        return group_stats or None
+    if parts[0] == "group_users" and len(parts) == 3:
+        row = conn.execute(
+            "SELECT data FROM users WHERE chat_id = ? AND user_id = ?", (int(parts[1]), int(parts[2]))
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+    if parts[0] == "stats" and len(parts) == 2:
+        return _load_user_stats(conn, int(parts[1]))
+    if parts[0] == "pending_feedback" and len(parts) == 2:
+        row = conn.execute("SELECT data FROM pending_feedback WHERE request_id = ?", (parts[1],)).fetchone()
+        return json.loads(row[0]) if row else None
+    raise ValueError(f"Lettura non supportata per '{path}'.")
+
+
+def restore_batch(updates: Dict[str, object]) -> None:
+    """
+    Scrive un blocco di percorsi dalla radice (come un update multi-path di Firebase)
+    in un'unica transazione. Un nodo con valore None viene svuotato.
+    """
+    users: Dict[str, object] = {}
+    stats: Dict[str, object] = {}
+    group_stats: Dict[str, object] = {}
+    conn = _conn()
+    with conn:
+        for path, value in updates.items():
+            node, _, rest = path.strip("/").partition("/")
+            if node == "group_users":
+                if rest:
+                    users[rest] = value
+                else:
+                    conn.execute("DELETE FROM users")
+                    _log_change(conn, 'group_users', None)
+                    if value:
+                        users.update({f"{chat_id}/{uid}": info for chat_id, chat in value.items() for uid, info in chat.items()})
+            elif node == "stats":
+                if rest:
+                    stats[rest] = value
+                else:
+                    conn.execute("DELETE FROM stats")
+                    conn.execute("DELETE FROM stats_history")
+                    _log_change(conn, 'stats', None)
+                    if value:
+                        stats.update({str(uid): data for uid, data in value.items()})
+            elif node == "group_stats":
+                if rest:
+                    group_stats[rest] = value
+                else:
+                    conn.execute("DELETE FROM group_stats")
+                    conn.execute("DELETE FROM group_daily")
+                    group_stats.update(value or {})
+            elif node == "pending_feedback":
+                if not rest:
+                    conn.execute("DELETE FROM pending_feedback")
+                    entries = (value or {}).items()
+                else:
+                    entries = [(rest, value)]
+                for request_id, data in entries:
+                    if data is None:
+                        conn.execute("DELETE FROM pending_feedback WHERE request_id = ?", (str(request_id),))
+                    else:
+                        conn.execute(
+                            "INSERT OR REPLACE INTO pending_feedback (request_id, data) VALUES (?, ?)",
+                            (str(request_id), _dumps(data)),
+                        )
+            elif node == "admin_ids":
+                conn.execute("DELETE FROM admins")
+                admin_ids = (value or {}).get("admin_ids") or []
+                conn.executemany("INSERT INTO admins (user_id) VALUES (?)", [(int(uid),) for uid in admin_ids])
+            else:
+                logger.warning(f"Percorso '{path}' non gestito da SQLite, ignorato nel ripristino.")
+        if users:
+            _write_user_updates(conn, users)
+        if stats:
+            _write_stats_updates(conn, stats)
+        if group_stats:
+            _write_group_stats(conn, group_stats)
+
+
+def load_leases() -> Dict[int, dict]:
+    """
+    Carica i lease delle shard ({shard: {owner, url, expires}}).
+    """
+    try:
+        rows = _conn().execute("SELECT shard, owner, url, expires FROM leases")
+        return {shard: {"owner": owner, "url": url, "expires": expires} for shard, owner, url, expires in rows}
+    except Exception as e:
+        logger.error(f"Errore load_leases da SQLite: {e}")
+        return {}
+
+
+def acquire_lease(shard: int, owner: str, url: str, ttl: float) -> Optional[dict]:
+    """
+    Prende o rinnova il lease di una shard con un'unica scrittura condizionale: riesce
+    solo se il lease è libero, scaduto o già di owner. Restituisce il lease risultante
+    (di owner se acquisito, altrimenti quello di chi lo detiene), None in caso di errore.
+    """
+    try:
+        conn = _conn()
+        now = time.time()
+        with conn:
+            conn.execute(
+                "INSERT INTO leases (shard, owner, url, expires) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(shard) DO UPDATE SET owner = excluded.owner, url = excluded.url, expires = excluded.expires "
+                "WHERE leases.owner = excluded.owner OR leases.expires <= ?",
+                (int(shard), owner, url, now + ttl, now),
+            )
+            row = conn.execute("SELECT owner, url, expires FROM leases WHERE shard = ?", (int(shard),)).fetchone()
+        return {"owner": row[0], "url": row[1], "expires": row[2]} if row else None
+    except Exception as e:
+        logger.error(f"Errore acquire_lease della shard {shard}: {e}")
+        return None
+
+
+def release_lease(shard: int, owner: str) -> bool:
+    """
+    Rilascia il lease di una shard, solo se appartiene ancora a owner.
+    Restituisce True se l'operazione è andata a buon fine.
+    """
+    try:
+        conn = _conn()
+        with conn:
+            conn.execute("DELETE FROM leases WHERE shard = ? AND owner = ?", (int(shard), owner))
+        return True
+    except Exception as e:
+        logger.error(f"Errore release_lease della shard {shard}: {e}")
+        return False
+
+
+def touch_replica(owner: str, url: str, ttl: float) -> bool:
+    """
+    Registra (o rinnova) la presenza di una replica, valida per ttl secondi.
+    Restituisce True se la scrittura è andata a buon fine.
+    """
+    try:
+        conn = _conn()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO replicas (owner, url, expires) VALUES (?, ?, ?)",
+                (owner, url, time.time() + ttl),
+            )
+        return True
+    except Exception as e:
+        logger.error(f"Errore touch_replica per {owner}: {e}")
+        return False
+
+
+def load_replicas() -> Dict[str, dict]:
+    """
+    Carica le repliche registrate ({owner: {url, expires}}), anche quelle scadute.
+    """
+    try:
+        rows = _conn().execute("SELECT owner, url, expires FROM replicas")
+        return {owner: {"url": url, "expires": expires} for owner, url, expires in rows}
+    except Exception as e:
+        logger.error(f"Errore load_replicas da SQLite: {e}")
+        return {}
+
+
+def remove_replica(owner: str) -> bool:
+    """
+    Cancella la registrazione di una replica (allo spegnimento).
+    Restituisce True se l'operazione è andata a buon fine.
+    """
+    try:
+        conn = _conn()
+        with conn:
+            conn.execute("DELETE FROM replicas WHERE owner = ?", (owner,))
+        return True
+    except Exception as e:
+        logger.error(f"Errore remove_replica per {owner}: {e}")
+        return False
@@ -2,15 +2,17 @@ import os
 import json
 import datetime
 import logging
-from typing import Dict
-from io import BytesIO
-import matplotlib.pyplot as plt
+from typing import Dict, Optional
 from telegram import Update
 from telegram.ext import ContextTypes
 from telegram.helpers import escape_markdown
 from telegram.constants import ParseMode
 from utils import restricted
-from firebase_file import save_stats, load_stats, load_group_users
+import storage
+from chart_renderer import chart_renderer, render_trend_png, render_totale_png
+from chart_cache import chart_cache, GROUP_CHART
+from records import StatsRecord
+from history import StatsHistory
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -24,6 +26,9 @@ mesi = {
     7: "Luglio", 8: "Agosto", 9: "Settembre", 10: "Ottobre", 11: "Novembre", 12: "Dicembre"
 }
 
+# Totale globale dei feedback ricevuti: calcolato una sola volta, poi aggiornato in modo incrementale
+_totale_feedback_ricevuti: Optional[int] = None
+
 def format_data_italiano(dt):
     giorno = giorni_settimana[dt.weekday()]
     mese = mesi[dt.month]
@@ -32,33 +37,54 @@ def format_data_italiano(dt):
 
 def ensure_user_stats(stats: Dict[int, dict], user_id: int, username: str) -> dict:
     """
-    Ensures a user's stats object is fully initialized, including all nested structures,
-    for both new and existing users.
+    Ensures a user's stats object exists. StatsRecord always carries every nested
+    structure (counters, last feedback, history), so new users only need creating.
     """
-    user_stats = stats.setdefault(user_id, {})
-
-    # Ensure 'feedback_fatti' and its sub-keys exist
-    fatti_stats = user_stats.setdefault("feedback_fatti", {})
-    fatti_stats.setdefault("count", 0)
-    fatti_stats.setdefault("daily_count", 0)
-    fatti_stats.setdefault("daily_date", None)
-    fatti_stats.setdefault("last", None)
-
-    # Ensure 'feedback_ricevuti' and its sub-keys exist
-    ricevuti_stats = user_stats.setdefault("feedback_ricevuti", {})
-    ricevuti_stats.setdefault("count", 0)
-    ricevuti_stats.setdefault("daily_count", 0)
-    ricevuti_stats.setdefault("daily_date", None)
-    ricevuti_stats.setdefault("last", None)
-
-    # Ensure other top-level keys exist
-    user_stats.setdefault("proporzione", 0)
-    user_stats.setdefault("history", {})
-    user_stats.setdefault("username", username)
-
+    user_stats = stats.get(user_id)
+    if user_stats is None:
+        user_stats = stats[user_id] = StatsRecord(username)
+    elif user_stats.get("username") is None:
+        user_stats["username"] = username
     return user_stats
 
-def update_feedback_stats(stats: Dict[int, dict], sender_id: int, sender_username: str, target_id: int, target_username: str) -> None:
+def reset_feedback_total() -> None:
+    """
+    Invalida il totale globale dei feedback ricevuti (da chiamare quando le stats vengono ricaricate).
+    """
+    global _totale_feedback_ricevuti
+    _totale_feedback_ricevuti = None
+
+
+def get_feedback_total(stats: Dict[int, dict]) -> int:
+    """
+    Restituisce il totale globale dei feedback ricevuti, calcolandolo solo al primo accesso.
+    """
+    global _totale_feedback_ricevuti
+    if _totale_feedback_ricevuti is None:
+        _totale_feedback_ricevuti = sum(
+            u.get("feedback_ricevuti", {}).get("count", 0)
+            for u in stats.values()
+        )
+    return _totale_feedback_ricevuti
+
+
+def get_proporzione(stats: Dict[int, dict], user_id: int) -> float:
+    """
+    Percentuale dei feedback ricevuti da un utente sul totale del gruppo, calcolata in lettura
+    dal totale globale (non viene salvata nelle stats).
+    """
+    total_feedback = get_feedback_total(stats)
+    if total_feedback <= 0 or user_id not in stats:
+        return 0
+    return (stats[user_id].get("feedback_ricevuti", {}).get("count", 0) / total_feedback) * 100
+
+
+def apply_feedback_stats(stats: Dict[int, dict], sender_id: int, sender_username: str, target_id: int, target_username: str) -> Dict[str, dict]:
+    """
+    Aggiorna in memoria le stats di mittente e destinatario per un feedback accettato.
+    Non scrive nulla: restituisce i percorsi sotto 'stats' da salvare, che il chiamante
+    include nel commit atomico del feedback.
+    """
     today = datetime.date.today().isoformat()
     now   = datetime.datetime.now().isoformat()
 
@@ -71,10 +97,11 @@ def update_feedback_stats(stats: Dict[int, dict], sender_id: int, sender_usernam
         # Salva storico del giorno precedente
         prev_date = sender_stats["feedback_fatti"]["daily_date"]
         if prev_date:
-            sender_stats.setdefault("history", {})[prev_date] = {
-                "feedback_fatti":    sender_stats["feedback_fatti"]["daily_count"],
-                "feedback_ricevuti": sender_stats["feedback_ricevuti"]["daily_count"]
-            }
+            sender_stats["history"].record(
+                prev_date,
+                sender_stats["feedback_fatti"]["daily_count"],
+                sender_stats["feedback_ricevuti"]["daily_count"],
+            )
         sender_stats["feedback_fatti"]["daily_count"] = 0
         sender_stats["feedback_fatti"]["daily_date"]  = today
 
@@ -91,10 +118,11 @@ def update_feedback_stats(stats: Dict[int, dict], sender_id: int, sender_usernam
     if target_stats["feedback_ricevuti"]["daily_date"] != today:
         prev_date = target_stats["feedback_ricevuti"]["daily_date"]
         if prev_date:
-            target_stats.setdefault("history", {})[prev_date] = {
-                "feedback_fatti":    target_stats["feedback_fatti"]["daily_count"],
-                "feedback_ricevuti": target_stats["feedback_ricevuti"]["daily_count"]
-            }
+            target_stats["history"].record(
+                prev_date,
+                target_stats["feedback_fatti"]["daily_count"],
+                target_stats["feedback_ricevuti"]["daily_count"],
+            )
         target_stats["feedback_ricevuti"]["daily_count"] = 0
         target_stats["feedback_ricevuti"]["daily_date"]  = today
 
@@ -107,54 +135,120 @@ def update_feedback_stats(stats: Dict[int, dict], sender_id: int, sender_usernam
         "timestamp":       now
     }
 
-    # 4) Normalizza TUTTI gli utenti per garantire la presenza di ogni chiave
-    for uid, data in list(stats.items()):
-        ensure_user_stats(stats, uid, data.get("username", ""))
+    # 4) Aggiorna il totale globale (la proporzione viene calcolata in lettura)
+    global _totale_feedback_ricevuti
+    if _totale_feedback_ricevuti is not None:
+        _totale_feedback_ricevuti += 1
 
-    total_feedback = sum(
-        u["feedback_ricevuti"].get("count", 0)
-        for u in stats.values()
-    )
-    if total_feedback > 0:
-        for user_data in stats.values():
-            user_data["proporzione"] = (
-                user_data["feedback_ricevuti"]["count"] / total_feedback
-            ) * 100
-    else:
-        for user_data in stats.values():
-            user_data["proporzione"] = 0
+    # 5) Invalida i grafici in cache che dipendono da questi storici
+    chart_cache.invalidate(sender_id)
+    chart_cache.invalidate(target_id)
+    chart_cache.invalidate(GROUP_CHART)
+
+    # 6) Da salvare: solo i due utenti coinvolti
+    return {
+        str(sender_id): sender_stats,
+        str(target_id): target_stats,
+    }
+
+
+def build_group_stats(stats: Dict[int, dict]) -> dict:
+    """
+    Ricostruisce da zero i contatori aggregati del gruppo a partire dalle stats dei singoli utenti.
+    Usata solo se il nodo 'group_stats' non esiste ancora. I periodi già accorpati
+    in settimane o mesi vengono attribuiti al loro primo giorno.
+    """
+    daily: Dict[str, int] = {}
+    top_sender = {"user_id": None, "username": "N/A", "count": 0}
+    top_receiver = {"user_id": None, "username": "N/A", "count": 0}
+
+    for uid, user_data in stats.items():
+        history = StatsHistory.from_value(user_data.get("history"))
+        for date, fatti_day, _ in history.entries():
+            daily[date] = daily.get(date, 0) + fatti_day
+
+        fatti = user_data.get("feedback_fatti") or {}
+        # Il giorno in corso non è ancora nello storico
+        if fatti.get("daily_date") and fatti["daily_date"] not in history:
+            daily[fatti["daily_date"]] = daily.get(fatti["daily_date"], 0) + fatti.get("daily_count", 0)
+
+        username = user_data.get("username", f"UnknownUser_{uid}")
+        sent = fatti.get("count", 0)
+        received = (user_data.get("feedback_ricevuti") or {}).get("count", 0)
+        if sent > top_sender["count"]:
+            top_sender = {"user_id": uid, "username": username, "count": sent}
+        if received > top_receiver["count"]:
+            top_receiver = {"user_id": uid, "username": username, "count": received}
 
-    save_stats(stats)
+    return {"daily": daily, "top_sender": top_sender, "top_receiver": top_receiver}
 
 
-def get_feedback_trend_image(stats: Dict[int, dict], user_id: int, days: int = 7) -> BytesIO:
+async def load_or_build_group_stats(stats: Dict[int, dict]) -> dict:
+    """
+    Carica i contatori aggregati del gruppo; alla prima esecuzione li costruisce dalle stats e li salva.
+    """
+    group_stats = await storage.load_group_stats()
+    if not group_stats and stats:
+        group_stats = build_group_stats(stats)
+        await storage.save_group_stats(group_stats)
+        logger.info("Nodo group_stats inizializzato a partire dalle statistiche utente.")
+    group_stats.setdefault("daily", {})
+    return group_stats
+
+
+def apply_group_stats_on_feedback(group_stats: dict, stats: Dict[int, dict], sender_id: int, sender_username: str, target_id: int, target_username: str) -> Dict[str, object]:
+    """
+    Aggiorna in modo incrementale i contatori del gruppo dopo un feedback accettato
+    (da chiamare dopo apply_feedback_stats). Restituisce solo i percorsi modificati
+    sotto 'group_stats', da includere nel commit atomico del feedback.
+    """
+    today = datetime.date.today().isoformat()
+    daily = group_stats.setdefault("daily", {})
+    daily[today] = daily.get(today, 0) + 1
+    updates = {f"daily/{today}": daily[today]}
+
+    # I contatori crescono solo di uno alla volta, quindi basta confrontarli con il massimo corrente
+    sent = stats[sender_id]["feedback_fatti"]["count"]
+    top_sender = group_stats.get("top_sender") or {"count": 0}
+    if sent > top_sender.get("count", 0) or top_sender.get("user_id") == sender_id:
+        group_stats["top_sender"] = {"user_id": sender_id, "username": sender_username, "count": sent}
+        updates["top_sender"] = group_stats["top_sender"]
+
+    received = stats[target_id]["feedback_ricevuti"]["count"]
+    top_receiver = group_stats.get("top_receiver") or {"count": 0}
+    if received > top_receiver.get("count", 0) or top_receiver.get("user_id") == target_id:
+        group_stats["top_receiver"] = {"user_id": target_id, "username": target_username, "count": received}
+        updates["top_receiver"] = group_stats["top_receiver"]
+
+    return updates
+
+
+async def get_feedback_trend_image(stats: Dict[int, dict], user_id: int, days: int = 7) -> bytes:
     if user_id not in stats:
         raise ValueError("Utente non presente nelle statistiche\\.")
     user_stats = stats[user_id]
-    if "history" not in user_stats or not user_stats["history"]:
+    history = user_stats.get("history")
+    if not history:
         raise ValueError("*Non ho abbastanza informazioni per generare il grafico, ci rivediamo quando avrai donato altre carte\\.*")
 
-    dates = sorted(user_stats["history"].keys())
-    dates_to_plot = dates[-days:]
-    feedback_fatti = [user_stats["history"].get(date, {}).get("feedback_fatti", 0) for date in dates_to_plot]
-    feedback_ricevuti = [user_stats["history"].get(date, {}).get("feedback_ricevuti", 0) for date in dates_to_plot]
-
-    plt.figure(figsize=(10, 6))
-    plt.plot(dates_to_plot, feedback_fatti, label="Feedback fatti", marker="o", linestyle="-")
-    plt.plot(dates_to_plot, feedback_ricevuti, label="Feedback ricevuti", marker="o", linestyle="-")
-    plt.xlabel("Date")
-    plt.ylabel("Numero di feedback")
-    plt.title("Andamento dei feedback negli ultimi giorni")
-    plt.legend()
-    plt.grid(True)
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-
-    buf = BytesIO()
-    plt.savefig(buf, format="png")
-    plt.close()
-    buf.seek(0)
-    return buf
+    cached = chart_cache.get(user_id, days)
+    if cached is not None:
+        return cached
+    version = chart_cache.version(user_id)
+
+    # Lo storico è già ordinato: gli ultimi giorni si leggono senza ordinare tutte le date
+    entries = history.last(days)
+    if not entries:
+        # Solo periodi accorpati: niente giorni recenti da mettere nel grafico
+        raise ValueError("*Non ho abbastanza informazioni per generare il grafico, ci rivediamo quando avrai donato altre carte\\.*")
+    dates_to_plot = [date for date, _, _ in entries]
+    feedback_fatti = [fatti for _, fatti, _ in entries]
+    feedback_ricevuti = [ricevuti for _, _, ricevuti in entries]
+
+    # Il rendering avviene nel pool di processi, fuori dal loop asyncio
+    image_png = await chart_renderer.render(render_trend_png, dates_to_plot, feedback_fatti, feedback_ricevuti)
+    chart_cache.put(user_id, days, image_png, version)
+    return image_png
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -166,8 +260,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     nickname = escape_markdown(update.effective_user.full_name or username, version=2)
     escaped_username = escape_markdown(username, version=2)
 
-    stats = load_stats()
-    user_stats = ensure_user_stats(stats, user_id, username)
+    # Le stats in memoria sono già aggiornate dal bot: nessun download da Firebase
+    stats = context.bot_data.get('stats', {})
+    if user_id in stats:
+        user_stats = ensure_user_stats(stats, user_id, username)
+    else:
+        user_stats = ensure_user_stats({}, user_id, username)
 
     last_sent = user_stats["feedback_fatti"].get("last")
     last_received = user_stats["feedback_ricevuti"].get("last")
@@ -187,6 +285,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         data_ricevuto = escape_markdown(received_date_str, version=2)
         sender = escape_markdown(last_received['sender_username'], version=2)
         received_info = f"_📥 Hai ricevuto l'ultimo feedback {data_ricevuto} da @{sender}\\._\n"
+        quota = f"{get_proporzione(stats, user_id):.1f}".replace(".", ",")
+        received_info += f"_📊 I tuoi feedback ricevuti sono il {quota}% del totale del gruppo\\._\n"
 
     group_link = "https://t.me/addlist/R1OCGDs37tY1ODY0"
     welcome_text = (
@@ -198,8 +298,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
     try:
-        image_buffer = get_feedback_trend_image(stats, user_id, days=7)
-        await update.message.reply_photo(photo=image_buffer, caption=welcome_text, parse_mode=ParseMode.MARKDOWN_V2)
+        image_png = await get_feedback_trend_image(stats, user_id, days=7)
+        await update.message.reply_photo(photo=image_png, caption=welcome_text, parse_mode=ParseMode.MARKDOWN_V2)
     except ValueError as e:
         await update.message.reply_text(welcome_text + "\n\n", parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
     except Exception as e:
@@ -209,75 +309,34 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 @restricted
 async def genera_grafico_totale(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    stats_users = load_stats()
-    
-    group_stats = load_group_users()
-    
-    all_dates = set()
-    for user_data in stats_users.values():
-        if "history" in user_data:
-            all_dates.update(user_data["history"].keys())
-    
-    all_dates = sorted(list(all_dates))
-    
-    if not all_dates:
-        await update.message.reply_text("Non ci sono dati storici disponibili per generare il grafico\\.")
-        return
-    
-    total_feedback_per_day = []
-    for date in all_dates:
-        daily_total = sum(user_data["history"][date].get("feedback_fatti", 0) for user_data in stats_users.values() if "history" in user_data and date in user_data["history"])
-        total_feedback_per_day.append(daily_total)
-    
-    # Genera il grafico
-    plt.figure(figsize=(12, 7))
-    plt.plot(all_dates, total_feedback_per_day, label="Feedback totali nel gruppo", marker="o", linestyle="-", color="blue")
-    plt.xlabel("Date")
-    plt.ylabel("Numero di feedback")
-    plt.title("Andamento giornaliero dei feedback totali nel gruppo")
-    plt.legend()
-    plt.grid(True)
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    
-    top_sender = {"username": "N/A", "count": 0}
-    top_receiver = {"username": "N/A", "count": 0}
+    # Serie giornaliera e top utenti sono pre-aggregati: nessun download dell'intero database
+    group_stats = context.bot_data.get('group_stats') or {}
+    daily = group_stats.get("daily") or {}
+
+    # Se il grafico del gruppo non è cambiato dall'ultima richiesta, riusa il PNG in cache
+    image_png = chart_cache.get(GROUP_CHART, 0)
+    if image_png is None:
+        version = chart_cache.version(GROUP_CHART)
+        all_dates = sorted(daily.keys())
+
+        if not all_dates:
+            await update.message.reply_text("Non ci sono dati storici disponibili per generare il grafico\\.")
+            return
+
+        total_feedback_per_day = [daily[date] for date in all_dates]
+
+        # Genera il grafico nel pool di processi, fuori dal loop asyncio
+        try:
+            image_png = await chart_renderer.render(render_totale_png, all_dates, total_feedback_per_day)
+        except Exception as e:
+            logger.error(f"Errore durante la generazione del grafico totale: {e}")
+            await update.message.reply_text("Errore nella generazione del grafico\\.", parse_mode=ParseMode.MARKDOWN_V2)
+            return
+        chart_cache.put(GROUP_CHART, 0, image_png, version)
+
+    top_sender = group_stats.get("top_sender") or {"username": "N/A", "count": 0}
+    top_receiver = group_stats.get("top_receiver") or {"username": "N/A", "count": 0}
 
-    all_users_data = {}
-    
-    for chat_id, users_in_chat in group_stats.items():
-        if isinstance(users_in_chat, dict): 
-            for user_id_str, user_info in users_in_chat.items():
-                if isinstance(user_info, dict): 
-                    user_id_int = int(user_id_str) 
-                    all_users_data[user_id_int] = {
-                        "username": user_info.get("username", f"UnknownUser_{user_id_int}"),
-                        "feedback_fatti": 0, 
-                        "feedback_ricevuti": 0  
-                    }
-    
-    for user_id, user_stats_data in stats_users.items():
-        if user_id in all_users_data:
-            all_users_data[user_id]["feedback_fatti"] = user_stats_data["feedback_fatti"]["count"]
-            all_users_data[user_id]["feedback_ricevuti"] = user_stats_data["feedback_ricevuti"]["count"]
-        else:
-            all_users_data[user_id] = {
-                "username": user_stats_data.get("username", f"UnknownUser_{user_id}"),
-                "feedback_fatti": user_stats_data["feedback_fatti"]["count"],
-                "feedback_ricevuti": user_stats_data["feedback_ricevuti"]["count"]
-            }
-            
-    for user_id, user_info in all_users_data.items():
-        if user_info["feedback_fatti"] > top_sender["count"]:
-            top_sender = {"username": user_info["username"], "count": user_info["feedback_fatti"]}
-        if user_info["feedback_ricevuti"] > top_receiver["count"]:
-            top_receiver = {"username": user_info["username"], "count": user_info["feedback_ricevuti"]}
-            
-    buf = BytesIO()
-    plt.savefig(buf, format="png")
-    plt.close()
-    buf.seek(0)
-    
     caption_text = (
         f"*📊 Statistiche dei feedback totali nel gruppo*\n\n"
         f"_🎁 Utente con più feedback inviati\\: *@{escape_markdown(str(top_sender['username']), version=2)}* "
@@ -287,7 +346,7 @@ async def genera_grafico_totale(update: Update, context: ContextTypes.DEFAULT_TY
     )
     
     await update.message.reply_photo(
-        photo=buf,
+        photo=image_png,
         caption=caption_text,
         parse_mode=ParseMode.MARKDOWN_V2
     )
@@ -0,0 +1,271 @@
+import os
+import time
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Optional, Set
+
+import firebase_file
+import sqlite_file
+from records import (
+    to_json, users_from_json, user_from_json, stats_from_json, stats_entry_from_json
+)
+
+logger = logging.getLogger(__name__)
+
+# Backend di persistenza: 'firebase' (default) oppure 'sqlite' per lavorare su disco locale
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "firebase").lower()
+STORAGE_WORKERS = int(os.getenv("STORAGE_WORKERS", "4"))
+STORAGE_MAX_CONCURRENCY = int(os.getenv("STORAGE_MAX_CONCURRENCY", str(STORAGE_WORKERS)))
+STORAGE_TIMEOUT = float(os.getenv("STORAGE_TIMEOUT", "10"))
+STORAGE_LOAD_TIMEOUT = float(os.getenv("STORAGE_LOAD_TIMEOUT", "60"))
+
+# Pool dedicato: le chiamate bloccanti del client firebase_admin non occupano
+# il default executor e non bloccano mai il loop di aiohttp/PTB
+_executor = ThreadPoolExecutor(max_workers=STORAGE_WORKERS, thread_name_prefix="storage")
+_semaphore = asyncio.Semaphore(STORAGE_MAX_CONCURRENCY)
+
+# Entrambi i moduli espongono le stesse funzioni sincrone
+backend = sqlite_file if STORAGE_BACKEND == "sqlite" else firebase_file
+
+# Ultime scritture di questo processo per record ('group_users/{chat}/{user}', 'stats/{uid}',
+# 'pending_feedback/{id}' o un nodo intero): live_sync le usa per non riapplicare in
+# memoria l'eco delle proprie scritture, che può arrivare quando la memoria è già avanti
+LOCAL_WRITE_WINDOW = float(os.getenv("LOCAL_WRITE_WINDOW", "15"))
+_local_writes: Dict[str, float] = {}
+_RECORD_DEPTH = {"group_users": 2, "stats": 1, "pending_feedback": 1}
+
+
+def initialize() -> None:
+    """Inizializza il backend selezionato (SDK Firebase o schema SQLite)."""
+    if backend is sqlite_file:
+        sqlite_file.initialize()
+    else:
+        firebase_file.initialize_firebase()
+    logger.info(f"Backend di storage: {backend.__name__}.")
+
+
+def increment(amount: int) -> dict:
+    """Valore da usare in un update per sommare amount lato database (stesso formato per entrambi i backend)."""
+    return firebase_file.increment(amount)
+
+
+def new_write_marker(label: Optional[str] = None) -> str:
+    """
+    Marcatore per rendere idempotente una scrittura con incrementi (vedi is_write_applied):
+    label se indicata, che deve identificare la scrittura e non il tentativo, altrimenti casuale.
+    """
+    return firebase_file.new_write_marker(label)
+
+
+def note_local_writes(node: str, paths: Optional[Iterable[str]] = None) -> None:
+    """Registra la scrittura dei record di node toccati da paths (None = tutto il nodo)."""
+    now = time.monotonic()
+    if paths is None:
+        _local_writes[node] = now
+    else:
+        depth = _RECORD_DEPTH.get(node, 0)
+        for path in paths:
+            parts = str(path).strip("/").split("/")[:depth]
+            _local_writes["/".join([node, *parts])] = now
+    if len(_local_writes) > 10000:
+        for record, at in list(_local_writes.items()):
+            if now - at >= LOCAL_WRITE_WINDOW:
+                del _local_writes[record]
+
+
+def written_locally(record: str) -> bool:
+    """True se questo processo ha scritto il record (o il suo nodo) negli ultimi LOCAL_WRITE_WINDOW secondi."""
+    now = time.monotonic()
+    for key in (record, record.split("/", 1)[0]):
+        at = _local_writes.get(key)
+        if at is not None and now - at < LOCAL_WRITE_WINDOW:
+            return True
+    return False
+
+
+def _json_values(updates: Dict[str, Any]) -> Dict[str, Any]:
+    """Converte i record in dict JSON prima di passarli al thread dello storage."""
+    return {path: to_json(value) if hasattr(value, "to_dict") else value for path, value in updates.items()}
+
+
+async def _run(func: Callable, *args, default: Any = None, timeout: float = STORAGE_TIMEOUT) -> Any:
+    """
+    Esegue una funzione del backend nel pool dedicato, con limite di concorrenza e timeout.
+    In caso di timeout registra l'errore e restituisce default, come fanno le funzioni sincrone;
+    il posto nel semaforo resta occupato finché il thread non ha davvero finito.
+    """
+    await _semaphore.acquire()
+    loop = asyncio.get_running_loop()
+    try:
+        future = loop.run_in_executor(_executor, functools.partial(func, *args))
+    except BaseException:
+        _semaphore.release()
+        raise
+    future.add_done_callback(lambda _: _semaphore.release())
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.error(f"Timeout ({timeout}s) durante {func.__name__}.")
+        return default
+
+
+async def _run_settled(func: Callable, *args, default: Any = None, timeout: float = STORAGE_TIMEOUT) -> Any:
+    """
+    Come _run, ma dopo il timeout continua ad aspettare che la chiamata finisca:
+    per le scritture con marcatore, dove chi ritenta deve sapere che nessun
+    tentativo precedente è ancora in volo prima di controllare se è arrivato.
+    """
+    async with _semaphore:
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(_executor, functools.partial(func, *args))
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{func.__name__} oltre {timeout}s, attendo comunque l'esito.")
+        try:
+            return await future
+        except Exception as e:
+            logger.error(f"Errore durante {func.__name__}: {e}")
+            return default
+
+
+async def load_admin_ids() -> Set[int]:
+    return await _run(backend.load_admin_ids, default=set())
+
+
+async def save_admin_ids(admin_ids: Set[int]) -> bool:
+    return await _run(backend.save_admin_ids, admin_ids, default=False)
+
+
+async def load_group_users() -> Dict[int, Dict[int, dict]]:
+    return users_from_json(await _run(backend.load_group_users, default={}, timeout=STORAGE_LOAD_TIMEOUT))
+
+
+async def update_group_users(updates: Dict[str, dict], marker: Optional[str] = None) -> bool:
+    """
+    Con un marcatore la chiamata non viene abbandonata al timeout: se restituisce
+    False la scrittura è terminata e is_write_applied(marker) dice se è arrivata.
+    """
+    # Registrate prima e dopo: l'eco può arrivare prima che la scrittura restituisca
+    note_local_writes("group_users", updates)
+    if marker is None:
+        ok = await _run(backend.update_group_users, _json_values(updates), default=False)
+    else:
+        ok = await _run_settled(backend.update_group_users, _json_values(updates), marker, default=False)
+    note_local_writes("group_users", updates)
+    return ok
+
+
+async def load_stats() -> Dict[int, dict]:
+    return stats_from_json(await _run(backend.load_stats, default={}, timeout=STORAGE_LOAD_TIMEOUT))
+
+
+async def load_stats_entry(user_id: int) -> Optional[dict]:
+    return stats_entry_from_json(await _run(backend.load_stats_entry, user_id))
+
+
+async def load_changes_since(version: str) -> Optional[Dict[str, dict]]:
+    return await _run(backend.load_changes_since, version, timeout=STORAGE_LOAD_TIMEOUT)
+
+
+async def prune_changes(before: str) -> bool:
+    return await _run(backend.prune_changes, before, default=False, timeout=STORAGE_LOAD_TIMEOUT)
+
+
+async def load_group_stats() -> dict:
+    return await _run(backend.load_group_stats, default={}, timeout=STORAGE_LOAD_TIMEOUT)
+
+
+async def save_group_stats(group_stats: dict) -> None:
+    await _run(backend.save_group_stats, group_stats)
+
+
+async def commit_accepted_feedback(request_id: str, marker: str, users: Dict[str, dict], stats: Dict[str, dict],
+                                   group_stats: Dict[str, object]) -> bool:
+    """
+    Commit atomico di un feedback accettato, marcato con marker. Non viene abbandonato
+    al timeout: se restituisce False il tentativo è concluso e va ripetuto solo se
+    is_write_applied(marker) è False.
+    """
+    def note() -> None:
+        note_local_writes("group_users", users)
+        note_local_writes("stats", stats)
+        note_local_writes("pending_feedback", [str(request_id)])
+
+    note()
+    ok = await _run_settled(
+        backend.commit_accepted_feedback, str(request_id), marker, _json_values(users), _json_values(stats),
+        dict(group_stats), default=False,
+    )
+    note()
+    return ok
+
+
+async def is_write_applied(marker: str) -> Optional[bool]:
+    """True/False se la scrittura marcata è arrivata o no, None se non si riesce a saperlo."""
+    return await _run(backend.is_write_applied, marker)
+
+
+async def load_pending_feedback_entry(request_id: str) -> Optional[dict]:
+    return await _run(backend.load_pending_feedback_entry, str(request_id))
+
+
+async def load_pending_feedback() -> Dict[str, dict]:
+    return await _run(backend.load_pending_feedback, default={}, timeout=STORAGE_LOAD_TIMEOUT)
+
+
+async def set_pending_feedback_entry(request_id: str, data: dict) -> bool:
+    note_local_writes("pending_feedback", [str(request_id)])
+    ok = await _run(backend.set_pending_feedback_entry, request_id, data, default=False)
+    note_local_writes("pending_feedback", [str(request_id)])
+    return ok
+
+
+async def update_pending_feedback_entry(request_id: str, fields: dict) -> bool:
+    note_local_writes("pending_feedback", [str(request_id)])
+    ok = await _run(backend.update_pending_feedback_entry, request_id, fields, default=False)
+    note_local_writes("pending_feedback", [str(request_id)])
+    return ok
+
+
+async def delete_pending_feedback_entry(request_id: str) -> bool:
+    note_local_writes("pending_feedback", [str(request_id)])
+    ok = await _run(backend.delete_pending_feedback_entry, request_id, default=False)
+    note_local_writes("pending_feedback", [str(request_id)])
+    return ok
+
+
+async def load_user_data(chat_id: int, user_id: int) -> Optional[Dict]:
+    return user_from_json(await _run(backend.load_user_data, chat_id, user_id), user_id)
+
+
+
+
+async def load_leases() -> Dict[int, dict]:
+    return await _run(backend.load_leases, default={})
+
+
+async def acquire_lease(shard: int, owner: str, url: str, ttl: float) -> Optional[dict]:
+    return await _run(backend.acquire_lease, shard, owner, url, ttl)
+
+
+async def release_lease(shard: int, owner: str) -> bool:
+    return await _run(backend.release_lease, shard, owner, default=False)
+
+
+async def touch_replica(owner: str, url: str, ttl: float) -> bool:
+    return await _run(backend.touch_replica, owner, url, ttl, default=False)
+
+
+async def load_replicas() -> Dict[str, dict]:
+    return await _run(backend.load_replicas, default={})
+
+
+async def remove_replica(owner: str) -> bool:
+    return await _run(backend.remove_replica, owner, default=False)
+
+
+def shutdown() -> None:
+    _executor.shutdown(wait=True)
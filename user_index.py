@@ -0,0 +1,77 @@
+import logging
+from collections.abc import Mapping
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Struttura: {chat_id: {username_minuscolo: user_id}}
+UsernameIndex = Dict[int, Dict[str, int]]
+
+
+def _normalize(username: Optional[str]) -> str:
+    return (username or "").lstrip("@").lower()
+
+
+def build_username_index(group_users: Dict[int, Dict[int, dict]]) -> UsernameIndex:
+    """
+    Costruisce l'indice username -> user_id a partire da group_users.
+    """
+    index: UsernameIndex = {}
+    for chat_id, users in group_users.items():
+        chat_index = index.setdefault(chat_id, {})
+        if not isinstance(users, Mapping):
+            continue
+        for user_id, user_data in users.items():
+            if isinstance(user_data, Mapping) and user_data.get("username"):
+                chat_index[_normalize(user_data["username"])] = user_id
+    return index
+
+
+def get_username_index(bot_data: dict) -> UsernameIndex:
+    """
+    Restituisce l'indice salvato in bot_data, costruendolo al primo accesso.
+    """
+    index = bot_data.get('username_index')
+    if index is None:
+        index = build_username_index(bot_data.get('group_users', {}))
+        bot_data['username_index'] = index
+    return index
+
+
+def index_user(bot_data: dict, chat_id: int, user_id: int, username: str, old_username: Optional[str] = None) -> None:
+    """
+    Registra (o aggiorna dopo un cambio nome) lo username di un utente nell'indice.
+    """
+    chat_index = get_username_index(bot_data).setdefault(chat_id, {})
+    if old_username:
+        old_key = _normalize(old_username)
+        if chat_index.get(old_key) == user_id:
+            del chat_index[old_key]
+    if username:
+        chat_index[_normalize(username)] = user_id
+
+
+def find_user_by_username(bot_data: dict, chat_id: int, username: str) -> Optional[dict]:
+    """
+    Cerca un utente per username (case-insensitive) nella chat indicata.
+    """
+    key = _normalize(username)
+    user_id = get_username_index(bot_data).get(chat_id, {}).get(key)
+    if user_id is None:
+        return None
+    user_data = bot_data.get('group_users', {}).get(chat_id, {}).get(user_id)
+    # Scarta voci non più valide (utente rimosso o rinominato fuori dal bot)
+    if not user_data or _normalize(user_data.get("username")) != key:
+        return None
+    return user_data
+
+
+def find_user_id_by_username(bot_data: dict, username: str) -> Optional[int]:
+    """
+    Cerca l'ID di un utente per username in tutte le chat indicizzate.
+    """
+    for chat_id in get_username_index(bot_data):
+        user_data = find_user_by_username(bot_data, chat_id, username)
+        if user_data:
+            return user_data.get("id")
+    return None
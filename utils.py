@@ -2,14 +2,17 @@ import logging
 import os
 import json
 import requests
-from typing import Dict, Set, List
+from typing import Dict, List, Sequence
 from functools import wraps
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
 from telegram.helpers import escape_markdown
 from dotenv import load_dotenv
-from firebase_file import load_admin_ids, save_admin_ids, load_group_users
+from admin_cache import admin_cache
+from user_index import find_user_id_by_username
+from leaderboard import get_leaderboards
+from pagination_store import PaginationStore
 load_dotenv()
 
 logging.basicConfig(
@@ -22,10 +25,8 @@ GROUP_USERS_BIN_ID = os.getenv("GROUP_USERS_BIN_ID")
 ADMIN_IDS_BIN_ID = os.getenv("ADMIN_IDS_BIN_ID")
 GRUPPO_STAFF = os.getenv("GRUPPO_STAFF")
 GRUPPO_SCAMBI = os.getenv("GRUPPO_SCAMBI")
-ALLOWED_USER_IDS: Set[int] = set()  # Inizializzazione temporanea, verrà sovrascritta
 ITEMS_PER_PAGE = 25
-PAGINATION_DATA_STORE: Dict[int, Dict[str, any]] = {}
-ALLOWED_USER_IDS = load_admin_ids()
+PAGINATION_DATA_STORE = PaginationStore()
 
 def restricted(func):
     @wraps(func)
@@ -33,7 +34,7 @@ def restricted(func):
         update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs
     ):
         user_id = update.effective_user.id
-        if user_id not in ALLOWED_USER_IDS:
+        if not admin_cache.is_admin(user_id):
             logger.warning(f"Tentativo di accesso non autorizzato: {user_id} ha tentato di usare {func.__name__}")
             if update.message:
                 await update.message.reply_text(
@@ -47,7 +48,6 @@ def restricted(func):
 
 @restricted
 async def add_auth(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global ALLOWED_USER_IDS
     args = context.args
     if len(args) < 1:
         await update.message.reply_text(
@@ -61,17 +61,20 @@ async def add_auth(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if new_user_id is None:
         return  # Messaggio di errore già inviato in get_user_id
 
-    ALLOWED_USER_IDS = load_admin_ids()
-
-    if new_user_id in ALLOWED_USER_IDS:
+    # Salva su Firebase e aggiorna la cache solo se il salvataggio è riuscito
+    added = await admin_cache.add(new_user_id)
+    if added is None:
+        await update.message.reply_text(
+            "_❌ Salvataggio della lista admin non riuscito, riprova più tardi\\._",
+            parse_mode=ParseMode.MARKDOWN_V2,
+        )
+        return
+    if not added:
         await update.message.reply_text(
             "_Questo utente è già autorizzato\\._", parse_mode=ParseMode.MARKDOWN_V2
         )
         return
 
-    ALLOWED_USER_IDS.add(new_user_id)
-    save_admin_ids(ALLOWED_USER_IDS)  # Salva su Firebase
-
     username = await get_username(new_user_id, context)
 
     await update.message.reply_text(
@@ -82,7 +85,6 @@ async def add_auth(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 @restricted
 async def remove_auth(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global ALLOWED_USER_IDS
     args = context.args
     if len(args) < 1:
         await update.message.reply_text(
@@ -96,18 +98,21 @@ async def remove_auth(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if rem_user_id is None:
         return  # Messaggio di errore già inviato in get_user_id
 
-    ALLOWED_USER_IDS = load_admin_ids()
-
-    if rem_user_id not in ALLOWED_USER_IDS:
+    # Salva su Firebase e aggiorna la cache solo se il salvataggio è riuscito
+    removed = await admin_cache.remove(rem_user_id)
+    if removed is None:
+        await update.message.reply_text(
+            "_❌ Salvataggio della lista admin non riuscito, riprova più tardi\\._",
+            parse_mode=ParseMode.MARKDOWN_V2,
+        )
+        return
+    if not removed:
         await update.message.reply_text(
             "_Questo utente non risulta nella lista degli autorizzati\\._",
             parse_mode=ParseMode.MARKDOWN_V2,
         )
         return
 
-    ALLOWED_USER_IDS.remove(rem_user_id)
-    save_admin_ids(ALLOWED_USER_IDS)  # Salva su Firebase
-
     username = await get_username(rem_user_id, context)
 
     await update.message.reply_text(
@@ -118,24 +123,16 @@ async def remove_auth(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def get_user_id(update: Update, param: str, context: ContextTypes.DEFAULT_TYPE):
     """
     Recupera l'ID di un utente. Prova prima a convertirlo in un intero.
-    Se fallisce, lo tratta come uno username e cerca nel database locale (caricato da Firebase).
+    Se fallisce, lo tratta come uno username e lo cerca nell'indice in memoria.
     """
     try:
         # Prova a convertire direttamente il parametro in un ID numerico
         return int(param)
     except ValueError:
         # Se non è un ID, trattalo come uno username
-        username_to_find = param.lstrip("@").lower()
-        
-        # Carica i dati degli utenti dal database (simulato dal tuo file.json)
-        group_users = load_group_users()
-        
-        # Itera su tutti i gruppi e gli utenti nel database per trovare una corrispondenza
-        for chat_id, users in group_users.items():
-            if isinstance(users, dict):
-                for user_id, user_data in users.items():
-                    if isinstance(user_data, dict) and user_data.get("username", "").lower() == username_to_find:
-                        return user_data.get("id")  # Restituisce l'ID trovato
+        user_id = find_user_id_by_username(context.bot_data, param)
+        if user_id is not None:
+            return user_id
 
         # Se l'utente non è stato trovato nel database locale
         await update.message.reply_text(
@@ -156,21 +153,18 @@ async def get_username(user_id: int, context: ContextTypes.DEFAULT_TYPE):
         )
         return str(user_id)
 
-@restricted
-async def list_admins(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def build_admin_data(context: ContextTypes.DEFAULT_TYPE) -> List[Dict]:
     """
-    Stampa la lista degli amministratori,
-    con paginazione e bottoni per navigare le pagine.
+    Costruisce la lista degli admin con il relativo username.
+    Le righe restano in admin_cache finché la lista non cambia (o per ADMIN_CACHE_TTL),
+    così sfogliare le pagine non richiede una chiamata a Telegram per ogni admin.
     """
-    admin_ids = list(load_admin_ids())
-    if not admin_ids:
-        await update.message.reply_text(
-            "_Nessun amministratore trovato\\._",
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
-        return
-
+    cached = admin_cache.rows()
+    if cached is not None:
+        return cached
+    admin_ids = admin_cache.ids()
     admin_data = []
+    resolved = True
     # Recupera username di ogni admin
     for uid in admin_ids:
         try:
@@ -178,7 +172,25 @@ async def list_admins(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             username = member.user.username or "N/A"
         except Exception:
             username = "N/A"
+            resolved = False
         admin_data.append({"id": uid, "username": username})
+    if resolved:
+        admin_cache.set_rows(admin_ids, admin_data)
+    return admin_data
+
+@restricted
+async def list_admins(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Stampa la lista degli amministratori,
+    con paginazione e bottoni per navigare le pagine.
+    """
+    admin_data = await build_admin_data(context)
+    if not admin_data:
+        await update.message.reply_text(
+            "_Nessun amministratore trovato\\._",
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+        return
 
     await send_paginated_message(
         update,
@@ -194,29 +206,18 @@ async def list_verified_users(update: Update, context: ContextTypes.DEFAULT_TYPE
     Stampa la lista di tutti gli utenti verificati nel gruppo,
     ordinati per numero crescente di feedback ricevuti, con paginazione.
     """
-    global group_users
-    group_users = load_group_users() # Ricarica per avere i dati più aggiornati
-
     chat_id = int(GRUPPO_SCAMBI)
 
-    if chat_id not in group_users or not group_users[chat_id]:
+    if not context.bot_data.get('group_users', {}).get(chat_id):
         await update.message.reply_text(
             "_Nessun utente trovato o verificato in questo gruppo\\._",
             parse_mode=ParseMode.MARKDOWN_V2
         )
         return
 
-    verified_users_data = []
-    for user_id, user_data in group_users[chat_id].items():
-        if user_data.get("verified"):
-            username = user_data.get("username", "N/A")
-            feedback_ricevuti = user_data.get("feedback_ricevuti", 0)
-            verified_users_data.append({
-                "id": user_id,
-                "username": username,
-                "feedback_ricevuti": feedback_ricevuti
-            })
-    
+    # Classifica mantenuta in memoria: nessuna rilettura né riordino
+    verified_users_data = get_leaderboards(context.bot_data, chat_id)['verificati']
+
     if not verified_users_data:
         await update.message.reply_text(
             "_Nessun utente verificato trovato in questo gruppo\\._",
@@ -224,8 +225,6 @@ async def list_verified_users(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return
 
-    verified_users_data.sort(key=lambda x: (x["feedback_ricevuti"], x["username"].lower()))
-
     await send_paginated_message(
         update, context, verified_users_data, 'verificati', '*✅ Utenti Verificati*'
     )
@@ -233,29 +232,17 @@ async def list_verified_users(update: Update, context: ContextTypes.DEFAULT_TYPE
 @restricted
 async def list_feedback_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Stampa la lista di tutti gli utenti con il numero di feedback ricevuti, ordinati decrescentemente, con paginazione."""
-    global group_users
-    group_users = load_group_users()
-
     chat_id = int(GRUPPO_SCAMBI)
 
-    if chat_id not in group_users or not group_users[chat_id]:
+    if not context.bot_data.get('group_users', {}).get(chat_id):
         await update.message.reply_text(
             "_Nessun utente trovato con feedback ricevuti in questo gruppo\\._",
             parse_mode=ParseMode.MARKDOWN_V2
         )
         return
 
-    users_with_feedback = []
-    for user_id, user_data in group_users[chat_id].items():
-        feedback_ricevuti = user_data.get("feedback_ricevuti", 0)
-        if feedback_ricevuti > 0:
-            username = user_data.get("username", "N/A")
-            users_with_feedback.append({
-                "id": user_id,
-                "username": username,
-                "feedback_ricevuti": feedback_ricevuti
-            })
-    
+    users_with_feedback = get_leaderboards(context.bot_data, chat_id)['ricevuti']
+
     if not users_with_feedback:
         await update.message.reply_text(
             "_Nessun utente ha ancora ricevuto feedback in questo gruppo\\._",
@@ -263,37 +250,23 @@ async def list_feedback_received(update: Update, context: ContextTypes.DEFAULT_T
         )
         return
 
-    users_with_feedback.sort(key=lambda x: x["feedback_ricevuti"], reverse=True)
-
     await send_paginated_message(
         update, context, users_with_feedback, 'ricevuti', '*🏆 Classifica Feedback Ricevuti*'
     )
 
 @restricted
 async def list_feedback_sent(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    global group_users
-    group_users = load_group_users()
-
     chat_id = int(GRUPPO_SCAMBI)
 
-    if chat_id not in group_users or not group_users[chat_id]:
+    if not context.bot_data.get('group_users', {}).get(chat_id):
         await update.message.reply_text(
             "_Nessun utente trovato con feedback inviati in questo gruppo\\._",
             parse_mode=ParseMode.MARKDOWN_V2
         )
         return
 
-    users_with_feedback = []
-    for user_id, user_data in group_users[chat_id].items():
-        feedback_fatti = user_data.get("feedback_fatti", 0)
-        if feedback_fatti > 0:
-            username = user_data.get("username", "N/A")
-            users_with_feedback.append({
-                "id": user_id,
-                "username": username,
-                "feedback_fatti": feedback_fatti
-            })
-    
+    users_with_feedback = get_leaderboards(context.bot_data, chat_id)['inviati']
+
     if not users_with_feedback:
         await update.message.reply_text(
             "_Nessun utente ha ancora inviato feedback in questo gruppo\\._",
@@ -301,8 +274,6 @@ async def list_feedback_sent(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return
 
-    users_with_feedback.sort(key=lambda x: x["feedback_fatti"], reverse=True)
-
     await send_paginated_message(
         update, context, users_with_feedback, 'inviati', '*📊 Classifica Feedback Inviati*'
     )
@@ -314,31 +285,16 @@ async def list_limited_users(update: Update, context: ContextTypes.DEFAULT_TYPE)
     Stampa la lista di tutti gli utenti limitati nel gruppo,
     con paginazione e bottoni per navigare le pagine.
     """
-    global group_users
-    group_users = load_group_users()
-
     chat_id = int(GRUPPO_SCAMBI)
-    if chat_id not in group_users or not group_users[chat_id]:
+    if not context.bot_data.get('group_users', {}).get(chat_id):
         await update.message.reply_text(
             "_Nessun utente trovato o limitato in questo gruppo\\._",
             parse_mode=ParseMode.MARKDOWN_V2
         )
         return
 
-    limited_users_data = []
-    for user_id, user_data in group_users[chat_id].items():
-        if user_data.get("limited"):
-            username = user_data.get("username", "N/A")
-            feedback_ricevuti = user_data.get("feedback_ricevuti", 0)
-            feedback_fatti = user_data.get("feedback_fatti", 0)
-            diff = feedback_ricevuti - feedback_fatti
-            limited_users_data.append({
-                "id": user_id,
-                "username": username,
-                "divario": diff,
-                "feedback_ricevuti": feedback_ricevuti,
-                "feedback_fatti": feedback_fatti
-            })
+    # Già ordinata per divario e username
+    limited_users_data = get_leaderboards(context.bot_data, chat_id)['limitati']
 
     if not limited_users_data:
         await update.message.reply_text(
@@ -347,9 +303,6 @@ async def list_limited_users(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return
 
-    # Ordina per divario e username
-    limited_users_data.sort(key=lambda x: (x["divario"], x["username"].lower()))
-
     # Usa la funzione generica di paginazione con key 'limitati'
     await send_paginated_message(
         update,
@@ -359,7 +312,7 @@ async def list_limited_users(update: Update, context: ContextTypes.DEFAULT_TYPE)
         '*🚫 Utenti Limitati*'
     )
 
-async def send_paginated_message(update: Update, context: ContextTypes.DEFAULT_TYPE, data_list: List[Dict], command_key: str, title: str, current_page: int = 0, message_id: int = None) -> None:
+async def send_paginated_message(update: Update, context: ContextTypes.DEFAULT_TYPE, data_list: Sequence[Dict], command_key: str, title: str, current_page: int = 0, message_id: int = None) -> None:
     total_items = len(data_list)
     total_pages = (total_items + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
 
@@ -459,15 +412,22 @@ async def send_paginated_message(update: Update, context: ContextTypes.DEFAULT_T
             parse_mode=ParseMode.MARKDOWN_V2
         )
 
-    # Salva stato paginazione
-    user_id = update.effective_user.id
-    if user_id not in PAGINATION_DATA_STORE:
-        PAGINATION_DATA_STORE[user_id] = {}
-    PAGINATION_DATA_STORE[user_id][command_key] = {
-        'data_list': data_list,
-        'total_pages': total_pages,
-        'current_page': current_page
-    }
+    # Salva solo il descrittore della paginazione: le pagine successive vengono
+    # ricalcolate dai dati live
+    PAGINATION_DATA_STORE.put(
+        update.effective_user.id,
+        command_key,
+        getattr(data_list, 'version', 0),
+        current_page
+    )
+
+async def load_pagination_source(context: ContextTypes.DEFAULT_TYPE, command_key: str) -> Sequence[Dict]:
+    """
+    Restituisce i dati live da paginare per un comando.
+    """
+    if command_key == 'admin':
+        return await build_admin_data(context)
+    return get_leaderboards(context.bot_data, int(GRUPPO_SCAMBI))[command_key]
 
 async def handle_pagination_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
@@ -478,16 +438,21 @@ async def handle_pagination_callback(update: Update, context: ContextTypes.DEFAU
     command_key = parts[1]
     new_page = int(parts[2])
     user_id = query.from_user.id
-    store = PAGINATION_DATA_STORE.get(user_id, {}).get(command_key)
+    store = PAGINATION_DATA_STORE.get(user_id, command_key)
     if not store:
         await query.edit_message_text(
             "_Errore: Dati di paginazione non disponibili\\._",
             parse_mode=ParseMode.MARKDOWN_V2
         )
         return
-    total_pages = store['total_pages']
-    
-    if 0 <= new_page < total_pages and new_page != store['current_page']:
+    data_list = await load_pagination_source(context, command_key)
+    # Il numero di pagine viene ricalcolato: i dati possono essere cambiati nel frattempo
+    total_pages = (len(data_list) + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
+    changed = store.version != getattr(data_list, 'version', 0)
+    if changed:
+        new_page = min(new_page, max(0, total_pages - 1))
+
+    if 0 <= new_page < total_pages and (new_page != store.page or changed):
         title_map = {
             'verificati': '✅ Utenti Verificati',
             'ricevuti': '🏆 Classifica Feedback Ricevuti',
@@ -498,7 +463,7 @@ async def handle_pagination_callback(update: Update, context: ContextTypes.DEFAU
         await send_paginated_message(
             update=update,
             context=context,
-            data_list=store['data_list'],
+            data_list=data_list,
             command_key=command_key,
             title=f"*{title_map.get(command_key, command_key)}*",
             current_page=new_page,
@@ -0,0 +1,178 @@
+import os
+import asyncio
+import logging
+from typing import Dict, List, Tuple, Optional
+
+import storage
+from records import to_json, COUNTER_FIELDS, CARD_FIELDS
+from replicas import REPLICA_MODE
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "2"))
+WRITE_BEHIND_MAX_BATCH = int(os.getenv("WRITE_BEHIND_MAX_BATCH", "200"))
+
+
+class GroupUsersWriteBehind:
+    """
+    Buffer write-behind per il nodo 'group_users'.
+    Gli handler segnano come "sporchi" i soli utenti modificati; un task in
+    background li scrive su Firebase con update() multi-path, raggruppati
+    a intervalli regolari o appena il buffer supera la soglia.
+    Con più repliche (field_level) ogni utente viene scritto campo per campo
+    e i contatori come incrementi accumulati, così le modifiche fatte da
+    un'altra replica sugli stessi utenti non vengono sovrascritte.
+    """
+
+    def __init__(self, interval: float = WRITE_BEHIND_INTERVAL, max_batch: int = WRITE_BEHIND_MAX_BATCH,
+                 field_level: bool = REPLICA_MODE):
+        self.interval = interval
+        self.max_batch = max_batch
+        self.field_level = field_level
+        self._dirty: Dict[Tuple[int, int], dict] = {}
+        self._deltas: Dict[Tuple[int, int], Dict[str, int]] = {}
+        # Blocchi scritti per campi il cui esito non si è potuto verificare:
+        # (marcatore, utenti, incrementi), riletti a ogni flush finché non si sa se sono arrivati
+        self._uncertain: List[Tuple[str, list, Dict[Tuple[int, int], Dict[str, int]]]] = []
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def mark_dirty(self, chat_id: int, user_id: int, user_data: dict, counters: Optional[Dict[str, int]] = None) -> None:
+        """
+        Segna un utente da salvare al prossimo flush. counters sono le variazioni dei
+        contatori (vedi records.counter_deltas), usate solo nella scrittura per campi.
+        """
+        key = (int(chat_id), int(user_id))
+        self._dirty[key] = user_data
+        if counters:
+            self._add_deltas(key, counters)
+        if len(self._dirty) >= self.max_batch:
+            self._wake.set()
+
+    def _add_deltas(self, key: Tuple[int, int], counters: Dict[str, int]) -> None:
+        pending = self._deltas.setdefault(key, {})
+        for path, delta in counters.items():
+            pending[path] = pending.get(path, 0) + delta
+
+    def _paths(self, chat_id: int, user_id: int, data: dict, deltas: Dict[str, int]) -> Dict[str, object]:
+        if not self.field_level:
+            return {f"{chat_id}/{user_id}": to_json(data)}
+        return user_write_paths(chat_id, user_id, data, deltas)
+
+    @property
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    def is_dirty(self, chat_id: int, user_id: int) -> bool:
+        """True se l'utente ha modifiche in memoria non ancora scritte (o di esito incerto)."""
+        key = (int(chat_id), int(user_id))
+        return key in self._dirty or any(key in chunk_deltas for _, _, chunk_deltas in self._uncertain)
+
+    def _requeue(self, items: list, deltas: Dict[Tuple[int, int], Dict[str, int]]) -> None:
+        # Senza sovrascrivere modifiche più recenti
+        for key, data in items:
+            self._dirty.setdefault(key, data)
+            if key in deltas:
+                self._add_deltas(key, deltas[key])
+
+    async def _resolve_uncertain(self) -> None:
+        """Rimette in coda gli incrementi dei blocchi incerti che di certo non sono arrivati."""
+        for entry in list(self._uncertain):
+            marker, chunk, chunk_deltas = entry
+            applied = await storage.is_write_applied(marker)
+            if applied is None:
+                continue
+            self._uncertain.remove(entry)
+            if not applied:
+                self._requeue(chunk, chunk_deltas)
+
+    async def flush(self) -> None:
+        """Scrive su Firebase tutti gli utenti sporchi, a blocchi di max_batch percorsi."""
+        async with self._lock:
+            if self._uncertain:
+                await self._resolve_uncertain()
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            deltas, self._deltas = self._deltas, {}
+
+            items = list(dirty.items())
+            for i in range(0, len(items), self.max_batch):
+                chunk = items[i:i + self.max_batch]
+                # Copia in formato JSON fatta sul loop, così il thread non legge record in modifica
+                payload = {}
+                for (chat_id, user_id), data in chunk:
+                    payload.update(self._paths(chat_id, user_id, data, deltas.get((chat_id, user_id), {})))
+                # Gli incrementi non si possono riscrivere alla cieca: il blocco porta un
+                # marcatore che dice, dopo un errore, se la scrittura è arrivata lo stesso
+                marker = storage.new_write_marker() if self.field_level else None
+                ok = await storage.update_group_users(payload, marker)
+                if not ok and marker is not None:
+                    applied = await storage.is_write_applied(marker)
+                    if applied is None:
+                        chunk_deltas = {key: deltas[key] for key, _ in chunk if key in deltas}
+                        self._uncertain.append((marker, chunk, chunk_deltas))
+                        self._requeue(items[i + self.max_batch:], deltas)
+                        logger.warning(f"Flush group_users di esito incerto per {len(chunk)} utenti, verrà ricontrollato.")
+                        return
+                    ok = applied
+                if not ok:
+                    self._requeue(items[i:], deltas)
+                    logger.warning(f"Flush group_users fallito, {len(items) - i} utenti rimessi in coda.")
+                    return
+            logger.debug(f"Flush group_users: {len(items)} utenti salvati.")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Errore nel flush write-behind: {e}")
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            logger.info(
+                f"Write-behind group_users avviato (intervallo {self.interval}s, batch {self.max_batch})."
+            )
+
+    async def stop(self) -> None:
+        """Ferma il task periodico ed esegue un ultimo flush."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._uncertain:
+            logger.warning(f"{len(self._uncertain)} blocchi di group_users con esito ancora incerto allo spegnimento.")
+
+
+group_users_writer = GroupUsersWriteBehind()
+
+
+def user_write_paths(chat_id: int, user_id: int, user_data: dict, deltas: Dict[str, int]) -> Dict[str, object]:
+    """
+    Percorsi di scrittura di un utente campo per campo: i campi normali con il loro
+    valore, i contatori solo come incrementi (deltas, da records.counter_deltas).
+    """
+    base = f"{chat_id}/{user_id}"
+    paths: Dict[str, object] = {
+        f"{base}/{field}": value
+        for field, value in to_json(user_data).items()
+        if field not in COUNTER_FIELDS and field not in CARD_FIELDS
+    }
+    paths.update({f"{base}/{path}": storage.increment(delta) for path, delta in deltas.items()})
+    return paths
+
+
+def mark_user_dirty(chat_id: int, user_id: int, user_data: dict, counters: Optional[Dict[str, int]] = None) -> None:
+    group_users_writer.mark_dirty(chat_id, user_id, user_data, counters)